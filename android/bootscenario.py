@@ -0,0 +1,144 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+from android.init import AndroidInit
+from utils import resolve_jobs
+from utils.logger import Logger
+from utils.overlay import OverlayDict
+
+FileState = Tuple[int, int, int]
+'''(user, group, perms) of a file'''
+
+class BootScenario:
+    '''one way to boot the same parsed firmware'''
+    def __init__(self, name: str, properties: Dict[str, str] = None, setup: Callable[[AndroidInit], None] = None):
+        self.name: str = name
+        self.properties: Dict[str, str] = properties or {}
+        '''set before booting, e.g. {"ro.hardware": "kirin980", "vold.decrypt": "trigger_restart_framework"}'''
+        self.setup: Callable[[AndroidInit], None] = setup
+        '''any other change to the forked init before it boots'''
+
+class ScenarioResult:
+    '''what one booted scenario ended up with, only the parts boot changed for the filesystem'''
+    def __init__(self, name: str):
+        self.name: str = name
+        self.services: Set[str] = set()
+        '''started services'''
+        self.processes: Set[str] = set()
+        '''whatever the probe reported (e.g. FileSystemInstance.processes)'''
+        self.properties: Dict[str, str] = {}
+        self.mount_points: Dict[str, Tuple[str, str]] = {}
+        '''path -> (fstype, device)'''
+        self.files: Dict[str, FileState] = {}
+        '''files boot created or changed'''
+        self.removed_files: Set[str] = set()
+
+    def __repr__(self):
+        return "<ScenarioResult %s: %d services, %d processes, %d files changed>" % (
+            self.name, len(self.services), len(self.processes), len(self.files))
+
+class ScenarioDiff:
+    '''how a scenario differs from the base one'''
+    def __init__(self, base: ScenarioResult, other: ScenarioResult):
+        self.name: str = other.name
+        self.services_added: Set[str] = other.services - base.services
+        self.services_removed: Set[str] = base.services - other.services
+        self.processes_added: Set[str] = other.processes - base.processes
+        self.processes_removed: Set[str] = base.processes - other.processes
+        self.properties_changed: Dict[str, Tuple[str | None, str | None]] = {
+            k: (base.properties.get(k), other.properties.get(k))
+            for k in base.properties.keys() | other.properties.keys()
+            if base.properties.get(k) != other.properties.get(k)}
+        self.mount_points_changed: Set[str] = {
+            p for p in base.mount_points.keys() | other.mount_points.keys()
+            if base.mount_points.get(p) != other.mount_points.get(p)}
+        self.files_changed: Set[str] = {
+            p for p in base.files.keys() | other.files.keys()
+            if base.files.get(p) != other.files.get(p)} | (base.removed_files ^ other.removed_files)
+
+    def __bool__(self) -> bool:
+        return any([self.services_added, self.services_removed, self.processes_added, self.processes_removed,
+                    self.properties_changed, self.mount_points_changed, self.files_changed])
+
+    def __repr__(self):
+        return "<ScenarioDiff %s: services +%d -%d, processes +%d -%d, %d props, %d mounts, %d files>" % (
+            self.name, len(self.services_added), len(self.services_removed),
+            len(self.processes_added), len(self.processes_removed),
+            len(self.properties_changed), len(self.mount_points_changed), len(self.files_changed))
+
+def run_scenario(init: AndroidInit, scenario: BootScenario,
+                 probe: Callable[[AndroidInit], Iterable[str]] = None) -> ScenarioResult:
+    '''boot a fork of a parsed (not yet booted) init'''
+    fork = init.snapshot()
+    for k, v in scenario.properties.items():
+        fork.asp.properties[k] = v
+    if scenario.setup is not None:
+        scenario.setup(fork)
+
+    fork.boot_system()
+
+    res = ScenarioResult(scenario.name)
+    res.services = {name for name, service in fork.services.items() if service.started}
+    res.properties = dict(fork.asp.properties.prop)
+    res.mount_points = {p: (mp.type, mp.device) for p, mp in fork.asp.combined_fs.mount_points.items()}
+
+    files: OverlayDict = fork.asp.combined_fs.files
+    res.files = {p: (fp.user, fp.group, fp.perms) for p, fp in files.overlay.items()}
+    res.removed_files = set(files.deleted)
+    # with use_virtual_kernelfs, chown/chmod under /dev and /sys only change kernelfs nodes
+    kernelfs = fork.asp.combined_fs.kernelfs
+    if kernelfs is not None:
+        nodes = kernelfs.nodes.overlay if isinstance(kernelfs.nodes, OverlayDict) else kernelfs.nodes
+        res.files.update((p, (fp.user, fp.group, fp.perms)) for p, fp in nodes.items())
+
+    if probe is not None:
+        res.processes = set(probe(fork))
+    return res
+
+class BootScenarioRunner:
+    '''
+    Boot several scenarios from one parsed init, each in its own process.
+    Workers are forked, so they inherit the parsed state instead of pickling it, and
+    scenarios may carry setup callables (lambdas included).
+    '''
+    def __init__(self, init: AndroidInit, probe: Callable[[AndroidInit], Iterable[str]] = None):
+        self.init: AndroidInit = init
+        self.probe: Callable[[AndroidInit], Iterable[str]] = probe
+        '''optional, e.g. instantiate a FileSystemInstance and return its process names'''
+
+    def run(self, scenarios: List[BootScenario], jobs: int = None) -> Dict[str, ScenarioResult]:
+        jobs = min(resolve_jobs(jobs), max(1, len(scenarios)))
+        if jobs == 1:
+            return {s.name: run_scenario(self.init, s, self.probe) for s in scenarios}
+
+        Logger.info("Booting %d scenarios with %d workers", len(scenarios), jobs)
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_scenario_worker, initargs=(self.init, scenarios, self.probe)) as pool:
+            results = pool.map(_scenario_worker, range(len(scenarios)))
+            return {s.name: r for s, r in zip(scenarios, results)}
+
+    def compare(self, results: Dict[str, ScenarioResult], base: str = None) -> Dict[str, ScenarioDiff]:
+        '''diff every scenario against the base one (the first by default)'''
+        if not results:
+            return {}
+        base_result = results[base] if base is not None else next(iter(results.values()))
+        diffs: Dict[str, ScenarioDiff] = {}
+        for name, result in results.items():
+            if result is base_result:
+                continue
+            diffs[name] = ScenarioDiff(base_result, result)
+            Logger.info("%s", diffs[name])
+        return diffs
+
+_scenario_init: AndroidInit = None
+_scenario_list: List[BootScenario] = []
+_scenario_probe: Callable[[AndroidInit], Iterable[str]] = None
+
+def _init_scenario_worker(init: AndroidInit, scenarios: List[BootScenario], probe: Callable[[AndroidInit], Iterable[str]]):
+    global _scenario_init, _scenario_list, _scenario_probe
+    _scenario_init = init
+    _scenario_list = scenarios
+    _scenario_probe = probe
+
+def _scenario_worker(index: int) -> ScenarioResult:
+    return run_scenario(_scenario_init, _scenario_list[index], _scenario_probe)
@@ -1,12 +1,19 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import multiprocessing
 import os
 import re
 import stat
-from typing import Dict, List
+from typing import Deque, Dict, List, Set
 from android.dac import AID_MAP_INV, Cred
-from android.property import PROPERTY_KEY, PROPERTY_VALUE, AndroidPropertyList
+from android.property import PROPERTY_KEY, PROPERTY_VALUE, AndroidPropertyList, PropertyExpander
+from android.rcparser import RC_PARSE_CACHE, RCParseCache
 from android.sepolicy import SELinuxContext
 from extractor.androidsecuritypolicy import AndroidSecurityPolicy
 from fs.filesystempolicy import FilePolicy, FileSystemPolicy
+from fs.kernelfs import KernelFS, UeventRule, is_kernelfs
+from utils import resolve_jobs
 from utils.logger import Logger
 
 # 创建类型别名
@@ -29,13 +36,22 @@ class TriggerCondition:
     def new_stage(self, stage: str) -> bool:
         '''determine if the trigger <stage> should trigger this event'''
         if self.stage_trigger == stage or (self.stage_trigger is None and stage == "boot"):
-            for p, v in self.property_conditions.items():   # 遍历所有的属性条件
-                cont = True if p in self.props and (self.props[p] == v or v == "*") else False
-                if not cont: return False
-            return True
+            return self._properties_hold()
         else:
             return False
 
+    def property_changed(self, prop: str) -> bool:
+        '''determine if a change of <prop> should trigger this event (property only triggers)'''
+        if self.stage_trigger is not None or prop not in self.property_conditions:
+            return False
+        return self._properties_hold()
+
+    def _properties_hold(self) -> bool:
+        for p, v in self.property_conditions.items():   # 遍历所有的属性条件
+            if p not in self.props or (self.props[p] != v and v != "*"):
+                return False
+        return True
+
     def _parse_trigger(self):
         expect_and = False  # flag to indicate if we expect an &&
         for cond in self.raw_condition:
@@ -104,6 +120,12 @@ class AndroidInitService:
         
         self.disabled: bool = False
         self.oneshot: bool = False
+        self.started: bool = False
+        '''started by start/class_start during the boot simulation'''
+
+    @property
+    def classes(self) -> List[str]:
+        return [self.service_class] + self.service_groups
     
     def add_option(self, option: str, args: List[str]):
         if option == "user":
@@ -144,8 +166,60 @@ class AndroidInit:
         self.actions: List[AndroidInitAction] = []
 
          # Runtime events
-        self.queue: List[AndroidInitAction] = [] 
+        self.queue: Deque[AndroidInitAction] = deque()
+        self.queued: Set[AndroidInitAction] = set()
+        '''actions currently in the queue'''
+
+        self.stage_actions: Dict[str, List[AndroidInitAction]] = {}
+        '''stage -> actions it may trigger, in definition order'''
+
+        self.property_actions: Dict[str, List[AndroidInitAction]] = {}
+        '''property name -> actions with a condition on it, in definition order'''
+
+        self.property_triggers_enabled: bool = False
+        '''property changes fire triggers once the boot stage was reached, like init's queue_property_triggers'''
+
+        self.started_classes: Set[str] = set()
+
+        self.parse_cache: RCParseCache = RC_PARSE_CACHE
+        '''.rc/fstab parse results keyed by content hash'''
+
+        self.parsed_rcs: Dict[str, List[Section]] = {}
+        '''path -> sections parsed ahead of time by parse_init_rcs'''
+
+        self.expander: PropertyExpander | None = None
+        '''memoized ${prop} expansion, bound to asp.properties on first use'''
     
+    def snapshot(self) -> 'AndroidInit':
+        '''
+        Fork the init state: the copy has its own properties, copy-on-write filesystem,
+        services, action queue and trigger state, and can be booted without touching this
+        one. Parsed data (commands, trigger conditions, parse results) is shared.
+        '''
+        snap = AndroidInit(self.asp.snapshot())
+        snap.parse_cache = self.parse_cache
+        snap.parsed_rcs = self.parsed_rcs
+        snap.property_triggers_enabled = self.property_triggers_enabled
+        snap.started_classes = set(self.started_classes)
+
+        for name, service in self.services.items():
+            snap.services[name] = copy.copy(service)
+
+        forked: Dict[AndroidInitAction, AndroidInitAction] = {}
+        for action in self.actions:
+            condition = copy.copy(action.condition)
+            condition.props = snap.asp.properties   # conditions read the snapshot's properties
+            new_action = AndroidInitAction(condition)
+            new_action.commands = action.commands
+            forked[action] = new_action
+            snap.actions.append(new_action)
+
+        snap.stage_actions = {k: [forked[a] for a in v] for k, v in self.stage_actions.items()}
+        snap.property_actions = {k: [forked[a] for a in v] for k, v in self.property_actions.items()}
+        for action in self.queue:
+            snap.queue_action(forked[action])
+        return snap
+
     def determine_hardware(self) -> str:
         rohw = 'ro.hardware'
         if rohw not in self.asp.properties:
@@ -169,63 +243,72 @@ class AndroidInit:
             self.asp.properties[rohw] = ro_hardware_guess
         return self.asp.properties[rohw]
     
-    def read_configs(self, init_rc_base: str = "/init.rc"):
-        first_init = self.read_init_rc(init_rc_base)
-
+    def read_configs(self, init_rc_base: str = "/init.rc", jobs: int = 1):
+        '''
+        Read /init.rc and every /etc/init/*.rc of system, vendor and odm.
+        With jobs != 1 all files (and the files they import) are parsed in a process pool
+        first (None or 0 for one worker per core), then applied in the serial order.
+        '''
         init_files = self._list_mount_init_files("system")
         init_files += self._list_mount_init_files("vendor")
         init_files += self._list_mount_init_files("odm")
 
+        if jobs != 1:
+            self.parse_init_rcs([init_rc_base] + init_files, jobs)
+
+        first_init = self.read_init_rc(init_rc_base)
+
         for init_file in init_files:
             self.read_init_rc(init_file)
 
+        self.parsed_rcs = {}
+
+    def parse_init_rcs(self, paths: List[str], jobs: int = None):
+        '''
+        Parse .rc files in a process pool, wave by wave: the imports found in one wave are
+        parsed in the next. Only fills parsed_rcs, services and actions are left to
+        read_init_rc so first-definition-wins behaves exactly as in a serial run.
+        '''
+        seen: Set[str] = set()
+        wave: List[str] = [p for p in dict.fromkeys(paths) if p in self.asp.combined_fs]
+        jobs = resolve_jobs(jobs)
+
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+            while wave:
+                seen.update(wave)
+                results = pool.map(_parse_rc_worker, [self.asp.combined_fs[p] for p in wave],
+                                   chunksize=max(1, len(wave) // (jobs * 4)))
+                imports: List[str] = []
+                for path, sections in zip(wave, results):
+                    if sections is None:
+                        continue    # unreadable, read_init_rc reports it
+                    self.parsed_rcs[path] = sections
+                    for section in sections:
+                        if section[0][0] == "import":
+                            imports.append(self.expand_properties(section[0][1]))
+                wave = [p for p in dict.fromkeys(imports) if p not in seen and p in self.asp.combined_fs]
+
+        Logger.debug("Parsed %d init files with %d workers", len(self.parsed_rcs), jobs)
+
+    def read_rc_sections(self, path: str) -> List[Section]:
+        '''sections of an .rc file, parsed ahead of time by parse_init_rcs if possible'''
+        if path in self.parsed_rcs:
+            return self.parsed_rcs[path]
+
+        with open(self.asp.combined_fs[path], 'r') as fp:
+            rc_lines = fp.read()
+        return self.parse_cache.sections(rc_lines)
+
     def read_init_rc(self, path: str):
         '''Reads the init.rc file and returns a list of sections'''
         if path not in self.asp.combined_fs:
             Logger.error(f"init.rc file not found at {path}")
             return
             # raise FileNotFoundError(f"init.rc file not found at {path}")
-        rc_path = self.asp.combined_fs[path]
-
-        with open(rc_path, 'r') as fp:
-            rc_lines = fp.read()
 
         pending_imports: List[str] = []     # [str]
-        sections: List[Section] = []        # [sections]
-        current_section: Section = None     # ? type [['no','init'],['cmd','parms']] : [[str]]
-        line_continue: bool = False
-        
         # 读取所有的init配置的文件，将其分割成section
-        for line in rc_lines.split("\n"):
-            if re.match('^(\s*#)|(\s*$)', line): continue   # ignore comments and empty lines
-            line = re.sub('\s+', " ", line)                # remove extra spaces
-            components: List[str] = list(filter(lambda x: len(x) > 0, line.split(" "))) # split by spaces
-            action = components[0]
-            if action in ['import', 'on', 'service']:   # 开始一个新的section
-                if current_section is not None and len(current_section):
-                    sections += [current_section]
-
-                current_section = []
-            elif current_section is None:
-                # ignore actions/commands before the first section
-                continue
-
-            line_continue_next: bool = components[-1] == "\\"
-
-            # erase trailing slash
-            if line_continue_next:
-                components = components[:-1]
-
-            if line_continue:
-                current_section[-1] += components
-            else:
-                current_section += [components]
-
-            line_continue = line_continue_next
-
-        # Get trailing section
-        if current_section is not None and len(current_section):
-            sections += [current_section]
+        sections: List[Section] = self.read_rc_sections(path)
 
         # 处理每一个section
         for section in sections:
@@ -270,6 +353,12 @@ class AndroidInit:
         for cmd in commands:
             action.add_command(cmd[0], cmd[1:])
         self.actions += [action]
+
+        # property only triggers are checked when the boot stage is reached
+        stage = trigger_cond.stage_trigger if trigger_cond.stage_trigger is not None else "boot"
+        self.stage_actions.setdefault(stage, []).append(action)
+        for prop in trigger_cond.property_conditions:
+            self.property_actions.setdefault(prop, []).append(action)
     
     def _list_mount_init_files(self, mount_point: str) -> List[str]:
         '''List all init files in a mount point'''
@@ -305,6 +394,10 @@ class AndroidInit:
 
         # other stages will be handled by internal actions
         self.main_loop()
+
+        # system_server reports the end of the boot, run the `on property:sys.boot_completed=1` actions
+        self.setprop("sys.boot_completed", "1")
+        self.main_loop()
         
 
     def read_uevent_rc(self, path: str):
@@ -315,11 +408,7 @@ class AndroidInit:
         with open(rc_path, 'r') as fp:
             rc_lines = fp.read()
 
-        for line in rc_lines.split("\n"):
-            if re.match('^(\s*#)|(\s*$)', line): continue
-            line = re.sub('\s+', " ", line)
-            components = list(filter(lambda x: len(x) > 0, line.split(" ")))
-            
+        for components in self.parse_cache.lines(rc_lines):
             fn = components[0]
 
             fn_expand = ""
@@ -345,23 +434,79 @@ class AndroidInit:
             else:
                 continue
 
-            file_policy = FilePolicy.create_pseudo_file(mode, user, group)
+            kernelfs = self.asp.combined_fs.kernelfs
+            if kernelfs is not None:
+                kernelfs.add_rule(UeventRule(os.path.normpath(fn), mode, user, group,
+                                             components[1] if fn.startswith("/sys") else None))
+                continue
+
+            file_policy = FilePolicy.create_pseudo_file(user, group, mode)
             self._add_uevent_file(fn_expand, file_policy)
 
     def new_stage_trigger(self, stage: str):
-        for action in self.actions:
+        for action in self.stage_actions.get(stage, []):
             if action.condition.new_stage(stage):   # if trigger
                 self.queue_action(action)           # queue action
+        if stage == "boot":
+            self.property_triggers_enabled = True
+
+    def setprop(self, name: str, value: str):
+        '''set a property and fire the property triggers it now satisfies'''
+        if name.startswith("ro.") and name in self.asp.properties:
+            Logger.warning("Ignoring setprop of read-only property %s", name)
+            return
+        old = self.asp.properties.get_default(name, None)
+        self.asp.properties[name] = value
+        # only a real change re-evaluates, an action setting its own trigger property would loop otherwise
+        if old != value and self.property_triggers_enabled:
+            self.property_trigger(name)
+
+    def start_service(self, name: str):
+        if name in self.services:
+            self.services[name].started = True
+
+    def class_start(self, service_class: str):
+        self.started_classes.add(service_class)
+        for service in self.services.values():
+            if service_class in service.classes and not service.disabled:
+                service.started = True
+
+    def class_stop(self, service_class: str):
+        self.started_classes.discard(service_class)
+        for service in self.services.values():
+            if service_class in service.classes:
+                service.started = False
+
+    def mount_all_done(self):
+        '''
+        What init does once mount_all mounted /data (builtins.cpp queue_fs_event): unless a
+        scenario boots a block encrypted device, /data counts as unencrypted (or file based
+        encrypted) and `on nonencrypted` starts class main and late_start.
+        '''
+        if "ro.crypto.state" not in self.asp.properties:
+            self.setprop("ro.crypto.state", "unencrypted")
+        if self.asp.properties["ro.crypto.state"] == "encrypted" and \
+                self.asp.properties.get_default("ro.crypto.type", "block") != "file":
+            return  # FDE, the framework is started by the vold.decrypt triggers
+        self.new_stage_trigger("nonencrypted")
+
+    def property_trigger(self, prop: str):
+        '''a property changed, queue the property triggered actions it now satisfies'''
+        for action in self.property_actions.get(prop, []):
+            if action.condition.property_changed(prop):
+                self.queue_action(action)
 
     def queue_action(self, action: AndroidInitAction):
         '''Queue an action to be executed'''
-        if action in self.queue: return # do not double queue actions
+        if action in self.queued: return # do not double queue actions
         self.queue.append(action)
+        self.queued.add(action)
 
     def main_loop(self, log: bool = False):
         '''Main loop of the init process (executes queued actions) '''
         while len(self.queue):
-            action = self.queue.pop(0)
+            action = self.queue.popleft()
+            self.queued.discard(action)
             for cmd in action.commands:
                 self.execute(cmd[0], cmd[1:], log)
     
@@ -396,27 +541,28 @@ class AndroidInit:
                 fp = FilePolicy.create_pseudo_file(AID_MAP_INV['root'], AID_MAP_INV['root'], 0o755 | stat.S_IFDIR)
                 self.asp.combined_fs.add_file(total_path, fp)   # just directory
 
+    def use_virtual_kernelfs(self):
+        '''
+        Keep ueventd rules as patterns in a KernelFS and route init's chown/chmod of
+        unknown /dev and /sys paths there, instead of materializing pseudo files (with '*'
+        replaced by '0') in combined_fs. Call before boot_system.
+        '''
+        if self.asp.combined_fs.kernelfs is None:
+            self.asp.combined_fs.kernelfs = KernelFS()
+
     def lazy_init_uevent(self, path: str, mode: int):
+        if self.asp.combined_fs.kernelfs is not None and is_kernelfs(path):
+            return  # the kernelfs creates the node on chmod
         if path not in self.asp.combined_fs:
             if path.startswith("/dev"):     mode = mode | stat.S_IFCHR
             elif path.startswith("/sys"):   mode = mode | stat.S_IFREG
             self._add_uevent_file(path, FilePolicy.create_pseudo_file(AID_MAP_INV['root'], AID_MAP_INV['root'], mode))
 
     def expand_properties(self, string: str) -> str:
-        new_string: str = string
-
-        for m in re.finditer(r'\$\{' + PROPERTY_KEY.pattern + r'\}', string):
-            key = m.group(0)[2:-1]
-
-            # silently fail a property lookup
-            if key in self.asp.properties:
-                value = self.asp.properties[key]
-            else:
-                value = ""
-
-            new_string = new_string.replace(m.group(0), value)
-
-        return new_string
+        '''replace ${prop} references, unknown properties expand to ""'''
+        if self.expander is None or self.expander.properties is not self.asp.properties:
+            self.expander = PropertyExpander(self.asp.properties)
+        return self.expander.expand(string)
 
     def _init_rel_path(self, path: str) -> str:
         return self.asp.combined_fs[path]
@@ -459,7 +605,7 @@ class AndroidInit:
             path = args[2]
 
             # Try to instantiate it anyways (if it's not in the combined_fs)
-            if path not in self.asp.combined_fs:
+            if path not in self.asp.combined_fs and not (self.asp.combined_fs.kernelfs is not None and is_kernelfs(path)):
                 if path.startswith("/dev"):
                     mode = 0o0600 | stat.S_IFCHR
                 elif path.startswith("/sys"):
@@ -489,13 +635,32 @@ class AndroidInit:
         elif cmd == "rmdir":
             pass
         elif cmd == "setprop":
-            pass
+            # setprop <name> <value>
+            if len(args) < 1: return
+            self.setprop(args[0], self.expand_properties(" ".join(args[1:])))
+        elif cmd == "start":
+            if len(args) < 1: return
+            self.start_service(args[0])
+        elif cmd == "stop":
+            if len(args) < 1: return
+            if args[0] in self.services:
+                self.services[args[0]].started = False
+        elif cmd == "class_start":
+            if len(args) < 1: return
+            self.class_start(args[0])
+        elif cmd in ["class_stop", "class_reset"]:
+            if len(args) < 1: return
+            self.class_stop(args[0])
         elif cmd == "enable":
             # enable <service>
+            if len(args) < 1: return
             service: str = args[0]
             if service in self.services:
                 if self.services[service].disabled:
                     self.services[service].disabled = False
+                    # a service enabled after its class started is started right away
+                    if any(c in self.started_classes for c in self.services[service].classes):
+                        self.services[service].started = True
         elif cmd == "write":
             pass
         elif cmd == "mount":
@@ -512,6 +677,7 @@ class AndroidInit:
 
             self.asp.combined_fs.add_mount_point(path, fstype, device, options)
         elif cmd == "mount_all":
+            if len(args) < 1: return
             path = args[0]
             late_mount = "--late" in args
 
@@ -521,7 +687,7 @@ class AndroidInit:
                     entries = self.parse_fstab(fstab_data)
             except IOError:
                 Logger.warning("Failed to open fstab file: %s", path)
-                return
+                entries = []
 
             for entry in entries:
                 if late_mount and "latemount" not in entry["fsmgroptions"]: continue
@@ -529,16 +695,15 @@ class AndroidInit:
                 if entry["path"] in self.asp.combined_fs.mount_points: continue
 
                 self.asp.combined_fs.add_mount_point(entry["path"], entry["fstype"], entry["device"], entry["options"])
+
+            if not late_mount:
+                self.mount_all_done()
         # if self.asp.combined_fs['/system'] is None:
         #     raise FileNotFoundError("System partition not found")
     def parse_fstab(self, data: str) -> List[Dict[str, str]]:
         entries: List[Dict[str, str]] = []
 
-        for line in data.split("\n"):
-            if re.match('^(\s*#)|(\s*$)', line): continue
-            line = re.sub('\s+', " ", line)
-            components = list(filter(lambda x: len(x) > 0, line.split(" ")))
-            
+        for components in self.parse_cache.lines(data):
             device = components[0]
             mount_path = components[1]
             fstype = components[2]
@@ -557,3 +722,10 @@ class AndroidInit:
     def _import(self, path: str):
         self.read_init_rc(self.expand_properties(path))
 
+def _parse_rc_worker(rc_path: str) -> List[Section] | None:
+    try:
+        with open(rc_path, 'r') as fp:
+            rc_lines = fp.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return RC_PARSE_CACHE.sections(rc_lines)
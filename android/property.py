@@ -1,21 +1,60 @@
 
+import os
 import re
-from typing import Dict
+from typing import Callable, Dict, List, Set
+from utils.logger import Logger
 
 PROPERTY_KEY = re.compile(r'[-_.a-zA-Z0-9]+')   # 匹配-_.等的key字符串
 PROPERTY_VALUE = re.compile(r'[^#]*')
 PROPERTY_KV = re.compile(r'^\s*([-_.a-zA-Z0-9]+)\s*=\s*([^#]*)')
+PROPERTY_REF = re.compile(r'\$\{(' + PROPERTY_KEY.pattern + r')\}')     # ${ro.hardware}
+# one pass per line: `import <path> [filter]` or `key=value`, anything else (comments, blank lines) does not match
+PROPERTY_LINE = re.compile(r'\s*(?:import\s+(\S+)(?:\s+(\S+))?|([-_.a-zA-Z0-9]+)\s*=\s*([^#\n]*))')
+
+PROPERTY_FILES: List[str] = [
+    # legacy rootfs defaults
+    '/default.prop',
+    '/prop.default',
+    '/system/etc/prop.default',
+    '/system/build.prop',
+    '/system_ext/etc/build.prop',
+    '/system_ext/build.prop',
+    '/vendor/default.prop',
+    '/vendor/build.prop',
+    '/vendor_dlkm/etc/build.prop',
+    '/odm_dlkm/etc/build.prop',
+    '/odm/etc/build.prop',
+    '/odm/default.prop',
+    '/odm/build.prop',
+    '/product/etc/build.prop',
+    '/product/build.prop',
+]
+'''the property files init loads, in the order it loads them (later files override earlier ones)'''
+
+PropertyListener = Callable[[str, str], None]
+'''called with (key, new value) after a property changed'''
 
 class AndroidPropertyList:
     '''all properties in the Android system, only one field: prop'''
     def __init__(self):
         self.prop: Dict[str, str] = {}
+        self.listeners: List[PropertyListener] = []
+        self.sources: Dict[str, str] = {}
+        '''key -> file the current value was loaded from'''
+
+    def add_listener(self, listener: PropertyListener):
+        self.listeners.append(listener)
 
     def __getitem__(self, key: str) -> str:
         return self.prop[key]
     
     def __setitem__(self, key: str, value: str):
-        self.prop[key] = value
+        if self.listeners and self.prop.get(key) != value:
+            self.prop[key] = value
+            for listener in self.listeners:
+                listener(key, value)
+        else:
+            self.prop[key] = value
 
     def __contains__(self, key: str) -> bool:
         return key in self.prop
@@ -28,27 +67,32 @@ class AndroidPropertyList:
     
     def _merge(self, other: Dict[str, str]):
         for k, v in other.items():
-            self.prop[k] = v
+            self[k] = v
 
-    def from_file(self, filename: str):
-        '''从file中读取出配置文件，合并入当前类（覆盖）'''
-        prop_raw_data = open(filename, 'r').read()
-        properties = {}
+    def from_file(self, filename: str, source: str = None, key_filter: str = None) -> List[str]:
+        '''
+        从file中读取出配置文件，合并入当前类（覆盖）
+        Streams the file line by line. Values are recorded as coming from `source` (the
+        filename by default), only keys passing key_filter ("ro.*" or an exact key) are set.
+        Returns the paths of the import directives, in order, for the caller to resolve.
+        '''
+        source = filename if source is None else source
+        imports: List[str] = []
+        prefix = key_filter[:-1] if key_filter is not None and key_filter.endswith('*') else None
 
-        for line in prop_raw_data.split("\n"):
-            # Ignore comments and blank lines
-            if re.match(r'^(\s*#)|(\s*$)', line): continue
-            # Ignore import statements
-            if re.match('^import', line): continue
-            # Match property assignments (right side can be blank)
-            result = PROPERTY_KV.match(line)
-            if result is None: continue
-
-            prop, value = result.groups()
-            properties[prop] = value
-
-        # Merge in the final found properties
-        self._merge(properties)
+        with open(filename, 'r', errors='replace') as fp:
+            for line in fp:
+                result = PROPERTY_LINE.match(line)
+                if result is None: continue
+                import_path, import_filter, prop, value = result.groups()
+                if import_path is not None:
+                    imports.append(import_path if import_filter is None else import_path + " " + import_filter)
+                    continue
+                if key_filter is not None and (not prop.startswith(prefix) if prefix is not None else prop != key_filter):
+                    continue
+                self[prop] = value
+                self.sources[prop] = source
+        return imports
 
     def to_file(self, filename: str):
         '''文本形式写入file中'''
@@ -56,6 +100,13 @@ class AndroidPropertyList:
             for k, v in self.prop.items():
                 fp.write("%s=%s\n" % (k, v))
 
+    def copy(self) -> 'AndroidPropertyList':
+        '''same properties, no listeners'''
+        res = AndroidPropertyList()
+        res.prop = dict(self.prop)
+        res.sources = dict(self.sources)
+        return res
+
     def get_default(self, key: str, default: str = ""):
         if key not in self.prop: return default
         else: return self.prop[key]
@@ -67,3 +118,108 @@ class AndroidPropertyList:
                 return self.prop[key]
 
         return default
+
+class PropertyTemplate:
+    '''
+    A string with ${prop} references, split once into literal segments and property
+    keys: segments[0::2] are literals, segments[1::2] keys. Expanding is then a lookup
+    per key and a join.
+    '''
+    def __init__(self, string: str):
+        self.string: str = string
+        self.segments: List[str] = PROPERTY_REF.split(string)
+        self.keys: Set[str] = set(self.segments[1::2])
+
+    def expand(self, properties: AndroidPropertyList) -> str:
+        if not self.keys:
+            return self.string
+        segments = list(self.segments)
+        for i in range(1, len(segments), 2):
+            # silently fail a property lookup
+            segments[i] = properties.prop.get(segments[i], "")
+        return "".join(segments)
+
+    def __repr__(self):
+        return "<PropertyTemplate %s %s>" % (self.string, sorted(self.keys))
+
+_TEMPLATES: Dict[str, PropertyTemplate] = {}
+'''string -> template, templates do not depend on the properties so every list shares them'''
+
+def compile_template(string: str) -> PropertyTemplate:
+    template = _TEMPLATES.get(string)
+    if template is None:
+        template = _TEMPLATES[string] = PropertyTemplate(string)
+    return template
+
+class PropertyExpander:
+    '''
+    Expands ${prop} references against one AndroidPropertyList. Results are memoized
+    until one of the properties they reference changes.
+    '''
+    def __init__(self, properties: AndroidPropertyList):
+        self.properties: AndroidPropertyList = properties
+        self.results: Dict[str, str] = {}
+        self.dependents: Dict[str, Set[str]] = {}
+        '''property key -> memoized strings referencing it'''
+        properties.add_listener(self.on_property_change)
+
+    def expand(self, string: str) -> str:
+        res = self.results.get(string)
+        if res is not None:
+            return res
+
+        template = compile_template(string)
+        res = template.expand(self.properties)
+        if template.keys:
+            self.results[string] = res
+            for key in template.keys:
+                self.dependents.setdefault(key, set()).add(string)
+        return res
+
+    def on_property_change(self, key: str, value: str):
+        for string in self.dependents.pop(key, ()):
+            self.results.pop(string, None)
+
+class PropertyLoader:
+    '''
+    Loads the property files of a firmware into one AndroidPropertyList the way init
+    does: the known files in PROPERTY_FILES order, `import` directives followed in place
+    (with ${prop} expansion and an optional key filter). Files are streamed, never read whole.
+    '''
+    def __init__(self, properties: AndroidPropertyList, resolve: Callable[[str], str | None]):
+        self.properties: AndroidPropertyList = properties
+        self.resolve: Callable[[str], str | None] = resolve
+        '''device path -> host path, None if the firmware does not have the file'''
+        self.loaded: List[str] = []
+        '''device paths in load order'''
+        self._loading: Set[str] = set()
+
+    def load(self, path: str, key_filter: str = None):
+        path = os.path.normpath(compile_template(path).expand(self.properties))
+        if path in self._loading:
+            Logger.warning("Ignoring recursive import of %s", path)
+            return
+        host_path = self.resolve(path)
+        if host_path is None:
+            return
+
+        self._loading.add(path)
+        self.loaded.append(path)
+        try:
+            for directive in self.properties.from_file(host_path, path, key_filter):
+                self.load(*directive.split(" ", 1))
+        finally:
+            self._loading.discard(path)
+
+    def load_all(self, paths: List[str]) -> List[str]:
+        '''
+        Load every present file of PROPERTY_FILES, in order. Other files in `paths` (e.g. all
+        *.prop of the image) are loaded first, sorted, so the files init reads win.
+        '''
+        known = set(PROPERTY_FILES)
+        for path in sorted(p for p in paths if p not in known):
+            self.load(path)
+        for path in PROPERTY_FILES:
+            self.load(path)
+        Logger.info("Loaded %d properties from %d files", len(self.properties.prop), len(self.loaded))
+        return self.loaded
@@ -0,0 +1,176 @@
+import json
+import os
+from typing import TYPE_CHECKING, Dict, Iterable, List, Set, Tuple
+from android.property import AndroidPropertyList
+from android.sepolicy import SELinuxContext
+from utils.logger import Logger
+
+if TYPE_CHECKING:
+    from se.sepolicygraph import PolicyGraph
+
+# in the order init loads them, later entries win
+PROPERTY_CONTEXTS_FILES: List[str] = [
+    'property_contexts',
+    'plat_property_contexts',
+    'nonplat_property_contexts',
+    'vendor_property_contexts',
+]
+
+class PropertyContext:
+    '''
+    One property_contexts line: name context [prefix|exact] [type ...]
+    Legacy lines only have the name and the context and are prefix matches, "*" is the default.
+    '''
+    def __init__(self, name: str, context: SELinuxContext, exact: bool = False, value_type: str = None):
+        self.name: str = name
+        self.context: SELinuxContext = context
+        self.exact: bool = exact
+        self.value_type: str | None = value_type
+        '''string, bool, int, uint, double, size or enum (Android 10+), None if not given'''
+
+    def __repr__(self):
+        return "<PropertyContext %s%s -> %s>" % (self.name, "" if self.exact else "*", self.context.type)
+
+class _TrieNode:
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children: Dict[str, _TrieNode] = {}
+        self.entry: PropertyContext | None = None
+
+class PropertyContextIndex:
+    '''
+    property name -> label, the way libselinux/property_info resolves it: an exact entry
+    first, otherwise the longest prefix entry. Prefix entries live in a character trie so a
+    lookup costs the length of the name, not the number of entries.
+    '''
+    def __init__(self):
+        self.exact: Dict[str, PropertyContext] = {}
+        self.root: _TrieNode = _TrieNode()
+        '''the "*" default entry sits on the root'''
+        self.entries: int = 0
+
+    def add(self, pc: PropertyContext):
+        self.entries += 1
+        if pc.exact:
+            self.exact[pc.name] = pc
+            return
+        node = self.root
+        for c in pc.name.rstrip('*'):
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = _TrieNode()
+            node = child
+        node.entry = pc
+
+    def lookup(self, name: str) -> PropertyContext | None:
+        pc = self.exact.get(name)
+        if pc is not None:
+            return pc
+        node = self.root
+        res = node.entry
+        for c in name:
+            node = node.children.get(c)
+            if node is None:
+                break
+            if node.entry is not None:
+                res = node.entry
+        return res
+
+    def label(self, name: str) -> str | None:
+        pc = self.lookup(name)
+        return pc.context.type if pc is not None else None
+
+    def read(self, source: str):
+        '''add the entries of one property_contexts file'''
+        with open(source, 'r') as fp:
+            for line_no, line in enumerate(fp):
+                components = line.split()
+                # Ignore comments and blank lines
+                if not components or components[0][0] == '#':
+                    continue
+                if len(components) < 2:
+                    raise ValueError("Malformed property_contexts line %d in %s" % (line_no+1, source))
+
+                name, context = components[0], SELinuxContext.FromString(components[1])
+                exact = len(components) > 2 and components[2] == "exact"
+                value_type = components[3] if len(components) > 3 else None
+                self.add(PropertyContext(name, context, exact, value_type))
+
+    @staticmethod
+    def from_files(sources: Iterable[str]) -> 'PropertyContextIndex':
+        index = PropertyContextIndex()
+        for source in sources:
+            if os.path.isfile(source):
+                index.read(source)
+        Logger.debug("Loaded %d property contexts (%d exact)", index.entries, len(index.exact))
+        return index
+
+class PropertySetters:
+    '''
+    "which domains can set property P", for every property at once.
+
+    One pass over the allow rules collects `property_service:set` grants per target, then
+    every distinct label is resolved once (attributes expanded on both sides) and the
+    properties only look up their label in the trie.
+    '''
+    def __init__(self, index: PropertyContextIndex, pg: 'PolicyGraph', perm: str = "set"):
+        self.index: PropertyContextIndex = index
+        self.pg: 'PolicyGraph' = pg
+        self.perm: str = perm
+
+        self.grants: Dict[str, Set[str]] = {}
+        '''target type/attribute -> source types/attributes allowed to set it'''
+        for s, t, edge in pg.G_allow.edges(data=True):
+            if edge["teclass"] == "property_service" and perm in edge["perms"]:
+                self.grants.setdefault(t, set()).add(s)
+
+        self.label_setters: Dict[str, Set[str]] = {}
+        '''label -> domains (types, attributes expanded) that can set properties with that label'''
+
+    def setters_of_label(self, label: str) -> Set[str]:
+        res = self.label_setters.get(label)
+        if res is not None:
+            return res
+
+        res = set()
+        targets = self.pg.expand_type(label) if label in self.pg.types else [label]
+        for t in targets:
+            for s in self.grants.get(t, ()):
+                if s in self.pg.attributes:
+                    res.update(self.pg.attributes[s])
+                else:
+                    res.add(s)
+        self.label_setters[label] = res
+        return res
+
+    def setters(self, name: str) -> Set[str]:
+        label = self.index.label(name)
+        return self.setters_of_label(label) if label is not None else set()
+
+    def table(self, properties: AndroidPropertyList | Iterable[str]) -> Dict[str, Tuple[str | None, List[str]]]:
+        '''property -> (label, sorted setter domains)'''
+        names = properties.prop.keys() if isinstance(properties, AndroidPropertyList) else properties
+        res: Dict[str, Tuple[str | None, List[str]]] = {}
+        sorted_setters: Dict[str, List[str]] = {}
+        for name in names:
+            label = self.index.label(name)
+            if label is None:
+                res[name] = (None, [])
+                continue
+            if label not in sorted_setters:
+                sorted_setters[label] = sorted(self.setters_of_label(label))
+            res[name] = (label, sorted_setters[label])
+
+        unlabeled = sum(1 for label, _ in res.values() if label is None)
+        Logger.info("Resolved setters of %d properties (%d labels, %d unlabeled)", len(res), len(sorted_setters), unlabeled)
+        return res
+
+    def write(self, properties: AndroidPropertyList | Iterable[str], path: str):
+        table = self.table(properties)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump({name: {"label": label, "setters": setters} for name, (label, setters) in sorted(table.items())},
+                      fp, indent=2)
+        Logger.info("Wrote property setters to %s", path)
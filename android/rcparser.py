@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+from utils import MODULE_PATH
+from utils.logger import Logger
+
+Tokens = List[str]
+Section = List[Tokens]
+
+# keywords that start a new section of an init .rc file
+SECTION_KEYWORDS: Tuple[str, ...] = ('import', 'on', 'service')
+
+def tokenize(text: str) -> Iterator[Tokens]:
+    '''
+    Whitespace separated tokens of every line, skipping blank lines and lines whose
+    first non blank character is '#'. Same as the former per-line regexes, without them.
+    '''
+    for line in text.split("\n"):
+        tokens = line.split()
+        if not tokens or tokens[0][0] == '#':
+            continue
+        yield tokens
+
+def parse_sections(text: str, keywords: Tuple[str, ...] = SECTION_KEYWORDS) -> List[Section]:
+    '''
+    Group the lines of an .rc file into sections, in one pass. A section starts at a
+    keyword line, lines before the first section are ignored and a trailing "\\" joins
+    the next line to the current one.
+    '''
+    sections: List[Section] = []
+    current: Section = None
+    line_continue: bool = False
+
+    for tokens in tokenize(text):
+        if tokens[0] in keywords:   # 开始一个新的section
+            if current:
+                sections.append(current)
+            current = []
+        elif current is None:
+            # ignore actions/commands before the first section
+            continue
+
+        line_continue_next = tokens[-1] == "\\"
+        # erase trailing slash
+        if line_continue_next:
+            tokens.pop()
+
+        if line_continue:
+            current[-1] += tokens
+        else:
+            current.append(tokens)
+        line_continue = line_continue_next
+
+    # Get trailing section
+    if current:
+        sections.append(current)
+    return sections
+
+class RCParseCache:
+    '''
+    Parse results keyed by the sha256 of the file content.
+
+    Most .rc files of a firmware are stock AOSP ones, byte for byte the same on every
+    image, so they are parsed once in memory and once across runs when a cache
+    directory is given (eval/cache/rc by default). Results are shared, callers must
+    not modify them.
+    '''
+    def __init__(self, directory: str = None):
+        self.directory: str | None = directory
+        self.entries: Dict[str, List] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def sections(self, text: str) -> List[Section]:
+        '''parse_sections(text), cached'''
+        return self._get("sections", text, parse_sections)
+
+    def lines(self, text: str) -> List[Tokens]:
+        '''list(tokenize(text)), cached. For line based files (ueventd.rc, fstab)'''
+        return self._get("lines", text, lambda t: list(tokenize(t)))
+
+    def _get(self, kind: str, text: str, parse) -> List:
+        key = hashlib.sha256(("%s\0%s" % (kind, text)).encode('utf-8', 'surrogateescape')).hexdigest()
+        res = self.entries.get(key)
+        if res is not None:
+            self.hits += 1
+            return res
+
+        res = self._load(key)
+        if res is None:
+            self.misses += 1
+            res = parse(text)
+            self._store(key, res)
+        else:
+            self.hits += 1
+        self.entries[key] = res
+        return res
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _load(self, key: str) -> List | None:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, key: str, res: List):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so concurrent runs never read a partial entry
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'w') as fp:
+                json.dump(res, fp)
+            os.replace(tmp, path)
+        except OSError as e:
+            Logger.debug("Unable to cache parse result %s: %s", key, e)
+
+RC_PARSE_CACHE: RCParseCache = RCParseCache(os.path.join(MODULE_PATH, 'eval', 'cache', 'rc'))
+'''shared by every AndroidInit of a run'''
@@ -0,0 +1,85 @@
+import os
+import re
+from typing import Dict, Iterable, List, Tuple
+from android.sepolicy import SELinuxContext
+from utils.logger import Logger
+
+# service_manager class -> the contexts files naming its services, later files win
+SERVICE_CONTEXTS_FILES: Dict[str, List[str]] = {
+    'service_manager': ['service_contexts', 'plat_service_contexts', 'nonplat_service_contexts'],
+    'hwservice_manager': ['hwservice_contexts', 'plat_hwservice_contexts', 'nonplat_hwservice_contexts', 'vendor_hwservice_contexts'],
+    'vndservice_manager': ['vndservice_contexts'],
+}
+
+# android.hardware.camera.provider@2.4::ICameraProvider -> android.hardware.camera.provider::ICameraProvider
+HIDL_VERSION = re.compile(r'@[0-9]+\.[0-9]+(?=::)')
+
+class ServiceContextIndex:
+    '''
+    service name -> type, one hash index per service manager ("service_manager",
+    "hwservice_manager", "vndservice_manager"). Unknown names fall back to the "*" entry
+    the way servicemanager does.
+    '''
+    def __init__(self):
+        self.names: Dict[str, Dict[str, str]] = {teclass: {} for teclass in SERVICE_CONTEXTS_FILES}
+        self.defaults: Dict[str, str] = {}
+        '''teclass -> type of the "*" entry'''
+
+    def __repr__(self):
+        return "<ServiceContextIndex %s>" % ", ".join("%s: %d" % (k, len(v)) for k, v in self.names.items())
+
+    def add(self, teclass: str, name: str, ty: str):
+        if name == "*":
+            self.defaults[teclass] = ty
+        else:
+            self.names.setdefault(teclass, {})[name] = ty
+
+    def lookup(self, teclass: str, name: str, default: bool = True) -> str | None:
+        ty = self.names.get(teclass, {}).get(name)
+        if ty is None and default:
+            ty = self.defaults.get(teclass)
+        return ty
+
+    def read(self, teclass: str, source: str):
+        '''add the entries of one *service_contexts file'''
+        with open(source, 'r') as fp:
+            for line_no, line in enumerate(fp):
+                components = line.split()
+                # Ignore comments and blank lines
+                if not components or components[0][0] == '#':
+                    continue
+                if len(components) < 2:
+                    raise ValueError("Malformed service_contexts line %d in %s" % (line_no+1, source))
+                self.add(teclass, components[0], SELinuxContext.FromString(components[1]).type)
+
+    @staticmethod
+    def from_files(sources: Dict[str, Iterable[str]]) -> 'ServiceContextIndex':
+        '''teclass -> paths, missing files are skipped'''
+        index = ServiceContextIndex()
+        for teclass, paths in sources.items():
+            for path in paths:
+                if os.path.isfile(path):
+                    index.read(teclass, path)
+        Logger.debug("Loaded service contexts %s", index)
+        return index
+
+    def interface_types(self, options: List[List[str]]) -> List[Tuple[str, str]]:
+        '''
+        (teclass, type) of every interface an init service declares, from its rc options:
+            interface android.hardware.camera.provider@2.4::ICameraProvider legacy/0   (HIDL)
+            interface aidl android.hardware.power.IPower/default                       (AIDL)
+        Interfaces without an explicit entry are left out, the default type says nothing about the owner.
+        '''
+        res: List[Tuple[str, str]] = []
+        for option in options:
+            if option[0] != "interface" or len(option) < 3:
+                continue
+            if option[1] == "aidl":
+                ty = self.lookup('service_manager', option[2], default=False)
+                if ty is not None:
+                    res.append(('service_manager', ty))
+                continue
+            ty = self.lookup('hwservice_manager', HIDL_VERSION.sub('', option[1]), default=False)
+            if ty is not None:
+                res.append(('hwservice_manager', ty))
+        return res
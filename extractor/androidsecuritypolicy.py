@@ -18,6 +18,11 @@ class AndroidSecurityPolicy:
         self.fs_policies = fs_policies
         self.policy_files = policy_files
     
+    def snapshot(self) -> 'AndroidSecurityPolicy':
+        '''copy that can be booted independently: copy-on-write combined_fs, own properties'''
+        return AndroidSecurityPolicy(self.combined_fs.snapshot(), self.properties.copy(),
+                                     self.name, self.fs_policies, self.policy_files)
+
     def get_android_version(self) -> List[int]:
         android_version: List[int] = list(map(int, self.get_properties()['properties']['android_version'].split('.')))
 
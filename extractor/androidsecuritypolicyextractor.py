@@ -1,10 +1,11 @@
 import copy
 import fnmatch
+import json
 import os
 import pickle
 import shutil
 from typing import Dict, List
-from android.property import AndroidPropertyList
+from android.property import AndroidPropertyList, PropertyLoader
 from extractor.androidsecuritypolicy import AndroidSecurityPolicy
 from fs.filesystempolicy import FilePolicy, FileSystem, FileSystemPolicy
 from se.policyfiles import PolicyFiles
@@ -184,13 +185,12 @@ class AndroidSecurityPolicyExtractor:
         prop_files += self.combined_fs.find("prop.default")
 
         props = AndroidPropertyList()
-        
-        # TODO: ensure ordering of property files!
+
+        # init's load order, imports followed in place
         # Ref: https://rxwen.blogspot.com/2010/01/android-property-system.html
-        for prop_file in prop_files:
-            src = self.combined_fs.files[prop_file].original_path
-            props.from_file(src)
-            self.save_file(src, os.path.join("prop", prop_file[1:]))
+        loader = PropertyLoader(props, lambda path: self.combined_fs.files[path].original_path if path in self.combined_fs else None)
+        for prop_file in dict.fromkeys(loader.load_all(prop_files)):
+            self.save_file(self.combined_fs.files[prop_file].original_path, os.path.join("prop", prop_file[1:]))
 
         if 'ro.build.version.release' not in props.prop:
             raise Exception("Invalid firmware image '%s': missing Android version in props files" % self.asp.firmware_name)
@@ -214,6 +214,9 @@ class AndroidSecurityPolicyExtractor:
 
     def save(self):
         self.properties.to_file(os.path.join(MODULE_PATH, 'eval', self.name, 'all_properties.prop'))
+        # which property file each value came from, all_properties.prop alone loses it
+        with open(os.path.join(MODULE_PATH, 'eval', self.name, 'property_sources.json'), 'w') as fp:
+            json.dump(self.properties.sources, fp, indent=2, sort_keys=True)
         Logger.info(f'Saved all properties')
         self.save_db(self.combined_fs, "combined_fs.pkl")
 
@@ -230,4 +233,8 @@ class AndroidSecurityPolicyExtractor:
     def load(self):
         self.properties = AndroidPropertyList()
         self.properties.from_file(os.path.join(MODULE_PATH, 'eval', self.name, 'all_properties.prop'))
+        sources_path = os.path.join(MODULE_PATH, 'eval', self.name, 'property_sources.json')
+        if os.path.isfile(sources_path):
+            with open(sources_path, 'r') as fp:
+                self.properties.sources.update(json.load(fp))
         self.combined_fs = self.load_db("combined_fs.pkl")
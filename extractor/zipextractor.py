@@ -1,17 +1,99 @@
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+from typing import List, Tuple
 from extractor.filesystemparser import AndroidSparseImageParser, LinuxExt4ImageParser, AndroidBootingParser
 from fs.filesystempolicy import FileSystem
 from utils.logger import Logger
-from zipfile import ZipFile
-from utils import MODULE_PATH
+from zipfile import ZipFile, ZipInfo
+from utils import MODULE_PATH, resolve_jobs
 import os
 
+EXTRACT_PATTERNS: List[str] = [
+    '*.zip',        # nested archives, planned again once extracted
+    '*.img',        # partition, sparse and boot images
+    '*.ext4',
+    '*.bin',        # e.g. the vfat NON-HLOS.bin of Qualcomm firmwares
+    'update*.app',  # Huawei, split by split_update_app
+]
+'''
+basenames (case insensitive) of the usual image members, an opt-in filter:
+process_file recognizes images by content, so extension-less images are only
+extracted with the default (everything)
+'''
+
+ExtractTask = Tuple[str, str, str]
+'''(archive, member, output directory)'''
+
 class ZipExtractor:
     '''extract zipped firmware'''
-    def __init__(self, filename: str) -> 'ZipExtractor':
+    def __init__(self, filename: str, patterns: List[str] = None, jobs: int = None) -> 'ZipExtractor':
         self.filename = os.path.basename(filename)
+        self.patterns: List[str] = [p.lower() for p in (patterns if patterns is not None else ['*'])]
+        '''members to extract, e.g. EXTRACT_PATTERNS to skip payloads process_file can not use'''
+        self.jobs: int = resolve_jobs(jobs)
+        '''decompression workers, None or 0 for one per core'''
         Logger.info(f"ZipExtractor init: {self.filename}")
         self.extract()
+
+    def wanted(self, info: ZipInfo) -> bool:
+        if info.is_dir():
+            return False
+        name = os.path.basename(info.filename).lower()
+        return any(fnmatch.fnmatchcase(name, p) for p in self.patterns)
+
+    def plan(self, archive: str, out_dir: str) -> List[Tuple[int, ExtractTask]]:
+        '''(size, task) of the wanted members of one archive, read from its central directory only'''
+        tasks: List[Tuple[int, ExtractTask]] = []
+        skipped = 0
+        with ZipFile(archive, 'r') as zf:
+            for info in zf.infolist():
+                if not self.wanted(info):
+                    skipped += info.file_size
+                    continue
+                target = os.path.join(out_dir, info.filename)
+                if os.path.isfile(target) and os.path.getsize(target) == info.file_size:
+                    Logger.debug(f"ZipExtractor: already extracted: {target}")
+                    continue
+                tasks.append((info.file_size, (archive, info.filename, out_dir)))
+        Logger.debug(f"ZipExtractor: {archive}: {len(tasks)} members to extract, {skipped >> 20} MiB skipped")
+        return tasks
+
+    def extract_archives(self, archives: List[Tuple[str, str]]):
+        '''
+        Extract the wanted members of (archive, output directory) pairs, then of the zips
+        found among them, wave by wave. Members are inflated concurrently in a process pool
+        (zlib holds the GIL), largest first.
+        '''
+        pool = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        try:
+            while archives:
+                tasks: List[Tuple[int, ExtractTask]] = []
+                for archive, out_dir in archives:
+                    tasks += self.plan(archive, out_dir)
+                tasks.sort(key=lambda x: x[0], reverse=True)
+                # every archive of the next wave is a member of this one, extracted or not
+                nested = [(a, o, m) for a, o in archives for m in self.nested_members(a)]
+
+                batch = [task for _, task in tasks]
+                if pool is not None and len(batch) > 1:
+                    list(pool.map(_extract_member, batch))
+                else:
+                    for task in batch:
+                        _extract_member(task)
+                Logger.info(f"ZipExtractor: extracted {len(batch)} members")
+
+                archives = []
+                for archive, out_dir, member in nested:
+                    path = os.path.join(out_dir, member)
+                    Logger.debug(f"ZipExtractor: recursive zipped file found: {path}")
+                    archives.append((path, os.path.splitext(path)[0]))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def nested_members(self, archive: str) -> List[str]:
+        with ZipFile(archive, 'r') as zf:
+            return [info.filename for info in zf.infolist() if info.filename.lower().endswith('.zip') and self.wanted(info)]
         
     def extract(self):
         '''extract zipped firmware once (may have recursive zipped files)'''
@@ -27,32 +109,9 @@ class ZipExtractor:
         zip_file_path_out = os.path.join(MODULE_PATH, 'firmwares_extracted', os.path.splitext(self.filename)[0])
         Logger.debug(f"ZipExtractor: zip_file_path_out: {zip_file_path_out}")
         self.extracted_path = zip_file_path_out
-        if not os.path.exists(zip_file_path_out):
-            os.makedirs(zip_file_path_out)
-            with ZipFile(zip_file_path_in, 'r') as zf:
-                zf.extractall(zip_file_path_out)
-            Logger.info(f"ZipExtractor: zip file extracted: {zip_file_path_out}")
-        else:
-            Logger.warning(f"ZipExtractor: zip file already extracted: {zip_file_path_out}")
-        
-        # 使用 os.walk() 遍历文件系统
-        for dirpath, dirnames, filenames in os.walk(zip_file_path_out):
-            # dirpath: 当前目录路径
-            # dirnames: 当前目录下的子目录名列表
-            # filenames: 当前目录下的文件名列表
-            for filename in filenames:
-                if filename.endswith('.zip'):
-                    Logger.debug(f"ZipExtractor: recursive zipped file found: {filename}")
-                    zip_file_path_in = os.path.join(dirpath, filename)
-                    zip_file_path_out = os.path.join(dirpath, os.path.splitext(filename)[0])
-                    if not os.path.exists(zip_file_path_out):
-                        os.makedirs(zip_file_path_out)
-                        with ZipFile(zip_file_path_in, 'r') as zf:
-                            zf.extractall(zip_file_path_out)
-                        Logger.info(f"ZipExtractor: recursive zipped file extracted: {zip_file_path_out}")
-                    else:
-                        Logger.warning(f"ZipExtractor: recursive zipped file already extracted: {zip_file_path_out}")
-            
+        os.makedirs(zip_file_path_out, exist_ok=True)
+        self.extract_archives([(zip_file_path_in, zip_file_path_out)])
+
         Logger.info("ZipExtractor status: done")
         return
 
@@ -99,4 +158,10 @@ class ZipExtractor:
     
     def get_mnt(self):
         '''get mount point of extracted file'''
-        return os.path.join(MODULE_PATH, 'firmwares_mnt', os.path.splitext(self.filename)[0])
\ No newline at end of file
+        return os.path.join(MODULE_PATH, 'firmwares_mnt', os.path.splitext(self.filename)[0])
+
+def _extract_member(task: ExtractTask) -> str:
+    '''runs in the pool, each worker opens the archive itself'''
+    archive, member, out_dir = task
+    with ZipFile(archive, 'r') as zf:
+        return zf.extract(member, out_dir)
\ No newline at end of file
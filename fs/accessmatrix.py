@@ -0,0 +1,250 @@
+import stat
+from typing import Dict, List, Tuple, Union
+from android.dac import Cred
+from fs.filesystempolicy import FilePolicy
+from se.graphnode import ProcessNode, ProcessState
+from se.sepolicygraph import PolicyGraph
+from utils.logger import Logger
+
+# access bits, the same as the rwx bits of a mode
+READ: int = 4
+WRITE: int = 2
+EXECUTE: int = 1
+
+# file type -> SELinux class
+FILE_CLASSES: Dict[int, str] = {
+    stat.S_IFREG: 'file',
+    stat.S_IFDIR: 'dir',
+    stat.S_IFLNK: 'lnk_file',
+    stat.S_IFCHR: 'chr_file',
+    stat.S_IFBLK: 'blk_file',
+    stat.S_IFSOCK: 'sock_file',
+    stat.S_IFIFO: 'fifo_file',
+}
+CLASS_NAMES: List[str] = list(FILE_CLASSES.values())
+
+# access bit -> perms that grant it under MAC, per class
+MAC_PERMS: Dict[int, Tuple[str, ...]] = {
+    READ: ('read',),
+    WRITE: ('write', 'append'),
+    EXECUTE: ('execute',),
+}
+DIR_MAC_PERMS: Dict[int, Tuple[str, ...]] = {
+    READ: ('read',),
+    WRITE: ('write', 'add_name'),
+    EXECUTE: ('search',),
+}
+
+def _numpy():
+    # numpy is only needed for the access matrix, do not make it a hard dependency
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required to compute the access matrix")
+    return numpy
+
+def mac_bits(pg: PolicyGraph, subject_type: str, label: str, teclass: str) -> int:
+    '''READ | WRITE | EXECUTE that the policy allows subject_type on label:teclass'''
+    allowed = pg.allowed_perms(subject_type, label, teclass)
+    if not allowed:
+        return 0
+    perms = DIR_MAC_PERMS if teclass == 'dir' else MAC_PERMS
+    res = 0
+    for bit, needed in perms.items():
+        if any(p in allowed for p in needed):
+            res |= bit
+    return res
+
+def dac_capabilities(process: ProcessNode, mac: bool = True) -> Tuple[bool, bool]:
+    '''(CAP_DAC_OVERRIDE, CAP_DAC_READ_SEARCH) that are effective for a process'''
+    effective = process.cred.cap.effective
+    # under MAC a capability also needs the policy's blessing (capability { dac_override })
+    allowed = process.subject.cred.cap.selinux if mac else effective
+    return ('CAP_DAC_OVERRIDE' in effective and 'CAP_DAC_OVERRIDE' in allowed,
+            'CAP_DAC_READ_SEARCH' in effective and 'CAP_DAC_READ_SEARCH' in allowed)
+
+def dac_bits(cred: Cred, uid: int, gid: int, mode: int, dac_override: bool = False, dac_read_search: bool = False) -> int:
+    '''access bits of one file for one set of credentials, see DACEvaluator.dac'''
+    if cred.uid is not None and cred.uid == uid:
+        bits = (mode >> 6) & 7
+    elif (cred.gid is not None and cred.gid == gid) or gid in cred.groups:
+        bits = (mode >> 3) & 7
+    else:
+        bits = mode & 7
+
+    is_dir = stat.S_ISDIR(mode)
+    if dac_override:
+        bits |= READ | WRITE
+        if is_dir or mode & 0o111:
+            bits |= EXECUTE
+    elif dac_read_search:
+        bits |= READ
+        if is_dir:
+            bits |= EXECUTE
+    return bits
+
+class SparseAccessMatrix:
+    '''
+    processes x files access bits in CSR form: row i covers
+    indices[indptr[i]:indptr[i+1]] (file columns) with the matching data (access bits).
+    '''
+    def __init__(self, rows: List[str], columns: List[str], indptr, indices, data):
+        self.rows: List[str] = rows
+        '''proc_id of every row'''
+        self.columns: List[str] = columns
+        '''path of every column'''
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+        self._row_of: Dict[str, int] = {r: i for i, r in enumerate(rows)}
+        self._column_of: Dict[str, int] = {c: i for i, c in enumerate(columns)}
+
+    @property
+    def nnz(self) -> int:
+        return len(self.indices)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.rows), len(self.columns)
+
+    def get(self, proc_id: str, path: str) -> int:
+        i = self._row_of[proc_id]
+        j = self._column_of[path]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        k = lo + int(self.indices[lo:hi].searchsorted(j))
+        return int(self.data[k]) if k < hi and self.indices[k] == j else 0
+
+    def row(self, proc_id: str, access: int = 0) -> Dict[str, int]:
+        '''path -> access bits of one process, only the files with all of the `access` bits'''
+        i = self._row_of[proc_id]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return {self.columns[j]: int(b) for j, b in zip(self.indices[lo:hi], self.data[lo:hi]) if b & access == access}
+
+    def column(self, path: str, access: int = 0) -> Dict[str, int]:
+        '''proc_id -> access bits of one file'''
+        np = _numpy()
+        j = self._column_of[path]
+        res: Dict[str, int] = {}
+        for k in np.flatnonzero(self.indices == j):
+            b = int(self.data[k])
+            if b & access == access:
+                row = int(np.searchsorted(self.indptr, k, side='right')) - 1
+                res[self.rows[row]] = b
+        return res
+
+class DACEvaluator:
+    '''
+    Vectorized DAC (and optionally MAC) access of processes to every file of a filesystem.
+
+    The mode, uid, gid, class and label of all files are kept as numpy columns, so one
+    process is checked against every file with a handful of array operations. MAC results
+    only depend on the subject, so they are computed once per (subject, label, class) and
+    gathered into a per-subject column.
+    '''
+    def __init__(self, files: Dict[str, FilePolicy], pg: PolicyGraph = None):
+        np = _numpy()
+        self.np = np
+        self.pg: Union[PolicyGraph, None] = pg
+
+        self.paths: List[str] = list(files)
+        fos = [files[p] for p in self.paths]
+
+        self.mode = np.fromiter((fo.perms for fo in fos), dtype=np.uint32, count=len(fos))
+        self.uid = np.fromiter((-1 if fo.user is None else fo.user for fo in fos), dtype=np.int64, count=len(fos))
+        self.gid = np.fromiter((-1 if fo.group is None else fo.group for fo in fos), dtype=np.int64, count=len(fos))
+
+        fmt = self.mode & 0o170000 # S_IFMT
+        self.is_dir = fmt == stat.S_IFDIR
+        self.class_id = np.full(len(fos), -1, dtype=np.int16)
+        for i, ifmt in enumerate(FILE_CLASSES):
+            self.class_id[fmt == ifmt] = i
+        # any execute bit set, CAP_DAC_OVERRIDE only grants execute to those
+        self.any_exec = (self.mode & 0o111) != 0
+
+        self.labels: List[str] = []
+        label_of: Dict[str, int] = {}
+        label_id = np.full(len(fos), -1, dtype=np.int32)
+        for i, fo in enumerate(fos):
+            if fo.selinux is None:
+                continue
+            ty = fo.selinux.type
+            if ty not in label_of:
+                label_of[ty] = len(self.labels)
+                self.labels.append(ty)
+            label_id[i] = label_of[ty]
+        self.label_id = label_id
+
+        self._pairs: List[Tuple[int, int]] = sorted(set(zip(label_id.tolist(), self.class_id.tolist())))
+        '''distinct (label, class) pairs, the only MAC lookups a subject needs'''
+
+        self._mac: Dict[str, object] = {}
+
+    def dac(self, cred: Cred, dac_override: bool = False, dac_read_search: bool = False):
+        '''access bits of every file for one set of credentials'''
+        np = self.np
+        uid = -1 if cred.uid is None else cred.uid
+        gid = -1 if cred.gid is None else cred.gid
+        groups = np.fromiter(cred.groups | {gid}, dtype=np.int64)
+
+        owner = self.uid == uid
+        group = ~owner & np.isin(self.gid, groups)
+
+        bits = np.where(owner, (self.mode >> 6) & 7, np.where(group, (self.mode >> 3) & 7, self.mode & 7)).astype(np.uint8)
+
+        if dac_override:
+            # read/write anything, execute anything with an x bit, search any directory
+            bits |= READ | WRITE
+            bits[self.is_dir | self.any_exec] |= EXECUTE
+        elif dac_read_search:
+            bits |= READ
+            bits[self.is_dir] |= EXECUTE
+        return bits
+
+    def mac(self, subject_type: str):
+        '''access bits of every file allowed by the policy to subject_type'''
+        np = self.np
+        res = self._mac.get(subject_type)
+        if res is not None:
+            return res
+
+        table = np.zeros((len(self.labels) + 1, len(CLASS_NAMES) + 1), dtype=np.uint8)
+        for label, cls in self._pairs:
+            if label < 0 or cls < 0:
+                continue
+            table[label, cls] = mac_bits(self.pg, subject_type, self.labels[label], CLASS_NAMES[cls])
+        # index -1 lands on the extra zero row/column: unlabeled files and unknown classes
+        res = self._mac[subject_type] = table[self.label_id, self.class_id]
+        return res
+
+    def process_access(self, process: ProcessNode, mac: bool = True):
+        '''DAC (& MAC) access bits of every file for one process'''
+        mac = mac and self.pg is not None
+        bits = self.dac(process.cred, *dac_capabilities(process, mac))
+        if mac:
+            bits &= self.mac(process.subject.type)
+        return bits
+
+    def matrix(self, processes: Dict[str, ProcessNode], mac: bool = True, running_only: bool = True) -> SparseAccessMatrix:
+        '''the sparse processes x files access matrix'''
+        np = self.np
+        rows: List[str] = []
+        indptr: List[int] = [0]
+        indices: List = []
+        data: List = []
+
+        for proc_id, process in processes.items():
+            if running_only and process.state != ProcessState.RUNNING:
+                continue
+            bits = self.process_access(process, mac)
+            nz = np.flatnonzero(bits)
+            rows.append(proc_id)
+            indices.append(nz.astype(np.int32))
+            data.append(bits[nz])
+            indptr.append(indptr[-1] + len(nz))
+
+        Logger.info("Computed access of %d processes to %d files (%d entries)", len(rows), len(self.paths), indptr[-1])
+        return SparseAccessMatrix(rows, self.paths,
+                                  np.array(indptr, dtype=np.int64),
+                                  np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                                  np.concatenate(data) if data else np.zeros(0, dtype=np.uint8))
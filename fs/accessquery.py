@@ -0,0 +1,172 @@
+import os
+import stat
+from typing import Dict, List, Tuple, Union
+from fs.accessmatrix import EXECUTE, FILE_CLASSES, READ, WRITE, dac_bits, dac_capabilities, mac_bits
+from fs.filesysteminstance import FileSystemInstance
+from fs.filesystempolicy import FilePolicy
+from se.graphnode import ProcessNode, ProcessState
+
+ACCESS_NAMES: Dict[str, int] = {'r': READ, 'w': WRITE, 'x': EXECUTE}
+
+def parse_access(access: Union[int, str]) -> int:
+    '''"rw" -> READ | WRITE, ints are taken as is'''
+    if isinstance(access, int):
+        return access
+    res = 0
+    for c in access:
+        if c not in ACCESS_NAMES:
+            raise ValueError("Unknown access '%s', expected a combination of r, w, x" % c)
+        res |= ACCESS_NAMES[c]
+    return res
+
+def access_str(bits: int) -> str:
+    return "".join(c if bits & b else "-" for c, b in ACCESS_NAMES.items())
+
+class AccessDecision:
+    '''answer of one access query, with the reason when it is denied'''
+    def __init__(self, path: str, needed: int, dac: int, mac: int, denied_at: Union[str, None] = None):
+        self.path: str = path
+        self.needed: int = needed
+        self.dac: int = dac
+        '''access bits DAC grants on the file itself'''
+        self.mac: int = mac
+        '''access bits MAC grants on the file itself'''
+        self.denied_at: Union[str, None] = denied_at
+        '''parent directory that can not be searched, if any'''
+
+    @property
+    def allowed(self) -> bool:
+        return self.denied_at is None and self.dac & self.mac & self.needed == self.needed
+
+    def __bool__(self) -> bool:
+        return self.allowed
+
+    @property
+    def reason(self) -> str:
+        if self.denied_at is not None:
+            return "can not search %s" % self.denied_at
+        missing = self.needed & ~(self.dac & self.mac)
+        if not missing:
+            return "allowed"
+        return "DAC %s, MAC %s, missing %s" % (access_str(self.dac), access_str(self.mac), access_str(missing))
+
+    def __repr__(self):
+        return "<AccessDecision %s %s: %s>" % (self.path, access_str(self.needed), self.reason)
+
+class AccessQuery:
+    '''
+    "Can process X really open /dev/Y for write?"
+
+    Joins the type level allow rules of the PolicyGraph, the file labels and DAC bits of
+    combined_fs and the credentials of the simulated processes. Every directory on the
+    way must be searchable too. The access bits only depend on the process, the file's
+    label and its (uid, gid, mode), so they are memoized on exactly that and a scan over
+    all files only evaluates each distinct combination once.
+    '''
+    def __init__(self, fsi: FileSystemInstance, mac: bool = True, traverse: bool = True):
+        self.fsi: FileSystemInstance = fsi
+        self.mac: bool = mac
+        self.traverse: bool = traverse
+        '''also require search on every parent directory'''
+
+        self._bits: Dict[Tuple[ProcessNode, Union[str, None], int, int, int], Tuple[int, int]] = {}
+        self._search: Dict[Tuple[ProcessNode, str], Union[str, None]] = {}
+        self._mac: Dict[Tuple[str, str, str], int] = {}
+        self._caps: Dict[ProcessNode, Tuple[bool, bool]] = {}
+
+    def clear(self):
+        '''forget all answers, e.g. after the policy or the process creds changed'''
+        self._bits.clear()
+        self._search.clear()
+        self._mac.clear()
+        self._caps.clear()
+
+    def process(self, process: Union[str, ProcessNode]) -> ProcessNode:
+        return self.fsi.processes[process] if isinstance(process, str) else process
+
+    def check(self, process: Union[str, ProcessNode], path: str, access: Union[int, str] = READ) -> AccessDecision:
+        '''whether process can access path, symlinks are followed. Virtual /dev and /sys nodes are looked up too'''
+        process = self.process(process)
+        combined_fs = self.fsi.init.asp.combined_fs
+        path = combined_fs.real_path(path)
+        fo = combined_fs.lookup(path)
+        if fo is None:
+            raise KeyError("File %s not in policy" % path)
+
+        dac, mac = self.file_bits(process, fo)
+        denied_at = self.search_denied(process, os.path.dirname(path)) if self.traverse else None
+        return AccessDecision(path, parse_access(access), dac, mac, denied_at)
+
+    def can(self, process: Union[str, ProcessNode], path: str, access: Union[int, str] = READ) -> bool:
+        return self.check(process, path, access).allowed
+
+    def files_for(self, process: Union[str, ProcessNode], access: Union[int, str] = READ) -> List[str]:
+        '''every file (and concrete virtual /dev, /sys node) the process can access'''
+        process = self.process(process)
+        needed = parse_access(access)
+        res: List[str] = []
+        for path, fo in self.fsi.init.asp.combined_fs.known_files():
+            dac, mac = self.file_bits(process, fo)
+            if dac & mac & needed != needed:
+                continue
+            if self.traverse and self.search_denied(process, os.path.dirname(path)) is not None:
+                continue
+            res.append(path)
+        return res
+
+    def processes_for(self, path: str, access: Union[int, str] = READ, running_only: bool = True) -> List[str]:
+        '''proc_id of every process that can access path'''
+        res: List[str] = []
+        for proc_id, process in self.fsi.processes.items():
+            if running_only and process.state != ProcessState.RUNNING:
+                continue
+            if self.check(process, path, access).allowed:
+                res.append(proc_id)
+        return res
+
+    def file_bits(self, process: ProcessNode, fo: FilePolicy) -> Tuple[int, int]:
+        '''(DAC bits, MAC bits) of one file, memoized per (process, label, uid, gid, mode)'''
+        label = fo.selinux.type if fo.selinux is not None else None
+        key = (process, label, fo.user, fo.group, fo.perms)
+        res = self._bits.get(key)
+        if res is not None:
+            return res
+
+        caps = self._caps.get(process)
+        if caps is None:
+            caps = self._caps[process] = dac_capabilities(process, self.mac)
+        dac = dac_bits(process.cred, fo.user, fo.group, fo.perms, *caps)
+
+        mac = READ | WRITE | EXECUTE
+        if self.mac:
+            teclass = FILE_CLASSES.get(stat.S_IFMT(fo.perms))
+            mac = self.mac_bits(process.subject.type, label, teclass) if label and teclass else 0
+
+        res = self._bits[key] = (dac, mac)
+        return res
+
+    def mac_bits(self, subject_type: str, label: str, teclass: str) -> int:
+        key = (subject_type, label, teclass)
+        res = self._mac.get(key)
+        if res is None:
+            res = self._mac[key] = mac_bits(self.fsi.sepol, subject_type, label, teclass)
+        return res
+
+    def search_denied(self, process: ProcessNode, directory: str) -> Union[str, None]:
+        '''the first directory from / down to `directory` the process can not search, None if all can'''
+        key = (process, directory)
+        if key in self._search:
+            return self._search[key]
+
+        parent = os.path.dirname(directory)
+        res = self.search_denied(process, parent) if parent != directory else None
+        if res is None:
+            fo = self.fsi.init.asp.combined_fs.lookup(directory)
+            # directories we know nothing about do not get in the way
+            if fo is not None:
+                dac, mac = self.file_bits(process, fo)
+                if not dac & mac & EXECUTE:
+                    res = directory
+
+        self._search[key] = res
+        return res
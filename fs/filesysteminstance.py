@@ -1,16 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
 import copy
-from fnmatch import fnmatch
+import multiprocessing
 import os
 import re
 import networkx as nx
-from typing import Dict, List, Set, Tuple, Union
+from typing import Dict, Iterable, List, Set, Tuple, Union
 from android.dac import Cred
 from android.init import AndroidInit, AndroidInitService
 from android.sepolicy import SELinuxContext
+from android.servicecontexts import ServiceContextIndex
+from fs.accessmatrix import DACEvaluator, SparseAccessMatrix
 from fs.filecontext import AndroidFileContext
 from fs.filesystempolicy import FilePolicy
-from se.graphnode import FileNode, GraphNode, IPCNode, ProcessNode, ProcessState, SubjectNode, IGraphNode
-from se.sepolicygraph import Class2, PolicyGraph
+from fs.filetags import FileTagger
+from fs.metrics import MetricsCollector, percent
+from se.graphnode import FileNode, GraphNode, IPCNode, ObjectNodeRegistry, ObjectTemplate, ProcessNode, ProcessState, SubjectNode, IGraphNode
+from se.permissionmap import DataflowTable
+from se.processtree import ProcessTree
+from se.reachability import ReachabilityIndex
+from se.sepolicygraph import Class2, DataflowEdge, FlowDelta, PolicyEdit, PolicyGraph
+from utils import resolve_jobs
 from utils.logger import Logger
 from setools.policyrep import Context, Type
 
@@ -25,6 +34,41 @@ OBJ_COLOR_MAP: Dict[str, str] = {
 
 AllowEdge = Dict[str, Union[str, List[str]]]
 
+def is_service_add(edge: AllowEdge) -> bool:
+    '''allow ... *service_manager { add }, the rules that decide who owns a service type'''
+    return edge["teclass"].endswith("service_manager") and "add" in edge["perms"]
+
+INSTANTIATE_STAGES: List[str] = [
+    'apply_file_contexts',
+    'inflate_subjects',
+    'recover_subject_hierarchy',
+    'inflate_graph',
+    'build_reachability_index',
+    'extract_selinux_capabilities',
+    'assign_trust',
+    'gen_process_tree',
+    'simulate_process_permissions',
+]
+'''instantiate() stages, in dependency order'''
+
+STAGE_DEPENDENCIES: Dict[str, List[str]] = {
+    'apply_file_contexts': ['file_contexts', 'combined_fs'],
+    'inflate_subjects': ['sepolicy'],
+    # entrypoints: labels of the files that back subjects (exec types, last ditch matches)
+    'recover_subject_hierarchy': ['apply_file_contexts', 'inflate_subjects', 'entrypoints'],
+    # service_contexts: service name -> type, joined with the interfaces init services declare
+    'inflate_graph': ['recover_subject_hierarchy', 'service_contexts'],
+    'build_reachability_index': ['inflate_graph'],
+    'extract_selinux_capabilities': ['inflate_subjects'],
+    'assign_trust': ['inflate_graph'],
+    # simulate_process_permissions rewrites the tree it is given, so a new simulation needs a new tree
+    'gen_process_tree': ['recover_subject_hierarchy', 'init_services'],
+    'simulate_process_permissions': ['gen_process_tree', 'init_services'],
+}
+'''stage -> inputs and stages it reads'''
+ObjectFlow = Tuple[str, Union[str, None], Tuple[str, ...], Union[Tuple[str, ...], None], Union[Tuple[str, ...], None]]
+'''(node kind, ipc_type, object types, read perms, write perms) of one allow rule'''
+
 class FileSystemInstance:
     '''巨型类，可以理解为一个实际运行的文件系统的实例'''
     def __init__(self, sepol: PolicyGraph, init: AndroidInit, file_contexts: List[AndroidFileContext]):
@@ -52,6 +96,52 @@ class FileSystemInstance:
         self.processes: Dict[str, ProcessNode] = {}
         '''Fully instantiated graph'''
 
+        self.lazy_process_tree: bool = False
+        '''only materialize processes once a query (or the boot simulation) reaches them'''
+
+        self.process_tree: ProcessTree = None
+        '''the on-demand tree behind self.processes in lazy mode'''
+
+        self.object_registry: ObjectNodeRegistry = ObjectNodeRegistry()
+        '''flyweight factory of object nodes, one node per (kind, ipc_type, type)'''
+
+        self.object_templates: Dict[str, ObjectTemplate] = {}
+        '''teclass -> (node kind, ipc_type)'''
+
+        self.dataflow_table: DataflowTable = None
+        '''(class, perm) -> read/write/manage, built once per policy'''
+        self.dataflow_table_path: str = None
+        '''config of load_dataflow_table, the table is rebuilt from it for a new policy'''
+
+        self.ipc_owners: Dict[str, List[SubjectNode]] = {}
+        '''service_manager type -> candidate owner subjects, best first'''
+
+        self.service_contexts: ServiceContextIndex = None
+        '''when set, the interfaces init services declare name the owners of their service types'''
+
+        self.original_labels: Dict[str, Union[SELinuxContext, None]] = {}
+        '''path -> on-disk label before apply_file_contexts'''
+
+        self.fc_matches: Dict[str, List[AndroidFileContext]] = {}
+        '''path -> file contexts matching it, as of the last labeling'''
+
+        self.dropped_files: Dict[str, FilePolicy] = {}
+        '''files removed from combined_fs because no label could be found'''
+
+        self.file_tagger: FileTagger = FileTagger()
+        '''tags backing files of externally controlled interfaces (usb, modem, ...)'''
+        self.file_tags: Dict[str, Set[str]] = {}
+        '''path -> tags of the backing file, kept off the FilePolicy a snapshot shares with its base'''
+
+        self.inflate_options: Tuple[bool, bool] = (True, True)
+        '''(expand_all_objects, skip_fileless_subjects) of the last inflate_graph'''
+
+        self.metrics: MetricsCollector = MetricsCollector()
+        '''counts recorded by the stages, reported by stats'''
+
+        # keep G_dataflow in sync with what-if edits of the policy
+        self.sepol.add_listener(self)
+
     def instantiate(self) -> bool:
         """
         Recreate a running system's state from a combination of MAC and DAC policies.
@@ -82,6 +172,9 @@ class FileSystemInstance:
         Logger.debug("Inflating subject dataflow graph...")
         self.inflate_graph()
 
+        Logger.debug("Indexing dataflow reachability...")
+        self.build_reachability_index()
+
         Logger.debug("Extracting policy capability bounds to subjects...")
         self.extract_selinux_capabilities()
 
@@ -100,84 +193,316 @@ class FileSystemInstance:
         Logger.info("Finished instantiating SEPolicy")
         return True
 
+    def reinstantiate(self, file_contexts: List[AndroidFileContext] = None, init: AndroidInit = None,
+                      changed: Iterable[str] = (), sepol: PolicyGraph = None) -> bool:
+        """
+        Bring an instantiated system up to date after some of its inputs changed.
+            * file_contexts: new contexts, only the paths they (used to) match are relabeled
+              and patched into file_mapping and the file objects
+            * init: re-parsed init configuration, only the process stages run again
+            * sepol: a new PolicyGraph, for edits made in place pass changed=['sepolicy']
+            * changed: any other input names of STAGE_DEPENDENCIES (e.g. 'sepolicy')
+        Stages that depend on a changed input are reset and run again, in order.
+        """
+        changed: Set[str] = set(changed)
+
+        if sepol is not None and sepol is not self.sepol:
+            changed.add('sepolicy')
+        if init is not None:
+            if init.asp is not self.init.asp:
+                changed.add('combined_fs')
+            changed.add('init_services')
+            if self.service_contexts is not None:
+                changed.add('service_contexts')     # the declared interfaces may have changed too
+
+        if file_contexts is not None:
+            if 'combined_fs' in changed or self.init.asp.combined_fs.kernelfs is not None:
+                # everything is labeled again from scratch on the new filesystem.
+                # virtual kernelfs nodes are not in fc_matches, they are only relabeled this way
+                self.file_contexts = file_contexts
+                changed.add('file_contexts')
+            else:
+                relabeled = self.update_file_contexts(file_contexts)
+                Logger.info("Relabeled %d files", len(relabeled))
+                if self.affects_entrypoints(relabeled):
+                    changed.add('entrypoints')
+
+        # reset against the old inputs, what the stages produced belongs to them
+        stages = self.get_dirty_stages(changed)
+        self.reset_stages(stages, changed)
+
+        if init is not None:
+            self.init = init
+        if sepol is not None and sepol is not self.sepol:
+            self.sepol.remove_listener(self)
+            self.sepol = sepol
+            self.sepol.G_dataflow.clear()
+            self.sepol.add_listener(self)
+
+        if not stages:
+            Logger.info("Nothing to re-instantiate")
+            return True
+
+        Logger.info("Re-running stages: %s", ", ".join(stages))
+        for stage in stages:
+            Logger.debug("Re-running %s...", stage)
+            if getattr(self, stage)() is False:
+                return False
+        return True
+
+    def get_dirty_stages(self, changed: Set[str]) -> List[str]:
+        '''stages (in order) that transitively read any of the changed inputs'''
+        dirty: Set[str] = set(changed)
+        stages: List[str] = []
+        for stage in INSTANTIATE_STAGES:
+            if any(dep in dirty for dep in STAGE_DEPENDENCIES[stage]):
+                dirty.add(stage)
+                stages.append(stage)
+        return stages
+
+    def reset_stages(self, stages: List[str], changed: Set[str] = frozenset()):
+        '''
+        drop whatever the given stages produced, so they can run again. Called before
+        self.init and self.sepol are swapped for new ones
+        '''
+        if 'apply_file_contexts' in stages:
+            # a new combined_fs never saw this labeling, only the old one is restored
+            if 'combined_fs' not in changed:
+                combined_fs = self.init.asp.combined_fs
+                combined_fs.files.update(self.dropped_files)
+                for path, label in self.original_labels.items():
+                    if path in combined_fs.files:
+                        combined_fs.writable(path).selinux = label
+            self.dropped_files = {}
+            self.original_labels = {}
+            self.fc_matches = {}
+            if self.init.asp.combined_fs.kernelfs is not None:
+                self.init.asp.combined_fs.kernelfs.set_labeler(None)
+        if 'sepolicy' in changed:
+            # both classify the rules of the old policy
+            self.dataflow_table = None
+            self.ipc_owners = {}
+        if 'inflate_subjects' in stages:
+            self.subjects = {}
+            self.subject_groups = {}
+            self.domain_attributes = []
+        if 'recover_subject_hierarchy' in stages:
+            self.file_mapping = {}
+            for subject in self.subjects.values():
+                subject.parents = set()
+                subject.children = set()
+                subject.backing_files = {}
+        if 'inflate_graph' in stages:
+            self.sepol.G_dataflow.clear()
+            self.objects = {}
+            self.object_registry = ObjectNodeRegistry()
+        if 'assign_trust' in stages:
+            self.file_tags = {}
+        if 'gen_process_tree' in stages:
+            self.processes = {}
+            self.process_tree = None
+
+    def update_file_contexts(self, file_contexts: List[AndroidFileContext]) -> List[Tuple[str, Union[str, None], Union[str, None]]]:
+        '''
+        Switch to a new set of file contexts and relabel only the paths matched by an
+        added or removed context. file_mapping and the file objects are patched in place.
+        Returns (path, old type, new type) of every file whose type changed (None: dropped).
+        '''
+        fc_key = lambda fc: (fc.regex.pattern, fc.mode, str(fc.context))
+        new_keys = set(map(fc_key, file_contexts))
+        old_keys = set(map(fc_key, self.file_contexts))
+        # by key, not identity: paths left alone by an earlier update still hold the objects of an older list
+        removed = old_keys - new_keys
+        added = [fc for fc in file_contexts if fc_key(fc) not in old_keys]
+        self.file_contexts = file_contexts
+
+        affected: Set[str] = set()
+        if removed:
+            affected |= set(path for path, matches in self.fc_matches.items() if any(fc_key(fc) in removed for fc in matches))
+        for afc in added:
+            affected |= set(filter(afc.match, self.fc_matches))
+
+        combined_fs = self.init.asp.combined_fs
+        files = combined_fs.files
+        relabeled: List[Tuple[str, Union[str, None], Union[str, None]]] = []
+        touched: Dict[str, GraphNode] = {}
+
+        for path in sorted(affected):
+            fcmatches = self.get_file_context_matches(path)
+            self.fc_matches[path] = fcmatches
+            label, _ = self.get_file_label(path, fcmatches)
+
+            fp: FilePolicy = files[path] if path in files else self.dropped_files[path]
+            old_type = self.dealias(fp.selinux.type) if path in files else None
+            if label is None:
+                if path in files:
+                    self.dropped_files[path] = files.pop(path)
+                new_type = None
+            else:
+                if path in self.dropped_files:
+                    files[path] = self.dropped_files.pop(path)
+                # copy first if it is still shared with the policy combined_fs is a snapshot of
+                fp = combined_fs.writable(path)
+                fp.selinux = label
+                new_type = self.dealias(label.type)
+
+            if old_type == new_type:
+                continue
+            relabeled.append((path, old_type, new_type))
+            self.file_tags.pop(path, None)
+
+            if old_type in self.file_mapping:
+                self.file_mapping[old_type].pop(path, None)
+            if new_type is not None and new_type in self.sepol.G_allow:
+                self.file_mapping.setdefault(new_type, {})[path] = fp
+
+            old_obj = self.object_registry.nodes.get(("file", None, old_type))
+            if old_obj is not None:
+                old_obj.backing_files.pop(path, None)
+                touched[old_obj.get_node_name()] = old_obj
+            new_obj = self.object_registry.nodes.get(("file", None, new_type))
+            if new_obj is not None:
+                new_obj.backing_files[path] = fp
+                touched[new_obj.get_node_name()] = new_obj
+
+        for name, obj in touched.items():
+            if name in self.objects:
+                self.assign_object_trust(name, obj)
+
+        self.metrics.record_labeling(self, self.metrics.get("labeling", "recovered_labels", 0), len(self.dropped_files))
+        return relabeled
+
+    def affects_entrypoints(self, relabeled: List[Tuple[str, Union[str, None], Union[str, None]]]) -> bool:
+        '''whether relabeling these files can change which files back which subject'''
+        if not relabeled:
+            return False
+        Gt = self.sepol.G_transition
+        exec_types = set(attrs["through"] for _, _, attrs in Gt.edges(data=True) if attrs["teclass"] == "process")
+        backing = set()
+        for subject in self.subjects.values():
+            backing |= set(subject.backing_files)
+
+        for path, old_type, new_type in relabeled:
+            # files appearing or disappearing can change the last ditch file search
+            if old_type is None or new_type is None:
+                return True
+            if old_type in exec_types or new_type in exec_types or path in backing:
+                return True
+        return False
+
+    def dealias(self, ty: str) -> str:
+        '''dereference alias as those nodes dont exist'''
+        return self.sepol.types[ty] if ty in self.sepol.aliases else ty
+
     def apply_file_contexts(self):
         '''恢复文件系统中的标签'''
         recovered_labels = 0
         dropped_files: List[str] = []
         # 遍历文件系统中的所有文件 file 是一个文件路径
         for file in self.init.asp.combined_fs.files:
-            label_from_file_context: bool = True    # 假设能够从file_context中获取到label
+            fp: FilePolicy = self.init.asp.combined_fs.files[file]
+            # remember the on-disk label, the incremental relabeling starts from it again
+            self.original_labels[file] = fp.selinux
             fcmatches: List[AndroidFileContext] = self.get_file_context_matches(file)
-
-            # XXX 没有匹配的文件context，或者文件是一个挂载点
-            if len(fcmatches) == 0 or file in self.init.asp.combined_fs.mount_points:
-                genfs_matches: List[Tuple[str, str, Context]] = []
-                # 遍历所有的挂载点，验证该文件是否是挂载的文件系统中的文件
-                for mount_path, mp in self.init.asp.combined_fs.mount_points.items():
-                    if file.startswith(mount_path):
-                        relfs : str = file[len(mount_path):]
-                        fstype: str = mp.type
-                        if relfs == "": relfs = "/"
-                        if fstype in self.sepol.genfs:  # 如果是挂载的文件系统，那么就要找到对应的genfscon
-                            for genfscon in self.sepol.genfs[fstype]:
-                                if re.match(r'^' + genfscon.path + r'.*', relfs):
-                                    genfs_matches += [(mount_path, genfscon.path, genfscon.context)]
-                                pass
-                        elif fstype in self.sepol.fs_use:
-                            if fstype != "tmpfs": continue  # 目前只处理tmpfs
-                            genfs_matches += [(mount_path, '/', self.sepol.fs_use[fstype].context)]
-                if len(genfs_matches) == 0:
-                    if self.init.asp.combined_fs.files[file].selinux is None:   # 寄
-                        dropped_files.append(file)
-                        Logger.warn("No file context for %s" % file)
-                        continue    # 下一个文件
-                    else:
-                        primary_match: SELinuxContext = self.init.asp.combined_fs.files[file].selinux
-                    pass
-                else:  # 生成了新的label
-                    genfs_matches = sorted(genfs_matches, reverse=True, key=lambda x: x[1])
-                    primary_path: str = genfs_matches[0][0]
-                    primary_match: SELinuxContext = SELinuxContext.FromString(str(genfs_matches[0][2]))
-                    label_from_file_context = False
-                    pass
-            else:   # 有在file context中匹配
-                ''' 在file_contexts文件中找到了匹配的文件context 找出最长的匹配
-                [AndroidFileContext<^/odm/etc/permissions(/.*)?$ -> u:object_r:odm_xml_file:s0>,
-                AndroidFileContext<^/(odm|vendor/odm)/etc(/.*)?$ -> u:object_r:vendor_configs_file:s0>,
-                AndroidFileContext<^/(odm|vendor/odm)(/.*)?$ -> u:object_r:vendor_file:s0>]
-                '''
-                max_prefix_len: int = 0
-                for afc in fcmatches:
-                    r = re.compile(r"\.|\^|\$|\?|\*|\+|\||\[|\(|\{")    # 一些通配符
-                    regex = afc.regex.pattern[1:len(afc.regex.pattern) - 1] # 去掉开头的^和结尾的$
-                    pos = r.search(regex)   # 找到第一个通配符的位置
-                    cur_prefix_len = pos.span()[0] if pos else len(regex)
-                    if cur_prefix_len >= max_prefix_len:
-                        max_prefix_len = cur_prefix_len
-                        primary_match = afc.context
-
-                pass
-            
-            # 如果原先没有context
-            if self.init.asp.combined_fs.files[file].selinux is None:
-                self.init.asp.combined_fs.files[file].selinux = primary_match
+            self.fc_matches[file] = fcmatches
+
+            label, recovered = self.get_file_label(file, fcmatches)
+            if label is None:   # 寄
+                dropped_files.append(file)
+                Logger.warn("No file context for %s" % file)
+                continue    # 下一个文件
+            if label is not fp.selinux:
+                # do not write through to the policy a booted snapshot shares its files with
+                fp = self.init.asp.combined_fs.writable(file)
+                fp.selinux = label
+            if recovered:
                 recovered_labels += 1
-            elif self.init.asp.combined_fs.files[file].selinux != primary_match:
-                if label_from_file_context: # file_context本身和文件系统的冲突
-                    # Logger.warn("File context %s does not match file system context %s" % (primary_match, self.init.asp.combined_fs.files[file].selinux))
-                    pass
-                else:
-                    recovered_labels += 1
-                    self.init.asp.combined_fs.files[file].selinux = primary_match
 
         for fn in dropped_files:
+            self.dropped_files[fn] = self.init.asp.combined_fs.files[fn]
             del self.init.asp.combined_fs.files[fn]
             pass
         if len(dropped_files) > 0:
             Logger.warn("Dropped %d files with no file context" % len(dropped_files))
             pass
+        # virtual /dev and /sys nodes are labeled when they are looked up
+        kernelfs = self.init.asp.combined_fs.kernelfs
+        if kernelfs is not None:
+            kernelfs.set_labeler(self.kernelfs_label)
         Logger.info("Recovered %d file labels from file contexts" % recovered_labels)
+        self.metrics.record_labeling(self, recovered_labels, len(dropped_files))
+
+    def kernelfs_label(self, path: str) -> Union[SELinuxContext, None]:
+        '''label of a virtual /dev or /sys node, the way a file without an on-disk label is labeled'''
+        label, _ = self.get_file_label(path, self.get_file_context_matches(path))
+        return label
+
+    def get_file_label(self, file: str, fcmatches: List[AndroidFileContext]) -> Tuple[Union[SELinuxContext, None], bool]:
+        '''
+        Decide the label of one file from its file_contexts matches, genfs and on-disk label.
+        Returns (label, recovered), label is None if the file has to be dropped.
+        '''
+        original: Union[SELinuxContext, None] = self.original_labels.get(file)
+        label_from_file_context: bool = True    # 假设能够从file_context中获取到label
+
+        # XXX 没有匹配的文件context，或者文件是一个挂载点
+        if len(fcmatches) == 0 or file in self.init.asp.combined_fs.mount_points:
+            genfs_matches: List[Tuple[str, str, Context]] = []
+            # 遍历所有的挂载点，验证该文件是否是挂载的文件系统中的文件
+            for mount_path, mp in self.init.asp.combined_fs.mount_points.items():
+                if file.startswith(mount_path):
+                    relfs : str = file[len(mount_path):]
+                    fstype: str = mp.type
+                    if relfs == "": relfs = "/"
+                    if fstype in self.sepol.genfs:  # 如果是挂载的文件系统，那么就要找到对应的genfscon
+                        for genfscon in self.sepol.genfs[fstype]:
+                            if re.match(r'^' + genfscon.path + r'.*', relfs):
+                                genfs_matches += [(mount_path, genfscon.path, genfscon.context)]
+                            pass
+                    elif fstype in self.sepol.fs_use:
+                        if fstype != "tmpfs": continue  # 目前只处理tmpfs
+                        genfs_matches += [(mount_path, '/', self.sepol.fs_use[fstype].context)]
+            if len(genfs_matches) == 0:
+                if original is None:   # 寄
+                    return None, False
+                else:
+                    primary_match: SELinuxContext = original
+                pass
+            else:  # 生成了新的label
+                genfs_matches = sorted(genfs_matches, reverse=True, key=lambda x: x[1])
+                primary_path: str = genfs_matches[0][0]
+                primary_match: SELinuxContext = SELinuxContext.FromString(str(genfs_matches[0][2]))
+                label_from_file_context = False
+                pass
+        else:   # 有在file context中匹配
+            ''' 在file_contexts文件中找到了匹配的文件context 找出最长的匹配
+            [AndroidFileContext<^/odm/etc/permissions(/.*)?$ -> u:object_r:odm_xml_file:s0>,
+            AndroidFileContext<^/(odm|vendor/odm)/etc(/.*)?$ -> u:object_r:vendor_configs_file:s0>,
+            AndroidFileContext<^/(odm|vendor/odm)(/.*)?$ -> u:object_r:vendor_file:s0>]
+            '''
+            max_prefix_len: int = 0
+            for afc in fcmatches:
+                r = re.compile(r"\.|\^|\$|\?|\*|\+|\||\[|\(|\{")    # 一些通配符
+                regex = afc.regex.pattern[1:len(afc.regex.pattern) - 1] # 去掉开头的^和结尾的$
+                pos = r.search(regex)   # 找到第一个通配符的位置
+                cur_prefix_len = pos.span()[0] if pos else len(regex)
+                if cur_prefix_len >= max_prefix_len:
+                    max_prefix_len = cur_prefix_len
+                    primary_match = afc.context
+
+            pass
         
+        # 如果原先没有context
+        if original is None:
+            return primary_match, True
+        elif original != primary_match:
+            if label_from_file_context: # file_context本身和文件系统的冲突
+                # Logger.warn("File context %s does not match file system context %s" % (primary_match, original))
+                return original, False
+            else:
+                return primary_match, True
+        return original, False
+
     def get_file_context_matches(self, filename: str) -> List[AndroidFileContext]:
         '''返回所有匹配的文件context，选最长的那个'''
         matches: List[AndroidFileContext] = []
@@ -251,9 +576,11 @@ class FileSystemInstance:
         A different typed file, even with the same path, would be considered a different file.
         """
         G = self.sepol.G_allow
-        # associate relevant types with known files
-        for file in self.init.asp.combined_fs.files:
-            sid = self.init.asp.combined_fs.files[file].selinux
+        # associate relevant types with known files (and the virtual /dev and /sys nodes)
+        for file, fp in self.init.asp.combined_fs.known_files():
+            sid = fp.selinux
+            if sid is None:     # a virtual node no file context covers
+                continue
             # dereference alias as those nodes dont exist
             ty: str = self.sepol.types[sid.type] if sid.type in self.sepol.aliases else sid.type
             if ty not in G:
@@ -261,7 +588,7 @@ class FileSystemInstance:
             if ty not in self.file_mapping:
                 self.file_mapping[ty] = {}  # touch
             # associate a SID (ty) with a file (f) and its (perm)issions
-            self.file_mapping[ty][file] = self.init.asp.combined_fs.files[file]
+            self.file_mapping[ty][file] = fp
 
     def recover_subject_hierarchy(self):
         '''遍历type_transition allow rule, 为每个subject设置find_associated_files'''
@@ -369,108 +696,79 @@ class FileSystemInstance:
 
     def get_object_node(self, edge: AllowEdge) -> GraphNode:
         '''allow rule {'teclass': 'lnk_file', 'perms': ['getattr']}'''
+        return ObjectNodeRegistry.create_node(*self.get_object_template(edge))
+
+    def get_object_template(self, edge: AllowEdge) -> ObjectTemplate:
+        '''(node kind, ipc_type) of the objects an allow rule targets, only depends on the teclass'''
         teclass: str = edge["teclass"]
+        if teclass in self.object_templates:
+            return self.object_templates[teclass]
+
         cls: Class2 = self.sepol.classes[teclass]
-        node = None
+        template = None
         
         if cls.inherits is not None:
             match cls.inherits:
                 case "file":
-                    node = FileNode()
+                    template = ("file", None)
                 case "socket":
-                    node = IPCNode("socket")
+                    template = ("ipc", "socket")
                 case "ipc":
-                    node = IPCNode(teclass)
+                    template = ("ipc", teclass)
                 case "cap" | "cap2":
-                    node = SubjectNode(Cred())
+                    template = ("subject", None)
         else:
             match teclass:
                 case 'drmservice'| 'debuggerd'| 'property_service'| 'service_manager'| 'hwservice_manager'| \
                     'binder'| 'key'| 'msg'| 'system'| 'security'| 'keystore_key'| 'zygote'| 'kernel_service':
-                    node = IPCNode(teclass)
+                    template = ("ipc", teclass)
                 case 'netif'| 'peer'| 'node':
-                    node = IPCNode("socket")
+                    template = ("ipc", "socket")
                 case 'filesystem':
-                    node = FileNode()
+                    template = ("file", None)
                 case "cap_userns"| "cap2_userns"| "capability"| "capability2"| "fd":
-                    node = SubjectNode(Cred())
+                    template = ("subject", None)
                 case 'process':
-                    node = IPCNode("process_op")
+                    template = ("ipc", "process_op")
                 case 'bpf':
-                    node = SubjectNode(Cred())
+                    template = ("subject", None)
 
         
-        if node is None:
+        if template is None:
             raise ValueError("Unhandled object type %s" % teclass)
 
-        return node
+        self.object_templates[teclass] = template
+        return template
 
     def get_dataflow_direction(self, edge: AllowEdge) -> Tuple[bool, bool, bool]:
-        # We consider binder:call and *:ioctl to be bi-directional
-
-        # ignore fd:use for now
-        # we ignore getattr as this is not security sensitive enough
-        # ignore DRMservice for now (pread)
-        read_types = [
-            'read', 'ioctl', 'unix_read', 'search',
-            'recv', 'receive', 'recv_msg',  'recvfrom', 'rawip_recv', 'tcp_recv', 'dccp_recv', 'udp_recv',
-            'nlmsg_read', 'nlmsg_readpriv',
-            # Android specific
-            'call', # binder
-            'list', # service_manager
-            'find', # service_manager
-        ]
-
-        # ignore setattr for now. ignore create types
-        write_types = [
-            'write', 'append',
-            #'ioctl',
-            'add_name', 'unix_write', 'enqueue',
-            'send', 'send_msg',  'sendto', 'rawip_send', 'tcp_send', 'dccp_send', 'udp_send',
-            'connectto',
-            'nlmsg_write',
-            # Android specific
-            'call', # binder
-            #'transfer', # binder
-            'set', # property_service
-            'add', # service_manager
-            'find', # service_manager - this is not necessarily a write type,
-                    #but why bother finding a service if you aren't going to send a message to it?
-            'ptrace',
-            'transition',
-        ]
-
-        # management types
-        manage_types = [
-            'create', 'open'
-        ]
-
-        teclass: str = edge["teclass"]
-        perms: List[str] = edge["perms"]
-
-        has_read: bool = False
-        has_write: bool = False
-        has_manage: bool = False
-
-        for perm in perms:
-            if perm in write_types:
-                has_write = True
-            if perm in read_types:
-                has_read = True
-            if perm in manage_types:
-                has_manage = True
+        '''(read, write, manage), see se.permissionmap for which perms count as which'''
+        return self.dataflow_table.direction(edge)
 
-        return has_read, has_write, has_manage
+    def load_dataflow_table(self, path: str):
+        '''tune which perms count as flows, must be called before inflate_graph'''
+        self.dataflow_table_path = path
+        self.dataflow_table = DataflowTable.from_file(self.sepol, path)
 
-    def inflate_graph(self, expand_all_objects: bool = True, skip_fileless_subjects: bool = True):
+    def inflate_graph(self, expand_all_objects: bool = True, skip_fileless_subjects: bool = True, jobs: int = 1):
         """
         Create all possible subjects and objects from the MAC policy and link
         them in a graph based off of dataflow.
+
+        With jobs != 1 the per-subject flows are computed in a process pool (None or 0
+        for one worker per core) and merged in the same order as the serial path.
         """
         G_allow = self.sepol.G_allow
         Gt = self.sepol.G_transition
 
         G_dataflow = self.sepol.G_dataflow
+        if self.dataflow_table is None:
+            if self.dataflow_table_path is not None:
+                self.dataflow_table = DataflowTable.from_file(self.sepol, self.dataflow_table_path)
+            else:
+                self.dataflow_table = DataflowTable(self.sepol)
+        self.resolve_ipc_owners()
+        self.inflate_options = (expand_all_objects, skip_fileless_subjects)
+
         for s in self.subjects.values():    # add all SubjectNode s
             if skip_fileless_subjects and len(s.backing_files) == 0:
                 continue
@@ -489,98 +787,488 @@ class FileSystemInstance:
                 # add a is-a edge between the subjects as they are effectively the same
                 G_dataflow.add_edge(self.subjects[domain].get_node_name(), s.get_node_name())
         
+        subject_names: List[str] = []
         for subject_name in list(self.subjects.keys()) + list(self.subject_groups.keys()):
             subject: SubjectNode = self.subjects[subject_name] if subject_name in self.subjects else self.subject_groups[subject_name]
             if subject.get_node_name() not in G_dataflow:
                 Logger.info("Skipping subject %s as it has no backing files", subject_name)
                 continue
-            for obj_name in G_allow[subject_name]:
-                for edge in G_allow[subject_name][obj_name].values():
-                    ###### Create object
-                    obj: GraphNode = self.get_object_node(edge)
-                    df_r, df_w, df_m = self.get_dataflow_direction(edge)
-                    obj_type = obj.get_obj_type()
-                    
-                    # mostly ignore subject nodes as the target for other subjects
-                    if obj_type == "subject":
-                        match edge["teclass"]:
-                            case "fd" | "process" | "bpf" | "capability" | "capability2" | "cap_userns" | "cap2_userns":
-                                continue
-                            case _:
-                                raise ValueError("Ignoring MAC edge <%s> -[%s]-> <%s>" % (subject_name, edge["teclass"], obj_name))
-                    domain_name: str = subject.get_node_name()
-
-                    object_expansion: List[str] = self.expand_attribute(obj_name) if expand_all_objects else [obj_name]
-                    
-                    for ty in object_expansion:
-                        new_obj: IGraphNode = copy.deepcopy(obj)
-                        new_obj.sid = SELinuxContext.FromString("u:object_t:%s:s0" % ty)
-                        obj_type = new_obj.get_obj_type()
-                        if obj_type == "ipc":
-                            if ty in self.subjects:
-                                new_obj: IPCNode
-                                new_obj.owner = self.subjects[ty]
-                            else:
-                                if new_obj.ipc_type.endswith("service_manager"):
-                                    found_ipc_owner = False
-                                    for source, target in G_allow.in_edges(self.actualize(new_obj.sid.type)):
-                                        obj_edge: AllowEdge
-                                        for obj_edge in G_allow[source][target].values():
-                                            # find any that have the add permission
-                                            if "add" in obj_edge["perms"]:
-                                                # expand - hal_graphics_allocator_server 9.0
-                                                # XXX: just take the first owner we see...
-                                                source_type = self.expand_attribute(source)[0]
-
-                                                new_obj.owner = self.subjects[source_type]
-
-                                                found_ipc_owner = True
-                                                break
-                                        if found_ipc_owner:
-                                            break
-                                        pass
-                                elif new_obj.ipc_type == "property_service":
-                                    new_obj.owner = self.subjects["init"]
-                            # seriously, there is no point in adding this if there is no owner
-                            # we'd be yelling to no one
-                            if not new_obj.owner:
-                                continue
-
-                            if len(new_obj.owner.backing_files) == 0 and skip_fileless_subjects:
-                                assert isinstance(new_obj.owner, SubjectNode)
-                                continue
-
-                            assert new_obj.owner.sid is not None
-                        if not df_r and not df_w:   # no read or write, skip
+            subject_names.append(subject_name)
+
+        jobs = min(resolve_jobs(jobs), len(subject_names))
+        if jobs <= 1:
+            for subject_name in subject_names:
+                self.merge_subject_flows(subject_name, self.get_subject_flows(subject_name, expand_all_objects), skip_fileless_subjects)
+        else:
+            Logger.debug("Inflating %d subjects with %d workers", len(subject_names), jobs)
+            # fork lets the workers inherit the policy instead of pickling it per task
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_init_inflate_worker, initargs=(self, expand_all_objects)) as pool:
+                batches = pool.map(_inflate_worker, subject_names, chunksize=max(1, len(subject_names) // (jobs * 4)))
+                # merge in the serial order so the graph comes out exactly the same
+                for subject_name, flows in zip(subject_names, batches):
+                    self.merge_subject_flows(subject_name, flows, skip_fileless_subjects)
+
+        self.metrics.record_dataflow(self)
+
+    def get_subject_flows(self, subject_name: str, expand_all_objects: bool = True) -> List[ObjectFlow]:
+        '''
+        Compute the dataflow of one subject (type or attribute) from its allow rules.
+        Only reads the policy, so it is safe to run in a worker process.
+        '''
+        G_allow = self.sepol.G_allow
+        flows: List[ObjectFlow] = []
+
+        for obj_name in G_allow[subject_name]:
+            for edge in G_allow[subject_name][obj_name].values():
+                ###### Create object
+                obj_type, ipc_type = self.get_object_template(edge)
+                df_r, df_w, df_m = self.get_dataflow_direction(edge)
+                
+                # mostly ignore subject nodes as the target for other subjects
+                if obj_type == "subject":
+                    match edge["teclass"]:
+                        case "fd" | "process" | "bpf" | "capability" | "capability2" | "cap_userns" | "cap2_userns":
                             continue
-                        if obj_type == "file":
-                            if ty in self.file_mapping:
-                                new_obj.associate_file(self.file_mapping[ty])
-                        obj_node_name = new_obj.get_node_name()
-
-                        # objects may be seen more than once, hence they need unique names
-                        self.objects[obj_node_name] = new_obj
-
-                        # create object
-                        G_dataflow.add_node(obj_node_name, obj=new_obj, fillcolor=OBJ_COLOR_MAP[obj_type])
-
-                        # We assume there is no way for subjects to talk directly (except shared memory)
-                        # data flow: object -> subject (read)
-                        if df_r and domain_name not in G_dataflow[obj_node_name]:
-                            G_dataflow.add_edge(obj_node_name, domain_name, ty="read", color='red')
-
-                        # data flow: subject -> object (write)
-                        if df_w or df_m:
-                            if obj_node_name in G_dataflow[domain_name]:
-                                # {'ty': 'write', 'color': 'green'}
-                                edge_types = list(map(lambda x: x['ty'], G_dataflow[domain_name][obj_node_name].values()))
-                            else:
-                                edge_types = []
-
-                            if df_w and 'write' not in edge_types:
-                                G_dataflow.add_edge(domain_name, obj_node_name, ty="write", color='green')
-        return
+                        case _:
+                            raise ValueError("Ignoring MAC edge <%s> -[%s]-> <%s>" % (subject_name, edge["teclass"], obj_name))
+                if not df_r and not df_w:   # no read or write, skip
+                    continue
+
+                object_expansion: List[str] = self.expand_attribute(obj_name) if expand_all_objects else [obj_name]
+                read_perms = tuple(self.dataflow_table.flow_perms(edge["teclass"], edge["perms"], "read")) if df_r else None
+                write_perms = tuple(self.dataflow_table.flow_perms(edge["teclass"], edge["perms"], "write")) if df_w else None
+                flows.append((obj_type, ipc_type, tuple(object_expansion), read_perms, write_perms))
+
+        return flows
+
+    def merge_subject_flows(self, subject_name: str, flows: List[ObjectFlow], skip_fileless_subjects: bool = True):
+        '''Instantiate the objects of one subject's flows and link them in G_dataflow'''
+        G_dataflow = self.sepol.G_dataflow
+        subject: SubjectNode = self.subjects[subject_name] if subject_name in self.subjects else self.subject_groups[subject_name]
+        domain_name: str = subject.get_node_name()
+
+        for obj_type, ipc_type, object_expansion, read_perms, write_perms in flows:
+            for ty in object_expansion:
+                new_obj, created = self.object_registry.get(obj_type, ipc_type, ty)
+                if created:
+                    # the owner and backing files only depend on the type, resolve them once
+                    self.init_object_node(new_obj, ty)
+                if obj_type == "ipc":
+                    new_obj: IPCNode
+                    # seriously, there is no point in adding this if there is no owner
+                    # we'd be yelling to no one
+                    if not new_obj.owner:
+                        continue
+
+                    if len(new_obj.owner.backing_files) == 0 and skip_fileless_subjects:
+                        assert isinstance(new_obj.owner, SubjectNode)
+                        continue
+
+                    assert new_obj.owner.sid is not None
+                obj_node_name = new_obj.get_node_name()
+
+                # objects may be seen more than once, hence they need unique names
+                self.objects[obj_node_name] = new_obj
+
+                # create object
+                G_dataflow.add_node(obj_node_name, obj=new_obj, fillcolor=OBJ_COLOR_MAP[obj_type])
+
+                # We assume there is no way for subjects to talk directly (except shared memory)
+                # data flow: object -> subject (read)
+                if read_perms is not None:
+                    self.add_dataflow_edge(obj_node_name, domain_name, "read", read_perms)
+
+                # data flow: subject -> object (write)
+                if write_perms is not None:
+                    self.add_dataflow_edge(domain_name, obj_node_name, "write", write_perms)
+
+    def init_object_node(self, obj: GraphNode, ty: str):
+        '''set up a freshly created object node of type `ty`'''
+        obj_type = obj.get_obj_type()
+
+        if obj_type == "ipc":
+            obj: IPCNode
+            if ty in self.subjects:
+                obj.owner = self.subjects[ty]
+            elif obj.ipc_type.endswith("service_manager"):
+                owners = self.ipc_owners.get(ty)
+                if owners:
+                    obj.owner = owners[0]
+            elif obj.ipc_type == "property_service":
+                obj.owner = self.subjects["init"]
+        elif obj_type == "file":
+            if ty in self.file_mapping:
+                obj.associate_file(self.file_mapping[ty])
+
+    def resolve_ipc_owners(self, types: Iterable[str] = None) -> Dict[str, List[SubjectNode]]:
+        '''
+        Index the owners of every service_manager style type from all `add` rules at once.
+        A type may be added by several domains, candidates are ordered so the pick is stable:
+        domains whose init service declares the interface first, then domains with backing
+        files, then domains named by the rule itself rather than through an attribute, then by name.
+        With types, only those are resolved again from the `add` rules reaching them.
+        '''
+        G_allow = self.sepol.G_allow
+        candidates: Dict[str, Dict[str, bool]] = {}   # type -> {domain: named directly}
+        declared = self.declared_service_owners()
+
+        def add_candidates(found: Dict[str, bool], source: str):
+            direct = not self.is_attribute(source)
+            # expand - hal_graphics_allocator_server 9.0
+            for d in self.expand_attribute(source):
+                if d in self.subjects:
+                    found[d] = found.get(d, False) or direct
+
+        if types is None:
+            for source, target, edge in G_allow.edges(data=True):
+                edge: AllowEdge
+                if is_service_add(edge):
+                    for ty in self.expand_attribute(target):
+                        add_candidates(candidates.setdefault(ty, {}), source)
+            self.ipc_owners = {}
+        else:
+            for ty in set(types):
+                found = candidates[ty] = {}
+                self.ipc_owners.pop(ty, None)
+                if ty not in self.sepol.types:
+                    continue
+                for name in self.actualize(ty):
+                    if name not in G_allow:
+                        continue
+                    for source, _, edge in G_allow.in_edges(name, data=True):
+                        if is_service_add(edge):
+                            add_candidates(found, source)
+
+        # a declared owner the policy has no add rule for still is the owner (e.g. a default type)
+        for ty, domains in declared.items():
+            if types is not None and ty not in candidates:
+                continue
+            found = candidates.setdefault(ty, {})
+            for d in domains:
+                found.setdefault(d, False)
+
+        for ty, found in candidates.items():
+            if not found and types is not None:
+                continue
+            owners = declared.get(ty, ())
+            ranked = sorted(found.items(), key=lambda x: (x[0] not in owners, len(self.subjects[x[0]].backing_files) == 0, not x[1], x[0]))
+            self.ipc_owners[ty] = [self.subjects[d] for d, _ in ranked]
+
+        if types is None:
+            self.metrics.set("ipc", "declared_owner_types", len(declared))
+            Logger.info("Resolved owners for %d service_manager types (%d declared by init services)", len(self.ipc_owners), len(declared))
+        return self.ipc_owners
+
+    def declared_service_owners(self) -> Dict[str, Set[str]]:
+        '''
+        service type -> domains of the init services declaring an interface of that type
+        (`interface` options joined with service_contexts). A service runs in its seclabel,
+        or in the subject its executable backs.
+        '''
+        declared: Dict[str, Set[str]] = {}
+        if self.service_contexts is None:
+            return declared
+
+        combined_fs = self.init.asp.combined_fs
+        exe_domains: Dict[str, str] = {}
+        for name, subject in self.subjects.items():
+            for path in subject.backing_files:
+                exe_domains.setdefault(path, name)
+
+        for service in self.init.services.values():
+            interfaces = self.service_contexts.interface_types(service.options)
+            if not interfaces:
+                continue
+            if service.cred.sid is not None:
+                domain = service.cred.sid.type
+            else:
+                domain = exe_domains.get(combined_fs.real_path(service.args[0]))
+            if domain not in self.subjects:
+                Logger.debug("No subject for service %s declaring %s", service.name, interfaces)
+                continue
+            for _, ty in interfaces:
+                declared.setdefault(ty, set()).add(domain)
+        return declared
+
+    def add_dataflow_edge(self, u: str, v: str, ty: str, flow_perms: Iterable[str]):
+        '''
+        Add a read/write edge to G_dataflow, or fold the perms into the existing one.
+        Each edge keeps the perms that produced it and the weight of the strongest one.
+        '''
+        G_dataflow = self.sepol.G_dataflow
+        weight = self.dataflow_table.flow_weight(flow_perms)
+
+        if v in G_dataflow[u]:
+            for attrs in G_dataflow[u][v].values():
+                # {'ty': 'write', 'color': 'green', 'perms': {...}, 'weight': 10}
+                if attrs.get("ty") == ty:
+                    attrs["perms"] |= set(flow_perms)
+                    attrs["weight"] = max(attrs["weight"], weight)
+                    return
+
+        G_dataflow.add_edge(u, v, ty=ty, color='red' if ty == "read" else 'green',
+                            perms=set(flow_perms), weight=weight)
     
+    def build_reachability_index(self) -> ReachabilityIndex:
+        '''index the transitive closure of G_dataflow, policy edits keep it up to date'''
+        self.sepol.reachability = ReachabilityIndex(self.sepol.G_dataflow)
+        Logger.info("Indexed reachability of %d dataflow nodes", len(self.sepol.reachability))
+        return self.sepol.reachability
+
+    ##### What-if policy edits
+
+    def on_policy_edit(self, edit: PolicyEdit) -> FlowDelta:
+        """
+        Patch G_dataflow (and its reachability index) after an edit of the policy.
+        Only the subjects whose flows can change are inflated again, then their old and
+        new edges are diffed. Not patched: new subjects (a type joining `domain`), subject
+        groups becoming effective, capabilities and the process tree. Use
+        reinstantiate(changed=['sepolicy']) for those.
+        """
+        if self.dataflow_table is None:
+            # not inflated yet, nothing derived from the policy to patch
+            return FlowDelta()
+
+        delta = FlowDelta()
+        affected: Set[str] = set()
+        owner_types: Set[str] = set()   # service_manager types whose owner may change
+
+        match edit.kind:
+            case "allow":
+                source: str = edit["source"]
+                if source in self.subjects or source in self.subject_groups:
+                    affected.add(source)
+                if is_service_add(edit):
+                    owner_types |= set(self.expand_attribute(edit["target"]))
+            case "typeattribute":
+                ty: str = edit["type"]
+                attr: str = edit["attribute"]
+                # every rule naming attr now reaches one more (or one less) type
+                affected |= self.subjects_referencing([attr])
+                owner_types |= self.owner_types_of_attribute(ty, attr)
+                if attr in self.subject_groups and ty in self.subjects:
+                    delta.merge(self.update_is_a_edge(ty, attr, edit.added))
+            case "type_transition":
+                if edit["teclass"] == "process":
+                    flipped = self.update_domain_transition(edit)
+                    if flipped is not None:
+                        delta.merge(flipped)
+                        # ipc objects owned by the child are (no longer) skipped
+                        affected |= self.subjects_referencing([edit["default"]])
+                        # the child gained or lost its backing files, which ranks the owners
+                        child = self.subjects.get(edit["default"])
+                        owner_types |= {t for t, owners in self.ipc_owners.items() if child in owners}
+
+        affected |= self.update_ipc_owners(owner_types)
+
+        for subject_name in sorted(affected):
+            delta.merge(self.reinflate_subject(subject_name))
+
+        Logger.info("Policy edit %s: %d flows added, %d removed", edit, len(delta.added), len(delta.removed))
+        return delta
+
+    def subjects_referencing(self, names: Iterable[str]) -> Set[str]:
+        '''subjects and subject groups with an allow rule on one of names (or on their attributes)'''
+        G_allow = self.sepol.G_allow
+        res: Set[str] = set()
+        for name in names:
+            targets = [name] if self.is_attribute(name) else self.actualize(name)
+            for target in targets:
+                if target not in G_allow:
+                    continue
+                for source in G_allow.predecessors(target):
+                    if source in self.subjects or source in self.subject_groups:
+                        res.add(source)
+        return res
+
+    def owner_types_of_attribute(self, ty: str, attr: str) -> Set[str]:
+        '''service_manager types whose owner candidates change when ty joins or leaves attr'''
+        G_allow = self.sepol.G_allow
+        res: Set[str] = set()
+        if attr not in G_allow:
+            return res
+        # attr adds services: ty is (no longer) a candidate for their types
+        for _, target, edge in G_allow.out_edges(attr, data=True):
+            if is_service_add(edge):
+                res |= set(self.expand_attribute(target))
+        # services of attr are added by someone: ty's own candidates change
+        if any(is_service_add(edge) for _, _, edge in G_allow.in_edges(attr, data=True)):
+            res.add(ty)
+        return res
+
+    def update_ipc_owners(self, types: Iterable[str]) -> Set[str]:
+        '''re-resolve the owners of some service_manager types, fix their ipc nodes and return the subjects that see them'''
+        types = set(types)
+        if not types:
+            return set()
+        old = {ty: self.ipc_owners[ty][0] for ty in types if self.ipc_owners.get(ty)}
+        self.resolve_ipc_owners(types)
+        new = {ty: self.ipc_owners[ty][0] for ty in types if self.ipc_owners.get(ty)}
+        changed = {ty for ty in types if old.get(ty) is not new.get(ty)}
+        if not changed:
+            return set()
+
+        ipc_types = [teclass for teclass in self.sepol.classes if teclass.endswith("service_manager")]
+        for ty in changed:
+            for ipc_type in ipc_types:
+                node = self.object_registry.nodes.get(("ipc", ipc_type, ty))
+                if node is not None:
+                    node: IPCNode
+                    node.owner = new.get(ty)
+        return self.subjects_referencing(changed)
+
+    def update_is_a_edge(self, ty: str, attr: str, added: bool) -> FlowDelta:
+        G_dataflow = self.sepol.G_dataflow
+        u = self.subjects[ty].get_node_name()
+        v = self.subject_groups[attr].get_node_name()
+        if u not in G_dataflow or v not in G_dataflow:
+            return FlowDelta()
+
+        if added:
+            if G_dataflow.has_edge(u, v):
+                return FlowDelta()
+            G_dataflow.add_edge(u, v)
+            delta = FlowDelta(added=[(u, v, "is-a")])
+        else:
+            keys = [k for k, e in G_dataflow[u][v].items() if "ty" not in e] if G_dataflow.has_edge(u, v) else []
+            if not keys:
+                return FlowDelta()
+            for key in keys:
+                G_dataflow.remove_edge(u, v, key)
+            delta = FlowDelta(removed=[(u, v, "is-a")])
+
+        self.sync_dataflow(delta)
+        return delta
+
+    def update_domain_transition(self, edit: PolicyEdit) -> Union[FlowDelta, None]:
+        """
+        Patch the subject hierarchy after a process type_transition edit.
+        Returns the delta if the child gained its first or lost its last backing file
+        (it enters or leaves G_dataflow), None otherwise.
+        """
+        parent: str = edit["source"]
+        child: str = edit["default"]
+        through: str = edit["through"]
+        if parent not in self.subjects or child not in self.subjects or through not in self.file_mapping:
+            return None
+
+        p = self.subjects[parent]
+        c = self.subjects[child]
+        was_backed = len(c.backing_files) > 0
+
+        if edit.added:
+            p.children.add(c)
+            c.parents.add(p)
+            c.associate_file(self.file_mapping[through])
+        else:
+            # keep the files another transition still maps to the child
+            still_mapped: Set[str] = set()
+            still_linked = False
+            for source, _, attrs in self.sepol.G_transition.in_edges(child, data=True):
+                if attrs["teclass"] != "process" or attrs["through"] not in self.file_mapping:
+                    continue
+                still_mapped |= set(self.file_mapping[attrs["through"]])
+                still_linked |= source == parent
+            for fn in self.file_mapping[through]:
+                if fn not in still_mapped:
+                    c.backing_files.pop(fn, None)
+            if not still_linked and not self.allows_transition(parent, child):
+                p.children.discard(c)
+                c.parents.discard(p)
+
+        _, skip_fileless_subjects = self.inflate_options
+        is_backed = len(c.backing_files) > 0
+        if not skip_fileless_subjects or was_backed == is_backed:
+            return None
+
+        G_dataflow = self.sepol.G_dataflow
+        node_name = c.get_node_name()
+        groups = [self.subject_groups[a].get_node_name() for a in self.sepol.types[child] if a in self.subject_groups]
+        if is_backed:
+            G_dataflow.add_node(node_name, obj=c, fillcolor=OBJ_COLOR_MAP['subject'])
+            for group in groups:
+                G_dataflow.add_edge(node_name, group)
+            delta = FlowDelta(added=[(node_name, group, "is-a") for group in groups])
+            delta.merge(self.reinflate_subject(child))
+        else:
+            delta = FlowDelta(removed=self.subject_flow_edges(node_name))
+            delta.removed |= {(node_name, group, "is-a") for group in groups if G_dataflow.has_edge(node_name, group)}
+            G_dataflow.remove_node(node_name)
+            self.sync_dataflow(delta)
+            if self.sepol.reachability is not None:
+                self.sepol.reachability.remove_node(node_name)
+            return delta
+
+        self.sync_dataflow(FlowDelta(added=[(node_name, group, "is-a") for group in groups]))
+        return delta
+
+    def allows_transition(self, parent: str, child: str) -> bool:
+        '''allow parent child:process { transition dyntransition }, through any attribute of child'''
+        G_allow = self.sepol.G_allow
+        for target in self.actualize(child):
+            for edge in G_allow.get_edge_data(parent, target, default={}).values():
+                if edge["teclass"] == "process" and ("dyntransition" in edge["perms"] or "transition" in edge["perms"]):
+                    return True
+        return False
+
+    def subject_flow_edges(self, domain_name: str) -> Set[DataflowEdge]:
+        '''the read edges into and write edges out of a subject node'''
+        G_dataflow = self.sepol.G_dataflow
+        res: Set[DataflowEdge] = set()
+        for u, v, ty in G_dataflow.in_edges(domain_name, data="ty"):
+            if ty == "read":
+                res.add((u, v, ty))
+        for u, v, ty in G_dataflow.out_edges(domain_name, data="ty"):
+            if ty == "write":
+                res.add((u, v, ty))
+        return res
+
+    def reinflate_subject(self, subject_name: str) -> FlowDelta:
+        '''drop the dataflow edges of one subject, derive them again from the policy and diff'''
+        G_dataflow = self.sepol.G_dataflow
+        expand_all_objects, skip_fileless_subjects = self.inflate_options
+        subject: SubjectNode = self.subjects[subject_name] if subject_name in self.subjects else self.subject_groups[subject_name]
+        domain_name: str = subject.get_node_name()
+        if domain_name not in G_dataflow:
+            return FlowDelta()
+
+        old = self.subject_flow_edges(domain_name)
+        for u, v, ty in old:
+            for key in [k for k, e in G_dataflow[u][v].items() if e.get("ty") == ty]:
+                G_dataflow.remove_edge(u, v, key)
+
+        known_objects = set(self.objects)
+        self.merge_subject_flows(subject_name, self.get_subject_flows(subject_name, expand_all_objects), skip_fileless_subjects)
+        for name in self.objects.keys() - known_objects:
+            self.assign_object_trust(name, self.objects[name])
+
+        new = self.subject_flow_edges(domain_name)
+        delta = FlowDelta(new - old, old - new)
+        self.sync_dataflow(delta)
+        return delta
+
+    def sync_dataflow(self, delta: FlowDelta):
+        '''drop objects left without edges and bring the reachability index up to date'''
+        G_dataflow = self.sepol.G_dataflow
+        reachability = self.sepol.reachability
+
+        orphans: Set[str] = set()
+        for u, v, _ in delta.removed:
+            if reachability is not None:
+                reachability.remove_edge(u, v)
+            orphans |= {n for n in (u, v) if n in self.objects and n in G_dataflow and G_dataflow.degree(n) == 0}
+        for name in orphans:
+            # the registry keeps the node, it is reused if a later edit needs it again
+            G_dataflow.remove_node(name)
+            del self.objects[name]
+            if reachability is not None:
+                reachability.remove_node(name)
+
+        if reachability is not None:
+            for u, v, _ in delta.added:
+                reachability.add_edge(u, v)
+
     def actualize(self, ty: str):
         """
         Transforms a type into itself and all its attributes
@@ -621,44 +1309,28 @@ class FileSystemInstance:
                 Logger.debug("Subject %s is trusted (reason: %s)", name, reason)
 
         for name, obj in self.objects.items():
-            trusted = False
-            reason = ""
-
-            for fn in obj.backing_files:
-                for magic in ['/sys/', '/dev/']:
-                    if fn.startswith(magic):
-                        trusted = True
-                        reason = "backing file %s starts with %s" % (fn, magic)
-                        break
-            
+            self.assign_object_trust(name, obj)
+
+    def assign_object_trust(self, name: str, obj: GraphNode):
+        trusted = False
+        reason = ""
+
+        for fn in obj.backing_files:
+            prefix = self.file_tagger.trusted_prefix(fn)
+            if prefix is not None and not trusted:
+                trusted = True
+                reason = "backing file %s starts with %s" % (fn, prefix)
+
             # revoke trust from some externally controlled sources
-            for fn, fo in obj.backing_files.items():
-                if not hasattr(fo, "tags"):
-                    fo.tags = set()
-                if fn.startswith('/dev/'):
-                    for pattern in ["*usb*", "*GS*", "*serial*"]:
-                        if fnmatch(fn, pattern) or fnmatch(obj.sid.type, pattern):
-                            fo.tags |= set(['usb'])
-                            break
-
-                    for pattern in ["*bt_*", "*bluetooth*", "*hci*"]:
-                        if fnmatch(fn, pattern) or fnmatch(obj.sid.type, pattern):
-                            fo.tags |= set(['bluetooth'])
-                            break
-
-                    for pattern in ["*nfc*"]:
-                        if fnmatch(fn, pattern) or fnmatch(obj.sid.type, pattern):
-                            fo.tags |= set(['nfc'])
-                            break
-
-                    for pattern in ["*at_*", "*atd*", "*modem*", "*mdm*", "*smd*"]:
-                        if fnmatch(fn, pattern) or fnmatch(obj.sid.type, pattern):
-                            fo.tags |= set(['modem'])
-                            break
-            
-            if trusted:
-                obj.trusted = True
-                Logger.debug("Object %s is trusted (reason: %s)", name, reason)
+            self.file_tags.setdefault(fn, set()).update(self.file_tagger.tag(fn, obj.sid.type))
+
+        obj.trusted = trusted
+        if trusted:
+            Logger.debug("Object %s is trusted (reason: %s)", name, reason)
+
+    def load_file_tags(self, path: str):
+        '''add vendor specific tag rules, must be called before assign_trust'''
+        self.file_tagger = FileTagger.from_file(path)
 
     def gen_process_tree(self):
         """
@@ -666,11 +1338,21 @@ class FileSystemInstance:
         This means expand out one of every backing file for a subject into a potential running
         process. Whether or not the process is actually running will be decided during boot
         simulation.
+
+        With lazy_process_tree set, only kernel_0 and the init processes are created here,
+        see se.processtree.ProcessTree for the rest.
         """
         # Start from the top of hierarchy
         kernel_subject = self.subjects["kernel"]
         init_subject = self.subjects["init"]
+
+        if self.lazy_process_tree:
+            self.process_tree = ProcessTree(self.init.asp.combined_fs.real_path, self.processes)
+            self.process_tree.root(kernel_subject, init_subject)
+            return
+
         visited: Set[SubjectNode] = set()
+        children_of: Dict[SubjectNode, List[SubjectNode]] = {}
 
         # Technically the kernel can have a ton of processes, but we only consider one in our graph
         self.processes["kernel_0"] = ProcessNode(kernel_subject, None, {'/kernel' : {}}, 0)
@@ -697,10 +1379,35 @@ class FileSystemInstance:
 
                 pid += 1
 
-                for child in sorted(child_subject.children, key=lambda x: str(x.type)):
+                if child_subject not in children_of:
+                    children_of[child_subject] = sorted(child_subject.children, key=lambda x: str(x.type))
+                for child in children_of[child_subject]:
                     if child not in visited or (child.type == "crash_dump" and child_subject.type in ["zygote"]):
                         stack += [(new_process, child)]
 
+    def access_matrix(self, mac: bool = True, running_only: bool = True) -> SparseAccessMatrix:
+        '''which (running) process can read, write or execute which file, under DAC and MAC'''
+        evaluator = DACEvaluator(self.init.asp.combined_fs.files, self.sepol if mac else None)
+        return evaluator.matrix(self.processes, mac, running_only)
+
+    def index_init_services(self) -> Dict[str, AndroidInitService]:
+        '''
+        resolved executable path -> the init service that starts it. Each service path is
+        resolved once; oneshot services and executables missing from the image are left out,
+        a service the boot simulation started wins, then the first in definition order.
+        '''
+        combined_fs = self.init.asp.combined_fs
+        index: Dict[str, AndroidInitService] = {}
+        for service in self.init.services.values(): # 遍历所有的init service
+            if service.oneshot:
+                continue
+            cmd = combined_fs.real_path(service.args[0])
+            if cmd not in combined_fs.files:
+                continue
+            if cmd not in index or (service.started and not index[cmd].started):
+                index[cmd] = service
+        return index
+
     def simulate_process_permissions(self):
         # Special cases for android
         kernel = self.processes["kernel_0"]
@@ -727,25 +1434,33 @@ class FileSystemInstance:
         init.state = ProcessState.RUNNING
 
         system_server_parent = None
+        services_by_exe = self.index_init_services()
+        # once the boot simulation reached class main, only the services it started (start, class_start, enable, ...) run.
+        # before that (no boot, or an FDE scenario stuck before the framework) every service is assumed to run
+        booted = "main" in self.init.started_classes
 
         for init_child in sorted(init.children, key=lambda x: x.pid):   # for each init child process
             init_child.cred = init.cred.execve(init_child.subject.sid)
             init_child.cred.clear_groups()  # Drop any supplemental groups from init
             
-            found_service = None
             # (a,_),*_={1:1, 2:2, 3:3}.items()
             (exe_path, _), = init_child.exe.items()   # only one element ? otherwise raise exception 
-            for service in self.init.services.values(): # 遍历所有的init service
-                cmd = self.init.asp.combined_fs.real_path(service.args[0])
-                if cmd not in self.init.asp.combined_fs.files:
-                    continue
-                if cmd == exe_path and not service.oneshot:
-                    if found_service:
-                        continue
-                    found_service = service
+            found_service = services_by_exe.get(exe_path)
             if not found_service:
                 Logger.warn("Not find service definition for %s", init_child)
                 continue
+
+            # Zygote special case handling
+            if "app_process" in found_service.args[0] and "--start-system-server" in found_service.args:
+                if system_server_parent is not None:
+                    Logger.error("Found multiple system_server parents!")
+                else:
+                    system_server_parent = init_child
+                    Logger.info("Primary system_server parent: %s", init_child)
+
+            if booted and not found_service.started:
+                Logger.debug("Service %s of %s was not started during boot", found_service.name, init_child)
+                continue
             init_child.state = ProcessState.RUNNING
             service: AndroidInitService = found_service
             Logger.debug("Got service definition for %s: %s", init_child, service)
@@ -766,33 +1481,27 @@ class FileSystemInstance:
                 init_child.cred.cap.bounding = copy.deepcopy(service.cred.cap.ambient)
                 init_child.cred.cap.inherited = copy.deepcopy(service.cred.cap.ambient)
                 init_child.cred.cap.ambient = copy.deepcopy(service.cred.cap.ambient)
-            args = service.args
-
-            # Zygote special case handling
-            if "app_process" in args[0]:
-                if "--start-system-server" in args:
-                    if system_server_parent is not None:
-                        Logger.error("Found multiple system_server parents!")
-                        continue
-
-                    system_server_parent = init_child
-                    Logger.info("Primary system_server parent: %s", init_child)
         # Handle the special case of native daemons spawning additional processes (except for zygote)
+        # subject -> running init children, lowest pid first
+        running: Dict[SubjectNode, List[ProcessNode]] = {}
+        for init_child in sorted(init.children, key=lambda x: x.pid):
+            if init_child.state == ProcessState.RUNNING:
+                running.setdefault(init_child.subject, []).append(init_child)
+
         for init_child in sorted(list(init.children), key=lambda x: x.pid):
             if init_child.state == ProcessState.STOPPED and "zygote" not in init_child.subject.sid.type:
-                for possible_parent in list(init.children):
-                    if possible_parent.state == ProcessState.RUNNING:
-                        if possible_parent.subject == init_child.subject:
-                            Logger.warn("Reparenting %s -> %s", init_child, possible_parent)
-
-                            possible_parent.children |= set([init_child])
-                            init.children -= set([init_child])
-                            init_child.parent = possible_parent
-
-                            # refork from the new parent creds
-                            init_child.cred = possible_parent.cred.execve()
-                            init_child.state = ProcessState.RUNNING
-                            break
+                possible_parents = running.get(init_child.subject)
+                if possible_parents:
+                    possible_parent = possible_parents[0]
+                    Logger.warn("Reparenting %s -> %s", init_child, possible_parent)
+
+                    possible_parent.children |= set([init_child])
+                    init.children -= set([init_child])
+                    init_child.parent = possible_parent
+
+                    # refork from the new parent creds
+                    init_child.cred = possible_parent.cred.execve()
+                    init_child.state = ProcessState.RUNNING
         if not system_server_parent:
             from IPython import embed; embed(); exit(1)
             Logger.error("Failed to identify the system_server parent")
@@ -866,8 +1575,10 @@ class FileSystemInstance:
 
         return True
 
-    def stats(self):
+    def stats(self, metrics_path: str = None):
+        '''log the metrics the stages recorded and save them as json (eval/<firmware>/metrics.json by default)'''
         log = Logger
+        m = self.metrics
         log.info("------- STATS --------")
         log.info("---[File Contexts Report]---")
         self.file_contexts_report()
@@ -875,95 +1586,61 @@ class FileSystemInstance:
         ############################
 
         log.info("---[Subject Backing File Report]---")
-        subjects_without_backing_files = list(filter(lambda x: len(x[1].backing_files) == 0, self.subjects.items()))
-        subjects_with_backing_files = list(filter(lambda x: len(x[1].backing_files) > 0, self.subjects.items()))
-        objects_without_backing_files = list(filter(lambda x: len(x[1].backing_files) == 0, self.objects.items()))
-        objects_with_backing_files = list(filter(lambda x: len(x[1].backing_files) > 0, self.objects.items()))
-
         log.info("STAT: Dataflow created %d subjects and %d objects with a total of %d R/W edges",
-                len(self.subjects), len(self.objects),
-                len(self.sepol.G_dataflow.edges()))
+                m.get("dataflow", "subjects", 0), m.get("dataflow", "objects", 0),
+                m.get("dataflow", "edges", 0))
         log.info("STAT: Recovered subject %d (%.1f%%) file mappings, but unable to do so for %d subjects",
-                 len(subjects_with_backing_files),
-                 float(len(subjects_with_backing_files))/len(self.subjects)*100.0,
-                 len(subjects_without_backing_files))
+                 m.get("dataflow", "subjects_with_files", 0),
+                 percent(m.get("dataflow", "subjects_with_files", 0), m.get("dataflow", "subjects", 0)),
+                 m.get("dataflow", "subjects_without_files", 0))
         log.info("STAT: Recovered object %d (%.1f%%) file mappings, but unable to do so for %d objects",
-                 len(objects_with_backing_files),
-                 float(len(objects_without_backing_files))/len(self.objects)*100.0,
-                 len(objects_without_backing_files))
+                 m.get("dataflow", "objects_with_files", 0),
+                 percent(m.get("dataflow", "objects_with_files", 0), m.get("dataflow", "objects", 0)),
+                 m.get("dataflow", "objects_without_files", 0))
 
         ############################
 
         log.info("---[IPC REPORT]---")
 
-        # IPC Missing owner report
-        missing_owner = set()
-        got_owner = set()
-        missing_ipc_types = {}
-        ipc_type_cnt = {}
-
-        for on, o in self.objects.items():
-            if isinstance(o, IPCNode):
-                ipc_type_cnt[o.ipc_type] = ipc_type_cnt.get(o.ipc_type, 0) + 1
-
-                if not o.owner:
-                    missing_owner |= set([o])
-                    missing_ipc_types[o.ipc_type] = missing_ipc_types.get(o.ipc_type, 0) + 1
-                else:
-                    got_owner |= set([o])
-
+        nodes = m.get("ipc", "nodes", 0)
+        missing_owner = m.get("ipc", "missing_owner", 0)
         log.info("IPC Freq:")
-        for ty, freq in sorted(ipc_type_cnt.items(), key=lambda x: x[1], reverse=True):
-            log.info("%s - %d (%.1f%%)", ty, freq, freq/(len(got_owner)+len(missing_owner))*100.0)
+        for ty, freq in m.get("ipc", "types", {}).items():
+            log.info("%s - %d (%.1f%%)", ty, freq, percent(freq, nodes))
 
         log.info("%d/%d (%.2f%%) IPCNodes are missing their owners!",
-                len(missing_owner), len(got_owner), float(len(missing_owner)) / len(got_owner) * 100.0)
-        for ty, freq in sorted(missing_ipc_types.items()):
+                missing_owner, nodes - missing_owner, percent(missing_owner, nodes - missing_owner))
+        for ty, freq in m.get("ipc", "missing_owner_types", {}).items():
             log.info("IPC type '%s' missing %d owners", ty, freq)
 
         log.info("------- END STATS --------")
 
-    def file_contexts_report(self):
-        fc_found = set()
-        fc_found_types = set()
-        fc_missing_types = set()
-        fc_prefixes = {}
-
-        # get some qualitative data about the file_contexts in relation to the FS
-        for f, perm in self.init.asp.combined_fs.files.items():
-            matches: List[AndroidFileContext] = self.get_file_context_matches(f)
-
-            if len(matches) <= 0: continue
-
-            ty = perm.selinux.type
-            fc_found |= set(matches)
-            fc_found_types |= set([ty])
-
-        # figure out which file contexts are missing from the file system
-        missing = set(self.file_contexts) - fc_found
-
-        for fc in missing:
-            # which types are missing
-            fc_missing_types.add(fc.context.type)
-            prefix = fc.regex.pattern.split(os.path.sep)[1]
-            if prefix not in fc_prefixes:
-                fc_prefixes[prefix] = 1
-            else:
-                fc_prefixes[prefix] += 1
-
-        fc_all_types = set(map(lambda x: x.context.type, self.file_contexts))
+        m.write(metrics_path if metrics_path else self.init.asp.get_saved_file_path("metrics.json"))
 
+    def file_contexts_report(self):
+        m = self.metrics
         log = Logger
         log.info("STAT: Filesystem matched %d/%d FCs (%.2f%% are missing)",
-                len(fc_found), len(self.file_contexts), len(missing)/len(self.file_contexts)*100.0)
+                m.get("labeling", "file_contexts_matched", 0), m.get("labeling", "file_contexts", 0),
+                percent(m.get("labeling", "file_contexts_missing", 0), m.get("labeling", "file_contexts", 0)))
         log.info("Here's a list of the most common filesystem prefixes that were never found")
-        for f, freq in sorted(fc_prefixes.items(), key=lambda x: x[1], reverse=True):
+        for f, freq in m.get("labeling", "missing_prefixes", {}).items():
             if freq > 1:
                 log.info("/%-10s - %d" % (f, freq))
 
         with open('missing-fc-report.txt', 'w') as report:
-            for fc in sorted(missing, key=lambda _: _.regex.pattern):
+            for fc in m.missing_fcs:
                 report.write(fc.regex.pattern + " " + fc.context.type + "\n")
 
-pass
+_inflate_instance: FileSystemInstance = None
+_inflate_expand_all_objects: bool = True
+
+def _init_inflate_worker(instance: FileSystemInstance, expand_all_objects: bool):
+    global _inflate_instance, _inflate_expand_all_objects
+    _inflate_instance = instance
+    _inflate_expand_all_objects = expand_all_objects
 
+def _inflate_worker(subject_name: str) -> List[ObjectFlow]:
+    return _inflate_instance.get_subject_flows(subject_name, _inflate_expand_all_objects)
+
+pass
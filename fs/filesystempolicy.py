@@ -1,9 +1,14 @@
+import copy
 import fnmatch
 import os, stat
-from typing import Dict, List, Self, Union
+from typing import TYPE_CHECKING, Dict, Iterator, List, Self, Tuple, Union
 
 from android.sepolicy import SELinuxContext
 from utils.logger import Logger
+from utils.overlay import OverlayDict
+
+if TYPE_CHECKING:
+    from fs.kernelfs import KernelFS
 
 class FilePolicy:
     def __init__(self, path: str | None):
@@ -90,6 +95,13 @@ class FileSystemPolicy:
     def __init__(self):
         self.files: Dict[str, FilePolicy] = {}
         self.mount_points: Dict[str, MountPoint] = {}
+        self.kernelfs: 'KernelFS | None' = None
+        '''virtual /dev and /sys, when set ueventd rules and init changes to them live there instead of in files'''
+
+    def __setstate__(self, state: Dict):
+        # policies pickled before the kernelfs existed
+        state.setdefault('kernelfs', None)
+        self.__dict__.update(state)
 
     def __repr__(self):
         # only display the first x elements of self.files
@@ -106,6 +118,21 @@ class FileSystemPolicy:
     def __contains__(self, key: str) -> bool:
         return key in self.files
 
+    def lookup(self, path: str) -> FilePolicy | None:
+        '''FilePolicy of path, from the files or synthesized by the virtual kernel filesystem'''
+        fp = self.files.get(path)
+        if fp is None and self.kernelfs is not None:
+            fp = self.kernelfs.lookup(path)
+        return fp
+
+    def known_files(self) -> Iterator[Tuple[str, FilePolicy]]:
+        '''the files, then the concrete nodes of the virtual kernel filesystem they do not shadow'''
+        yield from self.files.items()
+        if self.kernelfs is not None:
+            for path, fp in self.kernelfs.concrete():
+                if path not in self.files:
+                    yield path, fp
+
     def add_file(self, path: str, file_policy: FilePolicy):
         if path != "/" and path.endswith("/"):
             raise ValueError("Paths must be cannonicalized! %s" % path)
@@ -147,16 +174,41 @@ class FileSystemPolicy:
         self.files[path] = policy_info
 
     def chown(self, path: str, user: int, group: int):
-        if path not in self.files: raise KeyError("File %s not in policy" % path)
-        self.files[path].user = user
-        self.files[path].group = group
+        if path not in self.files:
+            fp = self.kernelfs.writable(path, user, group) if self.kernelfs is not None else None
+            if fp is None: raise KeyError("File %s not in policy" % path)
+        else:
+            fp: FilePolicy = self.writable(path)
+        fp.user = user
+        fp.group = group
 
     def chmod(self, path: str, perm: int):
         '''Change the permission of a file'''
-        if path not in self.files: return
-        fp: FilePolicy = self.files[path]
+        if path not in self.files:
+            fp = self.kernelfs.writable(path) if self.kernelfs is not None else None
+            if fp is None: return
+        else:
+            fp: FilePolicy = self.writable(path)
         fp.perms = (fp.perms & ~0o7777) | (perm & 0o7777)
 
+    def snapshot(self) -> Self:
+        '''
+        Copy-on-write copy: files and mount points are overlays of this policy, a FilePolicy
+        is only copied when the snapshot changes it (see writable). This policy must not
+        change while the snapshot is in use.
+        '''
+        snap = FileSystemPolicy.__new__(FileSystemPolicy)
+        snap.files = OverlayDict(self.files)
+        snap.mount_points = OverlayDict(self.mount_points)
+        snap.kernelfs = self.kernelfs.snapshot() if self.kernelfs is not None else None
+        return snap
+
+    def writable(self, path: str) -> FilePolicy:
+        '''the FilePolicy of path, copied first if it is still shared with the policy this is a snapshot of'''
+        if isinstance(self.files, OverlayDict) and not self.files.owns(path):
+            self.files[path] = copy.copy(self.files[path])
+        return self.files[path]
+
     def real_path(self, path: str) -> str:
         """
         Resolve a path by following symbolic links (if any)
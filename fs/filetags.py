@@ -0,0 +1,97 @@
+import json
+import re
+from fnmatch import translate
+from typing import Dict, FrozenSet, List, Tuple, Union
+from utils.logger import Logger
+
+# Paths under these prefixes are part of the kernel/device surface and trusted
+TRUSTED_PREFIXES: List[str] = ['/sys/', '/dev/']
+
+# Only files under these prefixes get interface tags
+TAGGED_PREFIXES: List[str] = ['/dev/']
+
+# revoke trust from some externally controlled sources
+# tag -> fnmatch patterns, matched against the path and the object's type
+TAG_PATTERNS: Dict[str, List[str]] = {
+    'usb': ["*usb*", "*GS*", "*serial*"],
+    'bluetooth': ["*bt_*", "*bluetooth*", "*hci*"],
+    'nfc': ["*nfc*"],
+    'modem': ["*at_*", "*atd*", "*modem*", "*mdm*", "*smd*"],
+}
+
+class FileTagger:
+    '''
+    All tag patterns compiled into a single regex.
+
+    Every tag becomes an optional lookahead with its own named group, so one match
+    against a string reports all the tags it carries. Results are cached per path
+    and per type, nothing is stored on the (possibly shared) FilePolicy objects.
+    '''
+    def __init__(self, tag_patterns: Dict[str, List[str]] = TAG_PATTERNS,
+                 trusted_prefixes: List[str] = TRUSTED_PREFIXES,
+                 tagged_prefixes: List[str] = TAGGED_PREFIXES):
+        self.tags: List[str] = list(tag_patterns)
+        self.trusted_prefixes: Tuple[str, ...] = tuple(trusted_prefixes)
+        self.tagged_prefixes: Tuple[str, ...] = tuple(tagged_prefixes)
+
+        groups: List[str] = []
+        for i, tag in enumerate(self.tags):
+            alternatives = "|".join(translate(p) for p in tag_patterns[tag])
+            groups.append("(?:(?=(?P<t%d>%s)))?" % (i, alternatives))
+        self.regex: re.Pattern = re.compile("".join(groups)) if groups else None
+
+        self._path_tags: Dict[str, FrozenSet[str]] = {}
+        self._type_tags: Dict[str, FrozenSet[str]] = {}
+
+    @staticmethod
+    def from_file(path: str) -> 'FileTagger':
+        '''
+        Load the tag rules from a json config, every key is optional:
+            {
+                "tags": {"usb": ["*usb*", "*GS*"], "qcom_diag": ["*diag*"]},
+                "trusted_prefixes": ["/sys/", "/dev/"],
+                "tagged_prefixes": ["/dev/"]
+            }
+        '''
+        with open(path, 'r') as fp:
+            config = json.load(fp)
+
+        Logger.info("Loaded file tag rules from %s", path)
+        return FileTagger(tag_patterns=config.get("tags", TAG_PATTERNS),
+                          trusted_prefixes=config.get("trusted_prefixes", TRUSTED_PREFIXES),
+                          tagged_prefixes=config.get("tagged_prefixes", TAGGED_PREFIXES))
+
+    def match(self, s: str) -> FrozenSet[str]:
+        '''tags whose patterns match s'''
+        if self.regex is None:
+            return frozenset()
+        m = self.regex.match(s)
+        return frozenset(self.tags[int(g[1:])] for g, v in m.groupdict().items() if v is not None)
+
+    def trusted_prefix(self, path: str) -> Union[str, None]:
+        '''the trusted prefix path starts with, if any'''
+        if not path.startswith(self.trusted_prefixes):
+            return None
+        for prefix in self.trusted_prefixes:
+            if path.startswith(prefix):
+                return prefix
+
+    def path_tags(self, path: str) -> FrozenSet[str]:
+        '''tags of a path alone, computed once per path'''
+        tags = self._path_tags.get(path)
+        if tags is None:
+            tags = self.match(path) if path.startswith(self.tagged_prefixes) else frozenset()
+            self._path_tags[path] = tags
+        return tags
+
+    def type_tags(self, ty: str) -> FrozenSet[str]:
+        tags = self._type_tags.get(ty)
+        if tags is None:
+            tags = self._type_tags[ty] = self.match(ty)
+        return tags
+
+    def tag(self, path: str, ty: str) -> FrozenSet[str]:
+        '''tags of a backing file, from its path and its object's type'''
+        if not path.startswith(self.tagged_prefixes):
+            return frozenset()
+        return self.path_tags(path) | self.type_tags(ty)
@@ -0,0 +1,192 @@
+import copy
+import os
+import re
+import stat
+from typing import Callable, Dict, Iterator, List, MutableMapping, Set, Self, Tuple
+from android.sepolicy import SELinuxContext
+from fs.filesystempolicy import FilePolicy
+from utils.overlay import OverlayDict
+
+KERNELFS_ROOTS = ("/dev", "/sys")
+
+# default permissions of nodes no rule covers
+#   devfs: directories 755, files 600
+#   sysfs: directories 755, files 644
+DEFAULT_DIR_MODE = 0o755 | stat.S_IFDIR
+DEFAULT_DEV_MODE = 0o600 | stat.S_IFCHR
+DEFAULT_SYS_MODE = 0o644 | stat.S_IFREG
+
+def is_kernelfs(path: str) -> bool:
+    return any(path == root or path.startswith(root + "/") for root in KERNELFS_ROOTS)
+
+class UeventRule:
+    '''
+    One ueventd.rc permission line, matched like ueventd does (devices.cpp Permissions):
+    no '*' is an exact match, a single trailing '*' a prefix match, any other '*' an
+    fnmatch with FNM_PATHNAME ('*' does not cross '/').
+    '''
+    def __init__(self, pattern: str, mode: int, user: int, group: int, attribute: str = None):
+        self.pattern: str = pattern
+        self.mode: int = mode
+        self.user: int = user
+        self.group: int = group
+        self.attribute: str | None = attribute
+        '''sysfs rules: the attribute file under the matched device directory'''
+
+        self.prefix: str | None = None
+        self.regex: re.Pattern | None = None
+        star = pattern.find('*')
+        if star == len(pattern) - 1:
+            self.prefix = pattern[:-1]
+        elif star != -1:
+            self.regex = re.compile("".join(
+                '[^/]*' if c == '*' else '[^/]' if c == '?' else re.escape(c) for c in pattern) + r'\Z')
+
+    @property
+    def literal_dir(self) -> str:
+        '''the deepest directory every path matching this rule is under'''
+        star = self.pattern.find('*')
+        head = self.pattern if star == -1 else self.pattern[:star]
+        return os.path.dirname(head) if star != -1 or self.attribute is None else self.pattern
+
+    def match_name(self, name: str) -> bool:
+        if self.prefix is not None:
+            return name.startswith(self.prefix)
+        if self.regex is not None:
+            return self.regex.match(name) is not None
+        return name == self.pattern
+
+    def match(self, path: str) -> bool:
+        if self.attribute is None:
+            return self.match_name(path)
+        directory, attribute = os.path.split(path)
+        return attribute == self.attribute and self.match_name(directory)
+
+    def policy(self) -> FilePolicy:
+        return FilePolicy.create_pseudo_file(self.user, self.group, self.mode)
+
+    def __repr__(self):
+        if self.attribute is None:
+            return "<UeventRule %s %o %d %d>" % (self.pattern, self.mode & 0o7777, self.user, self.group)
+        return "<UeventRule %s %s %o %d %d>" % (self.pattern, self.attribute, self.mode & 0o7777, self.user, self.group)
+
+class KernelFS:
+    '''
+    Virtual /dev and /sys. ueventd rules are kept as patterns and nodes are synthesized
+    when a path is looked up, instead of adding a FilePolicy per (wildcard expanded) path
+    to combined_fs. Only nodes init explicitly changes (chown/chmod) are stored.
+    '''
+    def __init__(self):
+        self.rules: List[UeventRule] = []
+        '''in definition order, the last matching rule wins like in ueventd'''
+        self.nodes: MutableMapping[str, FilePolicy] = {}
+        '''nodes changed by init, they take precedence over the rules'''
+        self.dirs: Set[str] = set(KERNELFS_ROOTS)
+        '''directories known to exist because some rule lies below them'''
+        self.labeler: Callable[[str], SELinuxContext | None] | None = None
+        '''path -> label from file_contexts/genfscon, set once the file contexts are applied'''
+        self.labels: Dict[str, SELinuxContext | None] = {}
+        '''memoized labeler results'''
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # bound to a FileSystemInstance, which sets it again when it applies its file contexts
+        state['labeler'] = None
+        state['labels'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # kernelfs pickled before nodes were labeled
+        state.setdefault('labeler', None)
+        state.setdefault('labels', {})
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return "<KernelFS %d rules, %d nodes>" % (len(self.rules), len(self.nodes))
+
+    def __contains__(self, path: str) -> bool:
+        return self.lookup(path) is not None
+
+    def add_rule(self, rule: UeventRule):
+        self.rules.append(rule)
+        directory = rule.literal_dir
+        while is_kernelfs(directory) and directory not in self.dirs:
+            self.dirs.add(directory)
+            directory = os.path.dirname(directory)
+
+    def lookup(self, path: str) -> FilePolicy | None:
+        '''metadata of a /dev or /sys path, synthesized from the rules. None if nothing is known about it'''
+        path = os.path.normpath(path)
+        fp = self.nodes.get(path)
+        if fp is not None:
+            return fp
+        for rule in reversed(self.rules):
+            if rule.match(path):
+                return self.labeled(path, rule.policy())
+        if path in self.dirs:
+            return self.labeled(path, FilePolicy.create_pseudo_file(0, 0, DEFAULT_DIR_MODE))
+        return None
+
+    def label(self, path: str) -> SELinuxContext | None:
+        if self.labeler is None:
+            return None
+        if path not in self.labels:
+            self.labels[path] = self.labeler(path)
+        return self.labels[path]
+
+    def labeled(self, path: str, fp: FilePolicy) -> FilePolicy:
+        '''fp (a fresh synthesized node) with the label of path'''
+        if self.labeler is not None:
+            fp.selinux = self.label(path)
+        return fp
+
+    def set_labeler(self, labeler: Callable[[str], SELinuxContext | None] | None):
+        '''label synthesized nodes with labeler from now on and relabel the stored ones'''
+        self.labeler = labeler
+        self.labels = {}
+        if labeler is None:
+            return
+        for path in list(self.nodes):
+            label = self.label(path)
+            if label != self.nodes[path].selinux:
+                self.writable(path).selinux = label
+
+    def concrete(self) -> Iterator[Tuple[str, FilePolicy]]:
+        '''
+        The nodes known by path: stored ones, directories and one representative per rule
+        ('*' replaced by '0', the path the materializing ueventd parser would have added).
+        '''
+        paths: Set[str] = set(self.nodes) | self.dirs
+        for rule in self.rules:
+            path = rule.pattern.replace('*', '0')
+            if rule.attribute is not None:
+                path = os.path.join(path, rule.attribute)
+            paths.add(os.path.normpath(path))
+        for path in sorted(paths):
+            yield path, self.lookup(path)
+
+    def writable(self, path: str, user: int = 0, group: int = 0) -> FilePolicy | None:
+        '''the stored node of path, created from the rules (or the defaults) on first change'''
+        path = os.path.normpath(path)
+        if not is_kernelfs(path):
+            return None
+        fp = self.nodes.get(path)
+        if fp is not None and isinstance(self.nodes, OverlayDict) and not self.nodes.owns(path):
+            fp = self.nodes[path] = copy.copy(fp)    # still shared with the kernelfs this is a snapshot of
+        if fp is None:
+            fp = self.lookup(path)
+            if fp is None:
+                mode = DEFAULT_DEV_MODE if path.startswith("/dev") else DEFAULT_SYS_MODE
+                fp = self.labeled(path, FilePolicy.create_pseudo_file(user, group, mode))
+            self.nodes[path] = fp
+        return fp
+
+    def snapshot(self) -> Self:
+        '''copy-on-write like FileSystemPolicy.snapshot, the nodes the snapshot changes end up in nodes.overlay'''
+        snap = KernelFS()
+        snap.rules = list(self.rules)
+        snap.dirs = set(self.dirs)
+        snap.nodes = OverlayDict(self.nodes)
+        snap.labeler = self.labeler
+        snap.labels = dict(self.labels)
+        return snap
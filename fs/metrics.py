@@ -0,0 +1,88 @@
+import json
+import os
+from typing import Any, Dict, List, Set, TYPE_CHECKING
+from fs.filecontext import AndroidFileContext
+from se.graphnode import IPCNode
+from utils.logger import Logger
+
+if TYPE_CHECKING:
+    from fs.filesysteminstance import FileSystemInstance
+
+def percent(part: int, total: int) -> float:
+    return float(part) / total * 100.0 if total else 0.0
+
+class MetricsCollector:
+    '''
+    Counts recorded by the instantiation stages while they run, so STATS does not have
+    to walk the subjects, objects and file contexts again. Everything ends up in
+    `metrics` (json friendly) and is logged by FileSystemInstance.stats.
+    '''
+    def __init__(self):
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+        '''section -> name -> value'''
+
+        self.missing_fcs: List[AndroidFileContext] = []
+        '''file contexts no file on the filesystem matched'''
+
+    def set(self, section: str, key: str, value: Any):
+        self.metrics.setdefault(section, {})[key] = value
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        return self.metrics.get(section, {}).get(key, default)
+
+    def record_labeling(self, fsi: 'FileSystemInstance', recovered: int, dropped: int):
+        '''after apply_file_contexts, reuses the matches labeling already computed'''
+        fc_found: Set[AndroidFileContext] = set()
+        for matches in fsi.fc_matches.values():
+            fc_found.update(matches)
+
+        # figure out which file contexts are missing from the file system
+        self.missing_fcs = sorted((fc for fc in fsi.file_contexts if fc not in fc_found), key=lambda fc: fc.regex.pattern)
+        fc_prefixes: Dict[str, int] = {}
+        for fc in self.missing_fcs:
+            prefix = fc.regex.pattern.split(os.path.sep)[1]
+            fc_prefixes[prefix] = fc_prefixes.get(prefix, 0) + 1
+
+        self.set("labeling", "files", len(fsi.fc_matches))
+        self.set("labeling", "recovered_labels", recovered)
+        self.set("labeling", "dropped_files", dropped)
+        self.set("labeling", "file_contexts", len(fsi.file_contexts))
+        self.set("labeling", "file_contexts_matched", len(fc_found))
+        self.set("labeling", "file_contexts_missing", len(self.missing_fcs))
+        self.set("labeling", "missing_prefixes", dict(sorted(fc_prefixes.items(), key=lambda x: x[1], reverse=True)))
+
+    def record_dataflow(self, fsi: 'FileSystemInstance'):
+        '''after inflate_graph, one pass over the subjects and one over the objects'''
+        subjects_with_files = sum(1 for s in fsi.subjects.values() if len(s.backing_files) > 0)
+
+        objects_with_files = 0
+        ipc_types: Dict[str, int] = {}
+        missing_owner_types: Dict[str, int] = {}
+        for o in fsi.objects.values():
+            if len(o.backing_files) > 0:
+                objects_with_files += 1
+            if isinstance(o, IPCNode):
+                ipc_types[o.ipc_type] = ipc_types.get(o.ipc_type, 0) + 1
+                if not o.owner:
+                    missing_owner_types[o.ipc_type] = missing_owner_types.get(o.ipc_type, 0) + 1
+
+        self.set("dataflow", "subjects", len(fsi.subjects))
+        self.set("dataflow", "subject_groups", len(fsi.subject_groups))
+        self.set("dataflow", "subjects_with_files", subjects_with_files)
+        self.set("dataflow", "subjects_without_files", len(fsi.subjects) - subjects_with_files)
+        self.set("dataflow", "objects", len(fsi.objects))
+        self.set("dataflow", "objects_with_files", objects_with_files)
+        self.set("dataflow", "objects_without_files", len(fsi.objects) - objects_with_files)
+        self.set("dataflow", "edges", fsi.sepol.G_dataflow.number_of_edges())
+
+        self.set("ipc", "types", dict(sorted(ipc_types.items(), key=lambda x: x[1], reverse=True)))
+        self.set("ipc", "missing_owner_types", dict(sorted(missing_owner_types.items())))
+        self.set("ipc", "nodes", sum(ipc_types.values()))
+        self.set("ipc", "missing_owner", sum(missing_owner_types.values()))
+
+    def write(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump(self.metrics, fp, indent=2, sort_keys=True)
+        Logger.info("Wrote metrics to %s", path)
@@ -3,9 +3,11 @@
 import os
 from typing import List
 from android.init import AndroidInit
+from android.propertycontexts import PROPERTY_CONTEXTS_FILES, PropertyContextIndex, PropertySetters
+from android.servicecontexts import SERVICE_CONTEXTS_FILES, ServiceContextIndex
 from extractor.androidsecuritypolicy import AndroidSecurityPolicy
 from extractor.androidsecuritypolicyextractor import AndroidSecurityPolicyExtractor
-from extractor.zipextractor import ZipExtractor
+from extractor.zipextractor import EXTRACT_PATTERNS, ZipExtractor
 from fs.filecontext import read_file_contexts
 from fs.filesysteminstance import FileSystemInstance
 from fs.filesystempolicy import FileSystem
@@ -22,7 +24,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     name = 'Huawei_Mate_20'
-    ext = ZipExtractor(f'{name}.zip')
+    # Huawei firmwares ship update*.app (and nested zips), everything else in the archive is skipped
+    ext = ZipExtractor(f'{name}.zip', patterns=EXTRACT_PATTERNS)
     ext.split_update_app() 
     fs_lst: List[FileSystem] = ext.process_file()
     Logger.debug("Extractor done !")
@@ -51,11 +54,17 @@ if __name__ == "__main__":
     pg: PolicyGraph = graph.build_graph()
     Logger.debug("Overlaying policy to filesystems")
 
+    property_contexts = PropertyContextIndex.from_files(asp.get_saved_file_path(f) for f in PROPERTY_CONTEXTS_FILES)
+    PropertySetters(property_contexts, pg).write(asp.properties, asp.get_saved_file_path("property_setters.json"))
+
 
     ################################
     # Simulate the whole system
     ################################
-    res = FileSystemInstance(pg, init, file_contexts).instantiate()
+    fsi = FileSystemInstance(pg, init, file_contexts)
+    fsi.service_contexts = ServiceContextIndex.from_files(
+        {teclass: [asp.get_saved_file_path(f) for f in files] for teclass, files in SERVICE_CONTEXTS_FILES.items()})
+    res = fsi.instantiate()
     Logger.debug("main.py done")
 
 
@@ -1,6 +1,6 @@
 
 from enum import Enum
-from typing import Dict, Protocol, Self, Set, Union
+from typing import Dict, Protocol, Self, Set, Tuple, Union
 from android.capabilities import Capabilities
 from android.dac import Cred
 from android.sepolicy import SELinuxContext
@@ -130,5 +130,49 @@ class ProcessNode(GraphNode):
     def add_child(self, child: Self):
         self.children.add(child)
 
-pass
+ObjectTemplate = Tuple[str, Union[str, None]]
+'''(node kind, ipc_type) ipc_type is None unless kind is "ipc"'''
+
+class ObjectNodeRegistry:
+    '''
+    Flyweight factory for object nodes.
+    A node only depends on its kind, ipc_type and type, so every allow rule that
+    expands to the same object shares a single node instead of a deep copy.
+    '''
+    def __init__(self):
+        self.nodes: Dict[Tuple[str, Union[str, None], str], GraphNode] = {}
+
+    def __contains__(self, key: Tuple[str, Union[str, None], str]) -> bool:
+        return key in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, kind: str, ipc_type: Union[str, None], ty: str) -> Tuple[GraphNode, bool]:
+        '''return (node, created), the node is only built the first time the key is seen'''
+        key = (kind, ipc_type, ty)
+        node = self.nodes.get(key)
+        if node is not None:
+            return node, False
+
+        node = ObjectNodeRegistry.create_node(kind, ipc_type)
+        node.sid = SELinuxContext.FromString("u:object_t:%s:s0" % ty)
+        self.nodes[key] = node
+        return node, True
+
+    def discard(self, kind: str, ipc_type: Union[str, None], ty: str):
+        self.nodes.pop((kind, ipc_type, ty), None)
+
+    @staticmethod
+    def create_node(kind: str, ipc_type: Union[str, None]) -> GraphNode:
+        '''build a blank node from a template'''
+        match kind:
+            case "file":
+                return FileNode()
+            case "ipc":
+                return IPCNode(ipc_type)
+            case "subject":
+                return SubjectNode(Cred())
+        raise ValueError("Unhandled object kind %s" % kind)
 
+pass
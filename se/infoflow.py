@@ -0,0 +1,135 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Set, Tuple
+import networkx as nx
+from se.permissionmap import MAX_WEIGHT, MIN_WEIGHT
+from se.reachability import ReachabilityIndex
+from utils import resolve_jobs
+from utils.logger import Logger
+
+FlowQuery = Tuple[str, str]
+
+class FlowPath:
+    '''one information flow path through G_dataflow'''
+    def __init__(self, nodes: List[str], weights: List[int]):
+        self.nodes: List[str] = nodes
+        self.weights: List[int] = weights
+        '''weight of each hop, len(weights) == len(nodes) - 1'''
+
+    @property
+    def strength(self) -> int:
+        '''a path is only as strong as its weakest hop'''
+        return min(self.weights, default=MAX_WEIGHT)
+
+    @property
+    def cost(self) -> int:
+        return sum(flow_cost(w) for w in self.weights)
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def __repr__(self):
+        return "<FlowPath %s (strength %d, cost %d)>" % (" -> ".join(self.nodes), self.strength, self.cost)
+
+def flow_cost(weight: int) -> int:
+    '''strong flows are cheap, so shortest paths prefer them'''
+    return MAX_WEIGHT + 1 - weight
+
+class InformationFlowAnalysis:
+    '''
+    Weighted path search over G_dataflow.
+
+    Parallel edges are collapsed into one edge carrying the strongest weight. Edges that
+    have no weight (the subject -> subject group is-a edges) count as MAX_WEIGHT: they
+    never weaken a path or fail min_weight, and cost 1 like the strongest flow.
+    '''
+    def __init__(self, G_dataflow: nx.MultiDiGraph, reachability: ReachabilityIndex = None):
+        self.G: nx.DiGraph = nx.DiGraph()
+        for u, v, weight in G_dataflow.edges(data="weight", default=MAX_WEIGHT):
+            if self.G.has_edge(u, v) and self.G[u][v]["weight"] >= weight:
+                continue
+            self.G.add_edge(u, v, weight=weight, cost=flow_cost(weight))
+        self.G.add_nodes_from(G_dataflow.nodes)
+
+        self.reachability: ReachabilityIndex = reachability if reachability else ReachabilityIndex(self.G)
+
+    def paths(self, source: str, target: str, k: int = 1, min_weight: int = MIN_WEIGHT,
+              exclude: Iterable[str] = (), max_cost: int = None) -> List[FlowPath]:
+        '''
+        The k cheapest simple paths source -> target.
+            * min_weight: ignore any edge weaker than this
+            * exclude: nodes no path may go through
+            * max_cost: stop once paths get more expensive than this
+        '''
+        return _search(self.G, self.reachability, source, target, k, min_weight, set(exclude), max_cost)
+
+    def paths_many(self, queries: Iterable[FlowQuery], k: int = 1, min_weight: int = MIN_WEIGHT,
+                   exclude: Iterable[str] = (), max_cost: int = None, jobs: int = None) -> Dict[FlowQuery, List[FlowPath]]:
+        '''Run paths() for many (source, target) pairs, spread over a process pool'''
+        queries = list(dict.fromkeys(queries))
+        exclude = set(exclude)
+        jobs = min(resolve_jobs(jobs), max(1, len(queries)))
+
+        if jobs == 1:
+            return {q: _search(self.G, self.reachability, q[0], q[1], k, min_weight, exclude, max_cost) for q in queries}
+
+        Logger.debug("Searching %d flow queries with %d workers", len(queries), jobs)
+        # fork lets the workers inherit the graph instead of pickling it per task
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_worker, initargs=(self.G, self.reachability)) as pool:
+            results = pool.map(_search_worker, queries,
+                               itertools.repeat((k, min_weight, exclude, max_cost)),
+                               chunksize=max(1, len(queries) // (jobs * 4)))
+            return dict(zip(queries, results))
+
+def _search(G: nx.DiGraph, reachability: ReachabilityIndex, source: str, target: str, k: int,
+            min_weight: int, exclude: Set[str], max_cost: int | None) -> List[FlowPath]:
+    if source not in G or target not in G or source in exclude or target in exclude:
+        return []
+    if not reachability.reachable(source, target):
+        return []
+
+    # Only nodes downstream of source and upstream of target can be on a path
+    candidates = reachability.descendants(source) & reachability.ancestors(target)
+    candidates |= {source, target}
+    candidates -= exclude
+
+    H: nx.DiGraph = nx.subgraph_view(G,
+                                    filter_node=lambda n: n in candidates,
+                                    filter_edge=lambda u, v: G[u][v]["weight"] >= min_weight)
+
+    if max_cost is not None:
+        # admissible pruning: drop nodes where even the cheapest detour exceeds the budget
+        to_node = nx.single_source_dijkstra_path_length(H, source, cutoff=max_cost, weight="cost")
+        from_node = nx.single_source_dijkstra_path_length(H.reverse(copy=False), target, cutoff=max_cost, weight="cost")
+        candidates &= {n for n in to_node if n in from_node and to_node[n] + from_node[n] <= max_cost}
+        if source not in candidates or target not in candidates:
+            return []
+
+    res: List[FlowPath] = []
+    try:
+        # Yen's algorithm, each spur path is found with a bidirectional dijkstra
+        for nodes in nx.shortest_simple_paths(H, source, target, weight="cost"):
+            path = FlowPath(nodes, [G[u][v]["weight"] for u, v in zip(nodes, nodes[1:])])
+            if max_cost is not None and path.cost > max_cost:
+                break
+            res.append(path)
+            if len(res) >= k:
+                break
+    except nx.NetworkXNoPath:
+        pass
+
+    return res
+
+_worker_graph: nx.DiGraph = None
+_worker_reachability: ReachabilityIndex = None
+
+def _init_worker(G: nx.DiGraph, reachability: ReachabilityIndex):
+    global _worker_graph, _worker_reachability
+    _worker_graph = G
+    _worker_reachability = reachability
+
+def _search_worker(query: FlowQuery, options: Tuple[int, int, Set[str], int | None]) -> List[FlowPath]:
+    k, min_weight, exclude, max_cost = options
+    return _search(_worker_graph, _worker_reachability, query[0], query[1], k, min_weight, exclude, max_cost)
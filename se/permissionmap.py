@@ -0,0 +1,202 @@
+import json
+from typing import Dict, Iterable, List, Set, Tuple
+from se.sepolicygraph import PolicyGraph
+from utils.logger import Logger
+
+# We consider binder:call and *:ioctl to be bi-directional
+
+# ignore fd:use for now
+# we ignore getattr as this is not security sensitive enough
+# ignore DRMservice for now (pread)
+READ_PERMS: List[str] = [
+    'read', 'ioctl', 'unix_read', 'search',
+    'recv', 'receive', 'recv_msg',  'recvfrom', 'rawip_recv', 'tcp_recv', 'dccp_recv', 'udp_recv',
+    'nlmsg_read', 'nlmsg_readpriv',
+    # Android specific
+    'call', # binder
+    'list', # service_manager
+    'find', # service_manager
+]
+
+# ignore setattr for now. ignore create types
+WRITE_PERMS: List[str] = [
+    'write', 'append',
+    #'ioctl',
+    'add_name', 'unix_write', 'enqueue',
+    'send', 'send_msg',  'sendto', 'rawip_send', 'tcp_send', 'dccp_send', 'udp_send',
+    'connectto',
+    'nlmsg_write',
+    # Android specific
+    'call', # binder
+    #'transfer', # binder
+    'set', # property_service
+    'add', # service_manager
+    'find', # service_manager - this is not necessarily a write type,
+            #but why bother finding a service if you aren't going to send a message to it?
+    'ptrace',
+    'transition',
+]
+
+# management types
+MANAGE_PERMS: List[str] = [
+    'create', 'open'
+]
+
+MAX_WEIGHT: int = 10
+MIN_WEIGHT: int = 1
+
+# How much information a permission lets through, 1 (barely any) to 10 (arbitrary data).
+# Same scale as the setools permission map; unknown flow perms get MIN_WEIGHT.
+PERMISSION_WEIGHTS: Dict[str, int] = {
+    'read': 10, 'write': 10, 'append': 9, 'ioctl': 7,
+    'unix_read': 9, 'unix_write': 9, 'enqueue': 7,
+    'search': 1, 'add_name': 3,
+    'recv': 9, 'receive': 9, 'recv_msg': 9, 'recvfrom': 9,
+    'rawip_recv': 9, 'tcp_recv': 9, 'dccp_recv': 9, 'udp_recv': 9,
+    'send': 9, 'send_msg': 9, 'sendto': 9,
+    'rawip_send': 9, 'tcp_send': 9, 'dccp_send': 9, 'udp_send': 9,
+    'connectto': 8,
+    'nlmsg_read': 6, 'nlmsg_readpriv': 7, 'nlmsg_write': 8,
+    'call': 10, 'list': 2, 'find': 4, 'set': 8, 'add': 6,
+    'ptrace': 10, 'transition': 10,
+}
+
+def perm_weight(perm: str) -> int:
+    return PERMISSION_WEIGHTS.get(perm, MIN_WEIGHT)
+
+def flow_weight(perms: Iterable[str]) -> int:
+    '''strength of a flow is the strongest permission that carries it, 0 if none'''
+    return max(map(perm_weight, perms), default=0)
+
+READ: int = 1
+WRITE: int = 2
+MANAGE: int = 4
+
+Direction = Tuple[bool, bool, bool]
+
+class DataflowTable:
+    '''
+    Permission -> dataflow classification, computed once per policy.
+
+    Every perm of a class (its own and its common's) gets a bit. For each class we keep
+    the masks of the perms that count as read, write and manage, so an allow edge only
+    needs its permission bitmask to be classified. The mask is cached on the edge and the
+    resulting direction is cached per (class, mask).
+    '''
+    def __init__(self, pg: PolicyGraph,
+                 read_perms: Iterable[str] = READ_PERMS,
+                 write_perms: Iterable[str] = WRITE_PERMS,
+                 manage_perms: Iterable[str] = MANAGE_PERMS,
+                 class_overrides: Dict[str, Dict[str, List[str]]] = None,
+                 weights: Dict[str, int] = None):
+        self.perm_bit: Dict[str, Dict[str, int]] = {}
+        '''class -> perm -> bit'''
+
+        self.masks: Dict[str, Tuple[int, int, int]] = {}
+        '''class -> (read mask, write mask, manage mask)'''
+
+        self.weights: Dict[str, int] = dict(PERMISSION_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+
+        self._directions: Dict[Tuple[str, int], Direction] = {}
+        self._defaults: Tuple[Set[str], Set[str], Set[str]] = (set(read_perms), set(write_perms), set(manage_perms))
+        self._overrides: Dict[str, Dict[str, List[str]]] = class_overrides or {}
+        self._override_sets: Dict[str, Tuple[Set[str], Set[str], Set[str]]] = {}
+
+        for cls_name, cls in pg.classes.items():
+            perms = list(cls.perms)
+            if cls.inherits is not None:
+                perms += pg.commons[cls.inherits]
+            self._add_class(cls_name, perms)
+
+        # the policy is fixed from here on, pre-compute the mask of every allow edge
+        for _, _, edge in pg.G_allow.edges(data=True):
+            edge["perm_mask"] = self.mask(edge["teclass"], edge["perms"])
+
+    @staticmethod
+    def from_file(pg: PolicyGraph, path: str) -> 'DataflowTable':
+        '''
+        Load the classification from a json config, every key is optional:
+            {
+                "read": ["read", ...], "write": [...], "manage": [...],
+                "classes": {"binder": {"read": ["call"], "write": ["call", "transfer"]}},
+                "weights": {"ioctl": 5}
+            }
+        A class listed under "classes" uses its own lists instead of the global ones.
+        '''
+        with open(path, 'r') as fp:
+            config = json.load(fp)
+
+        Logger.info("Loaded dataflow classification from %s", path)
+        return DataflowTable(pg,
+                             read_perms=config.get("read", READ_PERMS),
+                             write_perms=config.get("write", WRITE_PERMS),
+                             manage_perms=config.get("manage", MANAGE_PERMS),
+                             class_overrides=config.get("classes"),
+                             weights=config.get("weights"))
+
+    def _add_class(self, cls_name: str, perms: Iterable[str]):
+        bits = self.perm_bit.setdefault(cls_name, {})
+        for perm in perms:
+            if perm not in bits:
+                bits[perm] = len(bits)
+
+        read, write, manage = self._flow_perms(cls_name)
+        masks = [0, 0, 0]
+        for perm, bit in bits.items():
+            for i, flow in enumerate((read, write, manage)):
+                if perm in flow:
+                    masks[i] |= 1 << bit
+        self.masks[cls_name] = tuple(masks)
+
+    def _flow_perms(self, cls_name: str) -> Tuple[Set[str], Set[str], Set[str]]:
+        if cls_name not in self._overrides:
+            return self._defaults
+        if cls_name not in self._override_sets:
+            override = self._overrides[cls_name]
+            self._override_sets[cls_name] = tuple(set(override[k]) if k in override else default
+                                                  for k, default in zip(("read", "write", "manage"), self._defaults))
+        return self._override_sets[cls_name]
+
+    def perm_flags(self, teclass: str, perm: str) -> int:
+        '''READ | WRITE | MANAGE bits of a single (class, perm)'''
+        bit = 1 << self.perm_bit[teclass][perm]
+        r, w, m = self.masks[teclass]
+        return (READ if r & bit else 0) | (WRITE if w & bit else 0) | (MANAGE if m & bit else 0)
+
+    def mask(self, teclass: str, perms: Iterable[str]) -> int:
+        bits = self.perm_bit.get(teclass)
+        if bits is None or any(p not in bits for p in perms):
+            # unknown class or perm (e.g. a rule added after the table was built)
+            # existing bits never move, so cached directions stay valid
+            self._add_class(teclass, perms)
+            bits = self.perm_bit[teclass]
+
+        mask = 0
+        for perm in perms:
+            mask |= 1 << bits[perm]
+        return mask
+
+    def direction(self, edge: Dict) -> Direction:
+        '''(read, write, manage) of an allow edge'''
+        teclass: str = edge["teclass"]
+        mask: int = edge.get("perm_mask")
+        if mask is None:
+            mask = edge["perm_mask"] = self.mask(teclass, edge["perms"])
+
+        key = (teclass, mask)
+        res = self._directions.get(key)
+        if res is None:
+            r, w, m = self.masks[teclass]
+            res = self._directions[key] = (mask & r != 0, mask & w != 0, mask & m != 0)
+        return res
+
+    def flow_perms(self, teclass: str, perms: Iterable[str], ty: str) -> List[str]:
+        '''the perms of an edge that carry a "read" or "write" flow'''
+        read, write, _ = self._flow_perms(teclass)
+        flow = read if ty == "read" else write
+        return [p for p in perms if p in flow]
+
+    def flow_weight(self, perms: Iterable[str]) -> int:
+        return max((self.weights.get(p, MIN_WEIGHT) for p in perms), default=0)
@@ -0,0 +1,120 @@
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Union
+from android.dac import Cred
+from fs.filesystempolicy import FilePolicy
+from se.graphnode import ProcessNode, SubjectNode
+
+class LazyProcessNode(ProcessNode):
+    '''ProcessNode whose children are only created the first time they are accessed'''
+    def __init__(self, tree: 'ProcessTree', subject: SubjectNode, parent: Union[None, ProcessNode],
+                 exe: Dict[str, FilePolicy], pid: int, cred: Cred):
+        super().__init__(subject, parent, exe, pid, cred)
+        self.tree: ProcessTree = tree
+        self._children: Union[Set[ProcessNode], None] = None
+
+    @property
+    def expanded(self) -> bool:
+        return self._children is not None
+
+    @property
+    def children(self) -> Set[ProcessNode]:
+        if self._children is None:
+            self._children = set()
+            self.tree.expand(self)
+        return self._children
+
+    @children.setter
+    def children(self, v: Set[ProcessNode]):
+        self._children = v
+
+class ProcessTree:
+    '''
+    The process tree of gen_process_tree, materialized on demand.
+
+    A process gets one child per backing file of every child subject, but only once its
+    children are asked for. Like the eager tree's `visited` set, a subject is only
+    instantiated under the first process that expands it (crash_dump under zygote
+    excepted), so the tree never holds more processes than the eager one, even after a
+    full walk. Which parent gets a shared child subject follows the order of the queries,
+    so the two modes can attach it differently. Until simulate_process_permissions gives
+    a process its own credentials, it shares the credential template of its subject.
+    '''
+    def __init__(self, real_path: Callable[[str], str], processes: Dict[str, ProcessNode]):
+        self.real_path: Callable[[str], str] = real_path
+        self.processes: Dict[str, ProcessNode] = processes
+        '''proc_id -> process, every node materialized so far'''
+
+        self.next_pid: int = 0
+
+        self.instantiated: Set[SubjectNode] = set()
+        '''subjects that already have processes somewhere in the tree'''
+
+        self._children_of: Dict[SubjectNode, List[SubjectNode]] = {}
+        self._templates: Dict[SubjectNode, Cred] = {}
+        self._exe_paths: Dict[str, str] = {}
+
+    def root(self, kernel: SubjectNode, init: SubjectNode) -> ProcessNode:
+        '''create kernel_0 and its init processes, which simulate_process_permissions starts from'''
+        # kernel and init credentials are edited in place later, they get their own
+        kernel_process = self.create(kernel, None, {'/kernel' : {}}, Cred())
+        kernel_process.children = set()
+        for fn, fp in init.backing_files.items():
+            process = self.create(init, kernel_process, {self.exe_path(fn) : fp}, Cred())
+            kernel_process.add_child(process)
+        return kernel_process
+
+    def create(self, subject: SubjectNode, parent: Union[None, ProcessNode], exe: Dict[str, FilePolicy],
+               cred: Cred = None) -> LazyProcessNode:
+        pid = self.next_pid
+        self.next_pid += 1
+
+        self.instantiated.add(subject)
+        process = LazyProcessNode(self, subject, parent, exe, pid, cred if cred is not None else self.template(subject))
+        proc_id = "%s_%d" % (subject.type, pid)
+        assert proc_id not in self.processes
+        self.processes[proc_id] = process
+        return process
+
+    def expand(self, process: LazyProcessNode):
+        '''materialize the direct children of a process'''
+        for child in self.children_of(process.subject):
+            if child in self.instantiated and not (child.type == "crash_dump" and process.subject.type in ["zygote"]):
+                continue
+            for fn, fp in child.backing_files.items():
+                process.add_child(self.create(child, process, {self.exe_path(fn) : fp}))
+
+    def children_of(self, subject: SubjectNode) -> List[SubjectNode]:
+        '''child subjects in a stable order, sorted once per subject'''
+        res = self._children_of.get(subject)
+        if res is None:
+            res = self._children_of[subject] = sorted(subject.children, key=lambda x: str(x.type))
+        return res
+
+    def template(self, subject: SubjectNode) -> Cred:
+        cred = self._templates.get(subject)
+        if cred is None:
+            cred = self._templates[subject] = Cred()
+            cred.sid = subject.sid
+        return cred
+
+    def exe_path(self, fn: str) -> str:
+        path = self._exe_paths.get(fn)
+        if path is None:
+            path = self._exe_paths[fn] = self.real_path(fn)
+        return path
+
+    def walk(self, start: ProcessNode, max_depth: int = None) -> Iterator[Tuple[ProcessNode, int]]:
+        '''depth first (process, depth) pairs below start, materializing only what is visited'''
+        stack: List[Tuple[ProcessNode, int]] = [(start, 0)]
+        while stack:
+            process, depth = stack.pop()
+            yield process, depth
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for child in sorted(process.children, key=lambda x: x.pid, reverse=True):
+                stack.append((child, depth + 1))
+
+    def find(self, start: ProcessNode, subject_type: str, max_depth: int = None) -> Iterator[ProcessNode]:
+        '''processes of a subject type below start'''
+        for process, _ in self.walk(start, max_depth):
+            if process.subject.type == subject_type:
+                yield process
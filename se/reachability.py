@@ -0,0 +1,230 @@
+from typing import Dict, Hashable, Iterable, List, Set, Tuple
+import networkx as nx
+
+class ReachabilityIndex:
+    '''
+    Transitive closure of a graph, stored as one bitset per strongly connected component.
+
+    The graph is condensed into its SCC DAG. Each SCC gets an integer id following the
+    topological order, and its ancestor/descendant sets are kept as python ints where
+    bit `i` is set when SCC `i` is reachable. Queries never walk the graph again.
+
+    Edge insertions that keep the condensation a DAG are folded into the bitsets in place.
+    Anything else (a deletion, a new cycle) marks the index stale and it is rebuilt from
+    the graph on the next query, there is no cheap exact decremental update.
+    '''
+    def __init__(self, G: nx.DiGraph):
+        self.G: nx.DiGraph = G
+        '''the indexed graph, kept to rebuild after edits'''
+
+        self.stale: bool = False
+
+        self.ordered: bool = True
+        '''SCC ids still follow the topological order (lost after an in-place insertion)'''
+
+        self.scc_of: Dict[Hashable, int] = {}
+        '''node -> SCC id (topological order)'''
+
+        self.members: List[List[Hashable]] = []
+        '''SCC id -> nodes in that SCC'''
+
+        self.cyclic: List[bool] = []
+        '''SCC id -> whether a node of this SCC can reach itself'''
+
+        self.descendant_bits: List[int] = []
+        '''SCC id -> bitset of SCCs reachable from it (excluding itself)'''
+
+        self.ancestor_bits: List[int] = []
+        '''SCC id -> bitset of SCCs that can reach it (excluding itself)'''
+
+        self._build(G)
+
+    def _build(self, G: nx.DiGraph):
+        self.scc_of = {}
+        self.stale = False
+        self.ordered = True
+
+        C: nx.DiGraph = nx.condensation(G)
+        order: List[int] = list(nx.topological_sort(C))
+        # renumber the condensation so that ids follow the topological order
+        renumber: Dict[int, int] = {c: i for i, c in enumerate(order)}
+
+        self.members = [[] for _ in order]
+        for node, c in C.graph["mapping"].items():
+            self.scc_of[node] = renumber[c]
+            self.members[renumber[c]].append(node)
+
+        self.cyclic = [len(nodes) > 1 or any(G.has_edge(n, n) for n in nodes) for nodes in self.members]
+
+        successors: List[List[int]] = [[renumber[s] for s in C.successors(c)] for c in order]
+        predecessors: List[List[int]] = [[renumber[p] for p in C.predecessors(c)] for c in order]
+
+        # descendants: reverse topological order, every successor is already complete
+        desc: List[int] = [0] * len(order)
+        for i in range(len(order) - 1, -1, -1):
+            bits = 0
+            for s in successors[i]:
+                bits |= desc[s] | (1 << s)
+            desc[i] = bits
+
+        # ancestors: topological order, every predecessor is already complete
+        anc: List[int] = [0] * len(order)
+        for i in range(len(order)):
+            bits = 0
+            for p in predecessors[i]:
+                bits |= anc[p] | (1 << p)
+            anc[i] = bits
+
+        self.descendant_bits = desc
+        self.ancestor_bits = anc
+
+    def __contains__(self, node: Hashable) -> bool:
+        self._refresh()
+        return node in self.scc_of
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self.scc_of)
+
+    def _refresh(self):
+        if self.stale:
+            self._build(self.G)
+
+    ##### Incremental updates, call them after the graph itself was changed
+
+    def add_node(self, node: Hashable):
+        if self.stale or node in self.scc_of:
+            return
+        # an isolated node is a singleton SCC, it fits anywhere in the order
+        self.scc_of[node] = len(self.members)
+        self.members.append([node])
+        self.cyclic.append(False)
+        self.descendant_bits.append(0)
+        self.ancestor_bits.append(0)
+
+    def add_edge(self, u: Hashable, v: Hashable):
+        if self.stale:
+            return
+        self.add_node(u)
+        self.add_node(v)
+        cu = self.scc_of[u]
+        cv = self.scc_of[v]
+
+        if cu == cv:
+            if u == v and not self.cyclic[cu]:
+                self.cyclic[cu] = True
+            return
+        if (self.descendant_bits[cu] >> cv) & 1:
+            # already reachable, the closure does not change
+            return
+        if (self.descendant_bits[cv] >> cu) & 1:
+            # closes a cycle, SCCs have to be merged
+            self.stale = True
+            return
+
+        # everything reaching u (and u) now reaches v and everything below it
+        down = self.descendant_bits[cv] | (1 << cv)
+        up = self.ancestor_bits[cu] | (1 << cu)
+        bits = up
+        while bits:
+            low = bits & -bits
+            self.descendant_bits[low.bit_length() - 1] |= down
+            bits ^= low
+        bits = down
+        while bits:
+            low = bits & -bits
+            self.ancestor_bits[low.bit_length() - 1] |= up
+            bits ^= low
+
+        if cv < cu:
+            self.ordered = False
+
+    def remove_edge(self, u: Hashable, v: Hashable):
+        if self.stale or u not in self.scc_of or v not in self.scc_of:
+            return
+        if self.G.has_edge(u, v):
+            # a parallel edge is left, nothing changes
+            return
+        self.stale = True
+
+    def remove_node(self, node: Hashable):
+        # its edges were removed first, so the index is either stale already or the node was isolated
+        if node in self.scc_of and not self.stale:
+            self.stale = True
+
+    ##### Queries
+
+    def reachable(self, u: Hashable, v: Hashable) -> bool:
+        '''True if there is a path u -> v (a node always reaches itself)'''
+        self._refresh()
+        cu = self.scc_of[u]
+        cv = self.scc_of[v]
+        if cu == cv:
+            return True
+        # a DAG path only ever goes forward in topological order
+        if self.ordered and cv < cu:
+            return False
+        return (self.descendant_bits[cu] >> cv) & 1 == 1
+
+    def reachable_many(self, pairs: Iterable[Tuple[Hashable, Hashable]]) -> List[bool]:
+        '''Answer a batch of reachable(u, v) queries, in order'''
+        self._refresh()
+        scc_of = self.scc_of
+        desc = self.descendant_bits
+        res: List[bool] = []
+
+        for u, v in pairs:
+            cu = scc_of[u]
+            cv = scc_of[v]
+            res.append(cu == cv or (desc[cu] >> cv) & 1 == 1)
+
+        return res
+
+    def descendants(self, u: Hashable) -> Set[Hashable]:
+        '''All nodes reachable from u, u itself only if it is on a cycle'''
+        self._refresh()
+        return self._expand(self.scc_of[u], self.descendant_bits)
+
+    def ancestors(self, v: Hashable) -> Set[Hashable]:
+        '''All nodes that can reach v, v itself only if it is on a cycle'''
+        self._refresh()
+        return self._expand(self.scc_of[v], self.ancestor_bits)
+
+    def descendants_many(self, sources: Iterable[Hashable]) -> Set[Hashable]:
+        '''Union of descendants(u) for all u in sources'''
+        self._refresh()
+        bits = 0
+        res: Set[Hashable] = set()
+        for u in sources:
+            c = self.scc_of[u]
+            bits |= self.descendant_bits[c]
+            if self.cyclic[c]:
+                res.update(self.members[c])
+        res.update(self._decode(bits))
+        return res
+
+    def ancestors_many(self, targets: Iterable[Hashable]) -> Set[Hashable]:
+        '''Union of ancestors(v) for all v in targets'''
+        self._refresh()
+        bits = 0
+        res: Set[Hashable] = set()
+        for v in targets:
+            c = self.scc_of[v]
+            bits |= self.ancestor_bits[c]
+            if self.cyclic[c]:
+                res.update(self.members[c])
+        res.update(self._decode(bits))
+        return res
+
+    def _expand(self, c: int, table: List[int]) -> Set[Hashable]:
+        res: Set[Hashable] = set(self._decode(table[c]))
+        if self.cyclic[c]:
+            res.update(self.members[c])
+        return res
+
+    def _decode(self, bits: int) -> Iterable[Hashable]:
+        '''yield the members of every SCC whose bit is set'''
+        while bits:
+            low = bits & -bits
+            yield from self.members[low.bit_length() - 1]
+            bits ^= low
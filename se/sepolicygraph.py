@@ -1,7 +1,9 @@
-from typing import Dict, List, Set, Union
+from typing import Dict, Iterable, List, Protocol, Set, Tuple, Union
+import weakref
 import setools
 from setools.policyrep import TERule, AVRuleXperm, AVRule, FileNameTERule, TERuletype, Genfscon, FSUse, Type
 import networkx as nx
+from se.reachability import ReachabilityIndex
 from utils.logger import Logger
 
 class Class2:
@@ -9,6 +11,47 @@ class Class2:
         self.inherits: Union[str, None] = inherits
         self.perms: List[str] = perms
 
+DataflowEdge = Tuple[str, str, str]
+'''(from node, to node, "read" | "write") edge of G_dataflow'''
+
+class PolicyEdit:
+    '''one what-if change applied to a PolicyGraph'''
+    def __init__(self, kind: str, **details):
+        self.kind: str = kind
+        '''allow | typeattribute | type_transition'''
+        self.added: bool = details.pop("added")
+        self.details: Dict[str, Union[str, List[str], None]] = details
+
+    def __getitem__(self, key: str):
+        return self.details[key]
+
+    def __repr__(self):
+        return "<PolicyEdit %s%s %s>" % ("+" if self.added else "-", self.kind, self.details)
+
+class FlowDelta:
+    '''dataflow edges that appeared or disappeared because of a policy edit'''
+    def __init__(self, added: Iterable[DataflowEdge] = (), removed: Iterable[DataflowEdge] = ()):
+        self.added: Set[DataflowEdge] = set(added)
+        self.removed: Set[DataflowEdge] = set(removed)
+
+    def merge(self, other: 'FlowDelta'):
+        # an edge removed then added again (or the reverse) did not change
+        for edge in other.added:
+            if edge in self.removed: self.removed.discard(edge)
+            else: self.added.add(edge)
+        for edge in other.removed:
+            if edge in self.added: self.added.discard(edge)
+            else: self.removed.add(edge)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed)
+
+    def __repr__(self):
+        return "<FlowDelta +%d -%d>" % (len(self.added), len(self.removed))
+
+class PolicyEditListener(Protocol):
+    def on_policy_edit(self, edit: PolicyEdit) -> FlowDelta: ...
+
 class PolicyGraph:
     def __init__(self):
         self.classes: Dict[str, Class2] = {}
@@ -38,6 +81,144 @@ class PolicyGraph:
         '''teclass through name'''
         self.G_dataflow: nx.MultiDiGraph = nx.MultiDiGraph()
         '''dataflow graph 包含了主体以及对象'''
+        self.reachability: ReachabilityIndex = None
+        '''G_dataflow 的可达性索引, built after inflate_graph'''
+
+        self.listeners: List[weakref.ref] = []
+        '''
+        notified of every what-if edit, they keep G_dataflow in sync. Held weakly, an instance
+        nobody uses anymore (e.g. a boot scenario probe) does not stay alive for the policy
+        '''
+
+    def add_listener(self, listener: PolicyEditListener):
+        if listener not in self.get_listeners():
+            self.listeners.append(weakref.ref(listener))
+
+    def remove_listener(self, listener: PolicyEditListener):
+        self.listeners = [ref for ref in self.listeners if ref() is not None and ref() is not listener]
+
+    def get_listeners(self) -> List[PolicyEditListener]:
+        '''the listeners still alive, the dead ones are dropped'''
+        alive = [ref() for ref in self.listeners]
+        if None in alive:
+            self.listeners = [ref for ref, listener in zip(self.listeners, alive) if listener is not None]
+        return [listener for listener in alive if listener is not None]
+
+    def _notify(self, edit: PolicyEdit) -> FlowDelta:
+        Logger.debug("Policy edit %s", edit)
+        delta = FlowDelta()
+        for listener in self.get_listeners():
+            delta.merge(listener.on_policy_edit(edit))
+        return delta
+
+    def _check_name(self, name: str):
+        if name in self.aliases:
+            raise ValueError("'%s' is an alias, use the type it points to" % name)
+        if name not in self.types and name not in self.attributes:
+            raise ValueError("Unknown type or attribute '%s'" % name)
+
+    def expand_type(self, ty: str) -> List[str]:
+        '''a type (alias dereferenced) and all its attributes, the names rules can use for it'''
+        if ty in self.aliases:
+            ty = self.types[ty]
+        return self.types[ty] + [ty]
+
+    def allowed_perms(self, source: str, target: str, teclass: str) -> Set[str]:
+        '''perms of every allow rule source -> target:teclass, through any attribute of either side'''
+        res: Set[str] = set()
+        if source not in self.types or target not in self.types:
+            return res
+        targets = self.expand_type(target)
+        for s in self.expand_type(source):
+            if s not in self.G_allow:
+                continue
+            for t in targets:
+                for edge in self.G_allow.get_edge_data(s, t, default={}).values():
+                    if edge["teclass"] == teclass:
+                        res.update(edge["perms"])
+        return res
+
+    ##### What-if edits
+    # Each edit changes the policy in place, lets the listeners patch what they derived from
+    # it and returns which dataflow edges appeared or disappeared.
+
+    def add_allow_rule(self, source: str, target: str, teclass: str, perms: Iterable[str]) -> FlowDelta:
+        '''allow source target:teclass { perms };'''
+        self._check_name(source)
+        self._check_name(target)
+        if teclass not in self.classes:
+            raise ValueError("Unknown class '%s'" % teclass)
+        perms = list(perms)
+
+        edges = self.G_allow.get_edge_data(source, target, default={})
+        for edge in edges.values():
+            if edge["teclass"] == teclass:
+                edge["perms"] = edge["perms"] + [p for p in perms if p not in edge["perms"]]
+                edge.pop("perm_mask", None)
+                break
+        else:
+            self.G_allow.add_edge(source, target, teclass=teclass, perms=perms)
+
+        return self._notify(PolicyEdit("allow", added=True, source=source, target=target, teclass=teclass, perms=perms))
+
+    def remove_allow_rule(self, source: str, target: str, teclass: str, perms: Iterable[str] = None) -> FlowDelta:
+        '''drop perms (all of them if None) from the source -> target:teclass rules'''
+        removed: List[str] = []
+        edges = self.G_allow.get_edge_data(source, target, default={})
+        for key, edge in list(edges.items()):
+            if edge["teclass"] != teclass:
+                continue
+            drop = edge["perms"] if perms is None else [p for p in edge["perms"] if p in perms]
+            removed += drop
+            edge["perms"] = [p for p in edge["perms"] if p not in drop]
+            edge.pop("perm_mask", None)
+            if len(edge["perms"]) == 0:
+                self.G_allow.remove_edge(source, target, key)
+
+        if not removed:
+            return FlowDelta()
+        return self._notify(PolicyEdit("allow", added=False, source=source, target=target, teclass=teclass, perms=removed))
+
+    def add_type_attribute(self, ty: str, attr: str) -> FlowDelta:
+        '''typeattribute ty attr;'''
+        if ty not in self.types or ty in self.aliases:
+            raise ValueError("Unknown type '%s'" % ty)
+        if attr not in self.attributes:
+            raise ValueError("Unknown attribute '%s'" % attr)
+        if ty in self.attributes[attr]:
+            return FlowDelta()
+
+        self.attributes[attr].append(ty)
+        self.types[ty].append(attr)
+        return self._notify(PolicyEdit("typeattribute", added=True, type=ty, attribute=attr))
+
+    def remove_type_attribute(self, ty: str, attr: str) -> FlowDelta:
+        if attr not in self.attributes or ty not in self.attributes[attr]:
+            return FlowDelta()
+
+        self.attributes[attr].remove(ty)
+        self.types[ty].remove(attr)
+        return self._notify(PolicyEdit("typeattribute", added=False, type=ty, attribute=attr))
+
+    def add_type_transition(self, source: str, default: str, teclass: str, through: str, name: str = None) -> FlowDelta:
+        '''type_transition source through:teclass default [name];'''
+        self._check_name(source)
+        self._check_name(default)
+        self._check_name(through)
+        self.G_transition.add_edge(source, default, teclass=teclass, through=through, name=name)
+        return self._notify(PolicyEdit("type_transition", added=True, source=source, default=default,
+                                       teclass=teclass, through=through, name=name))
+
+    def remove_type_transition(self, source: str, default: str, teclass: str, through: str, name: str = None) -> FlowDelta:
+        edges = self.G_transition.get_edge_data(source, default, default={})
+        keys = [k for k, e in edges.items() if e["teclass"] == teclass and e["through"] == through and e["name"] == name]
+        if not keys:
+            return FlowDelta()
+
+        for key in keys:
+            self.G_transition.remove_edge(source, default, key)
+        return self._notify(PolicyEdit("type_transition", added=False, source=source, default=default,
+                                       teclass=teclass, through=through, name=name))
 
 class SELinuxPolicyGraph(setools.SELinuxPolicy):
     def build_graph(self) -> PolicyGraph:
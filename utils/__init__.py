@@ -23,4 +23,10 @@ def split_path_all(path: str) -> List[str]:
             directories.insert(0, directory)
         else:
             break
-    return directories
\ No newline at end of file
+    return directories
+
+def resolve_jobs(jobs: int | None) -> int:
+    '''Number of workers to use, `None` or 0 means one per core'''
+    if not jobs:
+        return os.cpu_count() or 1
+    return max(1, jobs)
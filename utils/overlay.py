@@ -0,0 +1,56 @@
+from typing import Dict, Generic, Iterator, MutableMapping, Set, TypeVar
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class OverlayDict(MutableMapping[K, V], Generic[K, V]):
+    '''
+    Copy-on-write view of a dict: reads fall through to the base, writes and deletes
+    only touch the overlay (deletes leave a tombstone). The base must not change while
+    overlays of it are alive.
+    '''
+    def __init__(self, base: MutableMapping[K, V]):
+        self.base: MutableMapping[K, V] = base
+        self.overlay: Dict[K, V] = {}
+        self.deleted: Set[K] = set()
+
+    def owns(self, key: K) -> bool:
+        '''whether key was written through this overlay with a value that is not the base's own'''
+        # a base value put back (e.g. a file restored after a drop) is still shared
+        return key in self.overlay and self.overlay[key] is not self.base.get(key)
+
+    def __getitem__(self, key: K) -> V:
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key: K, value: V):
+        self.overlay[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key: K):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.overlay or (key not in self.deleted and key in self.base)
+
+    def __iter__(self) -> Iterator[K]:
+        # base order first, like a dict copy updated in place would iterate
+        for key in self.base:
+            if key not in self.deleted:
+                yield key
+        for key in self.overlay:
+            if key not in self.base:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self.base) - len(self.deleted) + sum(1 for key in self.overlay if key not in self.base)
+
+    def __repr__(self):
+        return "<OverlayDict %d changed, %d deleted over %d>" % (len(self.overlay), len(self.deleted), len(self.base))